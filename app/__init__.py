@@ -8,6 +8,13 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_pagedown import PageDown
 from config import config
+from .instrumentation import QueryInstrumentation
+from .last_seen import LastSeenBuffer
+from .page_cache import PageCache
+from .follow_graph import FollowGraph
+from .identity_cache import IdentityCache
+from .role_table import RoleTable
+from .rendering import RenderCache, DeferredRendering
 
 # without parameter, not initialized
 bootstrap = Bootstrap()
@@ -18,6 +25,14 @@ login_manager = LoginManager()
 login_manager.session_protection = "strong"
 login_manager.login_view = "auth.login"  # in case that @login_required is used
 pagedown = PageDown()  # markdown preview when typing
+query_instrumentation = QueryInstrumentation()
+last_seen_buffer = LastSeenBuffer()
+page_cache = PageCache()
+follow_graph = FollowGraph()
+identity_cache = IdentityCache()
+role_table = RoleTable()
+render_cache = RenderCache()
+deferred_rendering = DeferredRendering()
 
 
 def create_app(config_name):
@@ -32,6 +47,18 @@ def create_app(config_name):
     db.init_app(app)
     login_manager.init_app(app)
     pagedown.init_app(app)
+    query_instrumentation.init_app(app)
+    last_seen_buffer.init_app(app)
+    page_cache.init_app(app)
+    render_cache.init_app(app)
+    follow_graph.init_app(app)
+    identity_cache.init_app(app)
+    role_table.init_app(app)
+    deferred_rendering.init_app(app)
+
+    from .email import outbox
+
+    outbox.init_app(app)
 
     if app.config["SSL_REDIRECT"]:
         from flask_sslify import SSLify
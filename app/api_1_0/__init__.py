@@ -4,4 +4,4 @@ from flask import Blueprint
 
 api = Blueprint("api", __name__)
 
-from . import authentication, errors, comments, posts, users
+from . import authentication, errors, comments, posts, search, users
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
 
-from flask import g, jsonify
+import hashlib
+import hmac
+import os
+from functools import lru_cache
+from flask import g, jsonify, current_app
 from flask_httpauth import HTTPBasicAuth
-from ..models import User, AnonymousUser
+from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from .. import db, role_table
+from ..cache import TTLCache
+from ..models import User, Role, Permission, AnonymousUser, AUTH_TOKEN_VERSION
 from .errors import unauthorized, forbidden
 from . import api
 
@@ -10,6 +17,176 @@ from . import api
 # no need to init in app/__init__.py
 auth = HTTPBasicAuth()
 
+# salted digest of (email, password) -> UserSnapshot, skips the slow KDF
+credential_cache = TTLCache(maxsize=10000)
+# per process, so the cache keys are useless outside of this worker
+credential_salt = os.urandom(16)
+
+
+class UserSnapshot:
+    """
+    The principal of an API request: the part of a user the API needs to
+    authorize it, read from the token or cached with the credentials. Any
+    other attribute loads the User, once per session.
+    """
+
+    is_anonymous = False
+    is_authenticated = True
+
+    def __init__(self, id, confirmed, permissions, role_id=None, token_generation=0):
+        self.id = id
+        self.confirmed = confirmed
+        self.permissions = permissions
+        self.role_id = role_id
+        self.token_generation = token_generation
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(
+            user.id,
+            user.confirmed,
+            user.permissions,
+            user.role_id,
+            user.token_generation or 0,
+        )
+
+    @property
+    def user(self):
+        # from the identity map after the first load
+        return User.query.get(self.id)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    def can(self, perm):
+        return self.permissions & perm == perm
+
+    def generate_auth_token(self, expiration):
+        # only needs the id, same token as the one of the User
+        return User.generate_auth_token(self, expiration)
+
+    def is_administrator(self):
+        return self.can(Permission.ADMIN)
+
+    def __repr__(self):
+        return "<UserSnapshot %r>" % self.id
+
+
+@lru_cache(maxsize=8)
+def token_serializer(secret_key):
+    return Serializer(secret_key)
+
+
+def generation_cache():
+    """user id -> current token generation, per worker and app"""
+    return current_app.extensions.setdefault(
+        "token_generations", TTLCache(maxsize=10000)
+    )
+
+
+def token_generation(user_id):
+    """the current token generation of a user, None once deleted"""
+    cache = generation_cache()
+    generation = cache.get(user_id)
+    if generation is None:
+        generation = (
+            db.session.query(User.token_generation).filter_by(id=user_id).scalar()
+        )
+        if generation is not None:
+            cache.set(user_id, generation, current_app.config["FLASKY_TOKEN_CACHE_TTL"])
+    return generation
+
+
+def verify_token(token):
+    """
+    Verify an auth token. Tokens of the current version carry what the
+    request is authorized with, the user is not loaded: only its token
+    generation is checked, from generation_cache().
+    """
+    s = token_serializer(current_app.config["SECRET_KEY"])
+    try:
+        data = s.loads(token)
+    except:
+        return None
+    if data.get("v") != AUTH_TOKEN_VERSION:
+        # issued before the versioned format, gone within the hour
+        user = User.query.get(data.get("id"))
+        return UserSnapshot.from_user(user) if user is not None else None
+    if data["gen"] != token_generation(data["id"]):
+        return None
+    # the role may have lost permissions since the token was issued
+    permissions = data["perm"] & role_table.permissions(data["role"])
+    return UserSnapshot(
+        data["id"], data["confirmed"], permissions, data["role"], data["gen"]
+    )
+
+
+def verify_credentials(email, password):
+    """
+    Verify email and password, and only run the deliberately slow password
+    hash if the same credentials were not verified within the last
+    FLASKY_CREDENTIAL_CACHE_TTL seconds.
+    """
+    key = hmac.new(
+        credential_salt,
+        email.encode("utf-8") + b"\0" + password.encode("utf-8"),
+        hashlib.sha256,
+    ).digest()
+    snapshot = credential_cache.get(key)
+    if snapshot is not None:
+        return snapshot
+    user = User.query.filter_by(email=email).first()
+    if user is None or not user.verify_password(password):
+        return None
+    if user in db.session.dirty:
+        # password was rehashed with the configured method
+        db.session.commit()
+    snapshot = UserSnapshot.from_user(user)
+    credential_cache.set(
+        key, snapshot, current_app.config["FLASKY_CREDENTIAL_CACHE_TTL"]
+    )
+    return snapshot
+
+
+def invalidate_user(target, value, oldvalue, initiator):
+    """drop cached credentials once role, confirmed flag or credentials change"""
+    if target.id is not None:
+        credential_cache.delete_where(lambda snapshot: snapshot.id == target.id)
+
+
+def invalidate_all(target, value, oldvalue, initiator):
+    credential_cache.clear()
+
+
+def on_user_written(mapper, connection, target):
+    """tokens revoked by this worker are rejected from the flush on"""
+    if db.inspect(target).attrs.token_generation.history.has_changes():
+        generation_cache().set(
+            target.id,
+            target.token_generation,
+            current_app.config["FLASKY_TOKEN_CACHE_TTL"],
+        )
+
+
+def on_user_deleted(mapper, connection, target):
+    generation_cache().delete(target.id)
+
+
+# a change of User.role sets role_id in the flush
+for attribute in (
+    User.confirmed,
+    User.role_id,
+    User.email,
+    User.password_hash,
+    User.token_generation,
+):
+    db.event.listen(attribute, "set", invalidate_user)
+db.event.listen(Role.permissions, "set", invalidate_all)
+db.event.listen(User, "after_update", on_user_written)
+db.event.listen(User, "after_delete", on_user_deleted)
+
 
 @auth.verify_password
 def verify_password(email_or_token, password):
@@ -18,17 +195,13 @@ def verify_password(email_or_token, password):
         g.current_user = AnonymousUser()  # app context during each request
         return True
     elif password == "":
-        g.current_user = User.verify_auth_token(email_or_token)
+        g.current_user = verify_token(email_or_token)
         g.token_used = True
         return g.current_user is not None
     else:
-        user = User.query.filter_by(email=email_or_token).first()
-        if not user:
-            return False
-        else:
-            g.current_user = user
-            g.token_used = False
-            return user.verify_password(password)
+        g.current_user = verify_credentials(email_or_token, password)
+        g.token_used = False
+        return g.current_user is not None
 
 
 @auth.error_handler
@@ -5,60 +5,99 @@ from .. import db
 from ..models import Permission, Post, Comment
 from . import api
 from .decorators import permission_required
+from .fields import Representation, author_keys
+from .pagination import cursor_validators, paginate_by_cursor
+from ..conditional import conditional
+
+
+def comments_validators():
+    return cursor_validators(
+        Comment.query,
+        Comment.timestamp,
+        Comment.id,
+        Comment.updated_at,
+        per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
+        representation=Representation(Comment),
+    )
+
+
+def comment_validators(id):
+    row = (
+        db.session.query(Comment.updated_at, Comment.author_id).filter_by(id=id).first()
+    )
+    if row is None:
+        return None
+    parts = [tuple(row)]
+    if Representation(Comment).embed:
+        # the author has no updated_at, leave it to the ETag
+        parts.append(author_keys({row.author_id}))
+        return parts, None
+    return parts, row.updated_at
+
+
+def post_comments_validators(id):
+    return cursor_validators(
+        Comment.query.filter_by(post_id=id),
+        Comment.timestamp,
+        Comment.id,
+        Comment.updated_at,
+        per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
+        descending=False,
+        representation=Representation(Comment),
+    )
 
 
 @api.route("/comments/")
+@conditional(comments_validators)
 def get_comments():
     """return all comments"""
-    page = request.args.get("page", 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"], error_out=False
+    representation = Representation(Comment)
+    pagination = paginate_by_cursor(
+        representation.query(Comment.query, "timestamp"),
+        Comment.timestamp,
+        Comment.id,
+        per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
     )
     comments = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for("api.get_comments", page=page - 1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for("api.get_comments", page=page + 1, _external=True)
-    return jsonify(
-        {
-            "comments": [comment.to_json() for comment in comments],
-            "prev": prev,
-            "next": next,
-            "count": pagination.total,
-        }
-    )
+    json_comments = {
+        "comments": representation.dump_all(comments),
+        "prev": pagination.prev_url("api.get_comments"),
+        "next": pagination.next_url("api.get_comments"),
+    }
+    if pagination.total is not None:
+        json_comments["count"] = pagination.total
+    return jsonify(json_comments)
 
 
 @api.route("/comments/<int:id>")
+@conditional(comment_validators)
 def get_comment(id):
-    comment = Comment.query.get_or_404(id)
-    return jsonify(comment.to_json())
+    representation = Representation(Comment)
+    comment = representation.query(Comment.query).get_or_404(id)
+    return jsonify(representation.dump(comment))
 
 
 @api.route("/posts/<int:id>/comments/")
+@conditional(post_comments_validators)
 def get_post_comments(id):
     post = Post.query.get_or_404(id)
-    page = request.args.get("page", 1, type=int)
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"], error_out=False
+    representation = Representation(Comment)
+    pagination = paginate_by_cursor(
+        representation.query(post.comments, "timestamp"),
+        Comment.timestamp,
+        Comment.id,
+        per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
+        descending=False,
     )
     comments = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for("api.get_post_comments", id=id, page=page - 1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for("api.get_post_comments", id=id, page=page + 1, _external=True)
-    return jsonify(
-        {
-            "comments": [comment.to_json() for comment in comments],
-            "prev": prev,
-            "next": next,
-            "count": pagination.total,
-        }
-    )
+    json_comments = {
+        "comments": representation.dump_all(comments),
+        "prev": pagination.prev_url("api.get_post_comments", id=id),
+        "next": pagination.next_url("api.get_post_comments", id=id),
+    }
+    if pagination.total is not None:
+        json_comments["count"] = pagination.total
+    return jsonify(json_comments)
 
 
 @api.route("/posts/<int:id>/comments/", methods=["POST"])
@@ -66,7 +105,7 @@ def get_post_comments(id):
 def new_post_comment(id):
     post = Post.query.get_or_404(id)
     comment = Comment.from_json(request.json)
-    comment.author = g.current_user
+    comment.author_id = g.current_user.id
     comment.post = post
     db.session.add(comment)
     db.session.commit()
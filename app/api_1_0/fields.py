@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+from flask import request
+from sqlalchemy.orm import load_only
+from .. import db
+from ..exceptions import ValidationError
+from ..models import User
+
+# ?embed= values, each a relationship to a User inlined in place of its URL
+embeddable = {"author": "author_id"}
+
+
+def _names(arg):
+    names = (name.strip() for name in request.args.get(arg, "").split(","))
+    return [name for name in names if name]
+
+
+def _columns(model, fields):
+    names = {"id"}
+    for name in model.json_fields if fields is None else fields:
+        names.update(model.json_fields[name][0])
+    return names
+
+
+def author_keys(author_ids):
+    """the columns of the embedded authors, for the ETag"""
+    if not author_ids:
+        return []
+    columns = Representation.columns_of(User, None)
+    return [
+        tuple(row)
+        for row in db.session.query(*columns)
+        .filter(User.id.in_(sorted(author_ids)))
+        .order_by(User.id)
+    ]
+
+
+class Representation:
+    """
+    The JSON of model instances as asked for by the request: ?fields=a,b
+    keeps only those fields of to_json(), ?embed=author inlines the authors
+    instead of their URL, loaded for the whole page with one query. Only the
+    columns the fields read are loaded, see options().
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.fields = _names("fields") or None
+        if self.fields is not None:
+            unknown = [name for name in self.fields if name not in model.json_fields]
+            if unknown:
+                raise ValidationError("unknown fields: %s" % ", ".join(unknown))
+        self.embed = _names("embed")
+        for name in self.embed:
+            if name not in embeddable or name not in model.json_fields:
+                raise ValidationError("cannot embed %s" % name)
+
+    @staticmethod
+    def columns_of(model, fields):
+        return [getattr(model, name) for name in sorted(_columns(model, fields))]
+
+    def columns(self):
+        """the columns the fields read, e.g. for the ETag"""
+        return self.columns_of(self.model, self.fields)
+
+    def options(self, *keys):
+        """load_only() the columns of the fields, and the keys given"""
+        names = _columns(self.model, self.fields) | set(keys)
+        names.update(embeddable[name] for name in self.embed)
+        return load_only(*sorted(names))
+
+    def query(self, query, *keys):
+        return query.options(self.options(*keys))
+
+    def dump_all(self, items):
+        json_items = [item.to_json(self.fields) for item in items]
+        for name in self.embed:
+            column = embeddable[name]
+            ids = {getattr(item, column) for item in items} - {None}
+            users = {}
+            if ids:
+                users = {
+                    user.id: user.to_json()
+                    for user in User.query.options(
+                        load_only(*sorted(_columns(User, None)))
+                    ).filter(User.id.in_(sorted(ids)))
+                }
+            for item, json_item in zip(items, json_items):
+                json_item[name] = users.get(getattr(item, column))
+        return json_items
+
+    def dump(self, item):
+        return self.dump_all([item])[0]
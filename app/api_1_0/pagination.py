@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import json
+from datetime import datetime
+from flask import request, url_for
+from .. import db
+from ..exceptions import ValidationError
+from .fields import author_keys, embeddable
+
+
+def encode_cursor(timestamp, id, direction):
+    """opaque cursor from the sort key of a row, (timestamp, id)"""
+    data = json.dumps([timestamp.isoformat(), id, direction])
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, id, direction = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8")
+        )
+        timestamp = datetime.fromisoformat(timestamp)
+        id = int(id)
+    except (ValueError, TypeError):
+        raise ValidationError("invalid cursor")
+    if direction not in ("next", "prev"):
+        raise ValidationError("invalid cursor")
+    return timestamp, id, direction
+
+
+def seek(query, timestamp, id, per_page, cursor=None, descending=True):
+    """
+    (query, direction): the rows of the page in query order and one more to
+    tell whether there is a further page
+    """
+    direction = "next"
+    if cursor:
+        cursor_timestamp, cursor_id, direction = decode_cursor(cursor)
+        # rows after the cursor in display order, or before it for "prev"
+        forward = descending != (direction == "prev")
+        if forward:
+            seek = db.or_(
+                timestamp < cursor_timestamp,
+                db.and_(timestamp == cursor_timestamp, id < cursor_id),
+            )
+        else:
+            seek = db.or_(
+                timestamp > cursor_timestamp,
+                db.and_(timestamp == cursor_timestamp, id > cursor_id),
+            )
+        query = query.filter(seek)
+    # walk backwards from the cursor for "prev", display order is restored later
+    reverse = (direction == "prev") == descending
+    if reverse:
+        query = query.order_by(timestamp.asc(), id.asc())
+    else:
+        query = query.order_by(timestamp.desc(), id.desc())
+    return query.limit(per_page + 1), direction
+
+
+class CursorPagination:
+    """
+    Keyset pagination on (timestamp, id). Seek past the row in the cursor
+    instead of OFFSET, so deep pages cost the same as the first one. The total
+    count is a separate COUNT(*) and only computed if asked for. item_keys
+    names the sort key on the items when the columns belong to another
+    table, e.g. the timeline.
+    """
+
+    def __init__(
+        self,
+        query,
+        timestamp,
+        id,
+        per_page,
+        cursor=None,
+        descending=True,
+        with_count=False,
+        item_keys=None,
+    ):
+        self.per_page = per_page
+        self.with_count = with_count
+        self.total = query.order_by(None).count() if with_count else None
+        query, direction = seek(query, timestamp, id, per_page, cursor, descending)
+        items = query.all()
+        has_more = len(items) > per_page
+        items = items[:per_page]
+        if direction == "prev":
+            items.reverse()
+            self.has_prev, self.has_next = has_more, True
+        else:
+            self.has_prev, self.has_next = cursor is not None, has_more
+        self.items = items
+        self._timestamp, self._id = item_keys or (timestamp.key, id.key)
+
+    def _cursor(self, item, direction):
+        return encode_cursor(
+            getattr(item, self._timestamp), getattr(item, self._id), direction
+        )
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or not self.items:
+            return None
+        return self._cursor(self.items[0], "prev")
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+        return self._cursor(self.items[-1], "next")
+
+    def prev_url(self, endpoint, **kw):
+        if self.prev_cursor is None:
+            return None
+        if self.with_count:
+            kw["count"] = 1
+        return url_for(endpoint, cursor=self.prev_cursor, _external=True, **kw)
+
+    def next_url(self, endpoint, **kw):
+        if self.next_cursor is None:
+            return None
+        if self.with_count:
+            kw["count"] = 1
+        return url_for(endpoint, cursor=self.next_cursor, _external=True, **kw)
+
+
+def paginate_by_cursor(query, timestamp, id, per_page, descending=True, item_keys=None):
+    """paginate query with the cursor and count flag from request arguments"""
+    return CursorPagination(
+        query,
+        timestamp,
+        id,
+        per_page,
+        cursor=request.args.get("cursor"),
+        descending=descending,
+        with_count=request.args.get("count", "").lower() in ["true", "on", "1"],
+        item_keys=item_keys,
+    )
+
+
+def cursor_validators(
+    query, timestamp, id, updated_at, per_page, descending=True, representation=None
+):
+    """
+    (ETag parts, None) of the page paginate_by_cursor would return for the
+    same query, from the keys of its rows rather than the rows. Embedded
+    authors of the representation are part of the page as well. There is no
+    Last-Modified: deleted rows and edited authors change the page without
+    making any updated_at newer, only the ETag sees them.
+    """
+    window, _ = seek(
+        query, timestamp, id, per_page, request.args.get("cursor"), descending
+    )
+    columns = [id, updated_at]
+    embeds_author = representation is not None and "author" in representation.embed
+    if embeds_author:
+        columns.append(getattr(representation.model, embeddable["author"]))
+    keys = [tuple(row) for row in window.with_entities(*columns)]
+    parts = [keys]
+    if embeds_author:
+        parts.append(author_keys({key[2] for key in keys}))
+    if request.args.get("count", "").lower() in ["true", "on", "1"]:
+        parts.append(query.order_by(None).count())
+    return parts, None
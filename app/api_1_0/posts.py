@@ -4,46 +4,74 @@ from flask import g, request, jsonify, url_for, current_app
 from . import api
 from .decorators import permission_required
 from .errors import forbidden
+from .fields import Representation, author_keys
+from .pagination import cursor_validators, paginate_by_cursor
+from ..conditional import conditional
 from ..models import Comment, Post, Permission
 from .. import db
 
+
+def posts_validators():
+    return cursor_validators(
+        Post.query,
+        Post.timestamp,
+        Post.id,
+        Post.updated_at,
+        per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
+        representation=Representation(Post),
+    )
+
+
+def post_validators(id):
+    row = db.session.query(Post.updated_at, Post.author_id).filter_by(id=id).first()
+    if row is None:
+        return None
+    parts = [tuple(row)]
+    if Representation(Post).embed:
+        # the author has no updated_at, leave it to the ETag
+        parts.append(author_keys({row.author_id}))
+        return parts, None
+    return parts, row.updated_at
+
+
 # TODO: add auth requirement, @auth.login_required
 @api.route("/posts/")
+@conditional(posts_validators)
 def get_posts():
-    page = request.args.get("page", 1, type=int)
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config["FLASKY_POSTS_PER_PAGE"], error_out=False
+    representation = Representation(Post)
+    pagination = paginate_by_cursor(
+        representation.query(Post.query, "timestamp"),
+        Post.timestamp,
+        Post.id,
+        per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
     )
     posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for("api.get_posts", page=page - 1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for("api.get_posts", page=page + 1, _external=True)
-    return jsonify(
-        {
-            "posts": [post.to_json() for post in posts],
-            "prev": prev,
-            "next": next,
-            "count": pagination.total,
-        }
-    )
+    json_posts = {
+        "posts": representation.dump_all(posts),
+        "prev": pagination.prev_url("api.get_posts"),
+        "next": pagination.next_url("api.get_posts"),
+    }
+    if pagination.total is not None:
+        json_posts["count"] = pagination.total
+    return jsonify(json_posts)
 
 
 @api.route("/posts/<int:id>")
+@conditional(post_validators)
 def get_post(id):
     # 404 error handler should be compatible with json format
-    post = Post.query.get_or_404(id)
-    return jsonify(post.to_json())
+    representation = Representation(Post)
+    post = representation.query(Post.query).get_or_404(id)
+    return jsonify(representation.dump(post))
 
 
 @api.route("/posts/", methods=["POST"])
 @permission_required(Permission.WRITE)
 def new_post():
     post = Post.from_json(request.json)
-    # Note: g.current_user is not an agent like current_user
-    post.author = g.current_user
+    # Note: g.current_user is not an agent like current_user, and may be a
+    # cached UserSnapshot rather than a User
+    post.author_id = g.current_user.id
     db.session.add(post)
     # commit at once manually, to generate fields for .to_json
     db.session.commit()
@@ -60,7 +88,7 @@ def new_post():
 @permission_required(Permission.WRITE)
 def edit_post(id):
     post = Post.query.get_or_404(id)
-    if g.current_user != post.author and not g.current_user.can(Permission.ADMIN):
+    if g.current_user.id != post.author_id and not g.current_user.can(Permission.ADMIN):
         return forbidden("Insufficient permissions")
     else:
         post.body = request.json.get("body", post.body)
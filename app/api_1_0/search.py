@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+from flask import abort, current_app, jsonify, url_for
+from . import api
+from .. import db
+from ..search import fts_enabled, paginate_search
+
+
+@api.route("/search/")
+def search():
+    """ranked matches of ?q= in posts and comments"""
+    if not fts_enabled(db.engine):
+        abort(501)
+    results = paginate_search(
+        db.session, current_app.config["FLASKY_SEARCH_RESULTS_PER_PAGE"]
+    )
+    json_results = {
+        "results": [
+            {
+                "type": hit.kind,
+                "url": url_for("api.get_%s" % hit.kind, id=hit.id, _external=True),
+                "post": url_for("api.get_post", id=hit.post_id, _external=True),
+                "rank": hit.rank,
+                "snippet": hit.snippet,
+            }
+            for hit in results.items
+        ],
+        "next": results.next_url("api.search", _external=True),
+    }
+    return jsonify(json_results)
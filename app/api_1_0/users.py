@@ -1,63 +1,105 @@
 # -*- coding: utf-8 -*-
 
-from flask import jsonify, request, current_app, url_for
+from flask import jsonify, current_app
 from . import api
+from .fields import Representation
+from .pagination import cursor_validators, paginate_by_cursor
+from .. import db
+from ..conditional import conditional
 from ..models import User, Post
 
 
+def user_validators(id):
+    """the columns of User.to_json()"""
+    columns = Representation(User).columns()
+    row = db.session.query(*columns).filter_by(id=id).first()
+    if row is None:
+        return None
+    return [tuple(row)], None
+
+
+def user_posts_validators(id):
+    return cursor_validators(
+        Post.query.filter_by(author_id=id),
+        Post.timestamp,
+        Post.id,
+        Post.updated_at,
+        per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
+        representation=Representation(Post),
+    )
+
+
+def user_followed_posts_validators(id):
+    if db.session.query(User.id).filter_by(id=id).first() is None:
+        return None
+    query, timestamp, post_id = User.timeline_of(id)
+    return cursor_validators(
+        query,
+        timestamp,
+        post_id,
+        Post.updated_at,
+        per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
+        representation=Representation(Post),
+    )
+
+
 @api.route("/users/<int:id>")
+@conditional(user_validators)
 def get_user(id):
-    user = User.query.get_or_404(id)
-    return jsonify(user.to_json())
+    representation = Representation(User)
+    user = representation.query(User.query).get_or_404(id)
+    return jsonify(representation.dump(user))
 
 
 @api.route("/users/<int:id>/posts/")
+@conditional(user_posts_validators)
 def get_user_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get("page", 1, type=int)
-    pagination = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config["FLASKY_POSTS_PER_PAGE"], error_out=False
+    representation = Representation(Post)
+    pagination = paginate_by_cursor(
+        representation.query(user.posts, "timestamp"),
+        Post.timestamp,
+        Post.id,
+        per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
     )
     posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for("api.get_user_posts", id=id, page=page - 1, _external=True)
-    next = None
-    if pagination.has_next:
-        next = url_for("api.get_user_posts", id=id, page=page + 1, _external=True)
-    return jsonify(
-        {
-            "posts": [post.to_json() for post in posts],
-            "prev": prev,
-            "next": next,
-            "count": pagination.total,
-        }
-    )
+    json_posts = {
+        "posts": representation.dump_all(posts),
+        "prev": pagination.prev_url("api.get_user_posts", id=id),
+        "next": pagination.next_url("api.get_user_posts", id=id),
+    }
+    if pagination.total is not None:
+        json_posts["count"] = pagination.total
+    return jsonify(json_posts)
 
 
 @api.route("/users/<int:id>/timeline/")
+@conditional(user_followed_posts_validators)
 def get_user_followed_posts(id):
     user = User.query.get_or_404(id)
-    page = request.args.get("page", 1, type=int)
-    pagination = user.followed_posts.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config["FLASKY_POSTS_PER_PAGE"], error_out=False
+    representation = Representation(Post)
+    query, timestamp, post_id = user.timeline()
+    pagination = paginate_by_cursor(
+        representation.query(query, "timestamp"),
+        timestamp,
+        post_id,
+        per_page=current_app.config["FLASKY_POSTS_PER_PAGE"],
+        item_keys=("timestamp", "id"),
     )
     posts = pagination.items
-    prev = None
-    if pagination.has_prev:
-        prev = url_for(
-            "api.get_user_followed_posts", id=id, page=page - 1, _external=True
-        )
-    next = None
-    if pagination.has_next:
-        next = url_for(
-            "api.get_user_followed_posts", id=id, page=page + 1, _external=True
-        )
-    return jsonify(
-        {
-            "posts": [post.to_json() for post in posts],
-            "prev": prev,
-            "next": next,
-            "count": pagination.total,
-        }
-    )
+    json_posts = {
+        "posts": representation.dump_all(posts),
+        "prev": pagination.prev_url("api.get_user_followed_posts", id=id),
+        "next": pagination.next_url("api.get_user_followed_posts", id=id),
+    }
+    if pagination.total is not None:
+        json_posts["count"] = pagination.total
+    return jsonify(json_posts)
+
+
+@api.route("/users/<int:id>/suggestions/")
+def get_user_suggestions(id):
+    """users to follow, precomputed by 'flask recommend'"""
+    user = User.query.get_or_404(id)
+    representation = Representation(User)
+    return jsonify({"suggestions": representation.dump_all(user.follow_suggestions())})
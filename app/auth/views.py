@@ -47,6 +47,8 @@ def login():
         user = User.query.filter_by(email=form.email.data.lower()).first()
         if user is not None and user.verify_password(form.password.data):
             login_user(user, form.remember_me.data)
+            # the password hash may have been upgraded
+            db.session.commit()
             next = request.args.get("next")
             if next is None or not next.startswith("/"):
                 next = url_for("main.index")
@@ -82,6 +84,7 @@ def register():
             user=user,
             token=token,
         )
+        db.session.commit()
         flash("A confirmation email has been sent to you.")
         return redirect(url_for("main.index"))
     return render_template("auth/register.html", form=form)
@@ -111,6 +114,7 @@ def resend_confirmation():
         user=current_user,
         token=token,
     )
+    db.session.commit()
     flash("A new confirmation email has been sent to you.")
     return redirect(url_for("main.index"))
 
@@ -150,6 +154,7 @@ def password_reset_request():
                 user=user,
                 token=token,
             )
+            db.session.commit()
             flash(
                 "An email with instructions to reset your password has been sent to you."
             )
@@ -203,6 +208,7 @@ def change_email_request():
                 user=current_user,
                 token=token,
             )
+            db.session.commit()
             flash(
                 "An email with instructions to confirm your new email address "
                 "has been sent to you."
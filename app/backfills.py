@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+from datetime import datetime
+from . import db
+from .models import Backfill, User
+
+# (name, model whose ids are walked, fn(first_id, last_id) -> rows changed)
+backfills = []
+
+
+def backfill(name, model):
+    """register fn(first_id, last_id) as a backfill over the ids of model"""
+
+    def decorator(fn):
+        backfills.append((name, model, fn))
+        return fn
+
+    return decorator
+
+
+backfill("self-follows", User)(User.add_self_follows)
+
+
+def pending():
+    """the registered backfills not completed yet, with a single query"""
+    completed = {
+        name
+        for (name,) in db.session.query(Backfill.name).filter(
+            Backfill.completed_at != None
+        )
+    }
+    return [entry for entry in backfills if entry[0] not in completed]
+
+
+def run(name, model, fn, chunk_size=1000):
+    """
+    Run a backfill over the ids of model in chunks, one transaction each.
+    The last id done is saved with every chunk, so an interrupted deploy
+    resumes there, and fn must be safe to repeat on a chunk. Rows created
+    while it runs are the application's job. Yield (last id done, last id,
+    rows changed) after every chunk.
+    """
+    state = Backfill.query.get(name) or Backfill(name=name, last_id=0)
+    last_id = db.session.query(db.func.max(model.id)).scalar() or 0
+    changed = 0
+    for first_id in range(state.last_id + 1, last_id + 1, chunk_size):
+        end_id = min(first_id + chunk_size - 1, last_id)
+        changed += fn(first_id, end_id)
+        state.last_id = end_id
+        db.session.add(state)
+        db.session.commit()
+        yield end_id, last_id, changed
+    state.completed_at = datetime.utcnow()
+    db.session.add(state)
+    db.session.commit()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+from functools import wraps
+from flask import current_app, request
+from werkzeug.http import is_resource_modified
+
+
+def make_etag(parts):
+    """
+    Strong ETag of a representation built from parts, which also covers the
+    URL, the host of the external links and FLASKY_ETAG_SALT: set it to the
+    release on deploy, so that changed templates don't validate old copies
+    """
+    key = repr(
+        (
+            current_app.config["FLASKY_ETAG_SALT"],
+            request.host,
+            request.endpoint,
+            sorted(request.view_args.items()),
+            sorted(request.args.items(multi=True)),
+            parts,
+        )
+    )
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def conditional(validators, when=None):
+    """
+    Answer conditional GET requests without running the view.
+
+    validators(**view_args) returns (ETag parts, Last-Modified or None),
+    read with column queries before the view loads any object, or None to
+    leave the request to the view, e.g. for a 404. A request whose
+    If-None-Match or If-Modified-Since still matches gets an empty 304,
+    the 200 responses of the view get the validators. when() may turn the
+    whole thing off for a request, e.g. for pages that differ per user.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kw):
+            if request.method != "GET" or (when is not None and not when()):
+                return f(*args, **kw)
+            found = validators(**kw)
+            if found is None:
+                return f(*args, **kw)
+            parts, last_modified = found
+            etag = make_etag(parts)
+            if not is_resource_modified(
+                request.environ, etag=etag, last_modified=last_modified
+            ):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(f(*args, **kw))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+
+        return decorated_function
+
+    return decorator
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class BoundedDrain:
+    """
+    Background work on a bounded in-process thread pool: work() is called in
+    the app context until it returns a falsy value. A drain runs after the
+    commit of every session that flushed an instance wanted() by the drain,
+    and every poll interval seconds, which picks up retries and rows left by
+    a stopped process. The pool size and poll interval are read from the
+    config keys given; a pool size of 0 disables the drain.
+    """
+
+    def __init__(self, name, pool_size, poll_interval):
+        self.name = name
+        self.pool_size = pool_size
+        self.poll_interval = poll_interval
+        self._executor = None
+        self._scheduled = 0
+        # apps dispatched while the pool was busy, a drain takes them over
+        # before it stops
+        self._waiting = []
+        self._polling = weakref.WeakSet()
+        self._lock = threading.Lock()
+        event.listen(Session, "after_flush", self.on_after_flush)
+        event.listen(Session, "after_commit", self.on_after_commit)
+        event.listen(Session, "after_rollback", self.on_after_rollback)
+
+    def init_app(self, app):
+        # only processes that serve requests poll, not CLI commands
+        app.before_request(self._start_polling)
+
+    def work(self):
+        """handle one batch, return whether there was anything to handle"""
+        raise NotImplementedError
+
+    def wanted(self, instance):
+        """whether a flushed instance calls for a drain"""
+        return False
+
+    def dispatch(self, app):
+        size = app.config[self.pool_size]
+        if not size:
+            return
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=size, thread_name_prefix=self.name
+                )
+            if self._scheduled >= size:
+                if app not in self._waiting:
+                    self._waiting.append(app)
+                return
+            self._scheduled += 1
+        self._executor.submit(self._drain, app)
+
+    def _drain(self, app):
+        while app is not None:
+            try:
+                with app.app_context():
+                    while self.work():
+                        pass
+            except Exception:
+                app.logger.exception("Background %s failed" % self.name)
+            # checked under the lock that dispatch() holds to append, so a
+            # dispatch seeing a full pool is never left behind
+            with self._lock:
+                if self._waiting:
+                    app = self._waiting.pop(0)
+                else:
+                    app = None
+                    self._scheduled -= 1
+
+    def _start_polling(self):
+        app = current_app._get_current_object()
+        if app in self._polling:
+            return
+        with self._lock:
+            if app in self._polling:
+                return
+            self._polling.add(app)
+        interval = app.config[self.poll_interval]
+        if interval and app.config[self.pool_size]:
+            threading.Thread(
+                target=self._poll,
+                args=(app, interval),
+                name="%s-poll" % self.name,
+                daemon=True,
+            ).start()
+
+    def _poll(self, app, interval):
+        while True:
+            self.dispatch(app)
+            time.sleep(interval)
+
+    def on_after_flush(self, session, flush_context):
+        key = "drain:" + self.name
+        if session.info.get(key):
+            return
+        for instance in list(session.new) + list(session.dirty):
+            if self.wanted(instance):
+                session.info[key] = True
+                return
+
+    def on_after_commit(self, session):
+        if not session.info.pop("drain:" + self.name, False):
+            return
+        if has_app_context():
+            self.dispatch(current_app._get_current_object())
+
+    def on_after_rollback(self, session):
+        session.info.pop("drain:" + self.name, None)
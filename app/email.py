@@ -1,27 +1,123 @@
 # -*- coding: utf-8 -*-
 
-from threading import Thread
+from datetime import datetime, timedelta
 from flask import render_template, current_app
 from flask_mail import Message
 
-from . import mail
-
-
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+from . import db, mail
+from .drain import BoundedDrain
+from .models import OutboxMessage
 
 
 def send_email(to, subject, template, **kw):
-    # get the current app object, use current_app as app variable is OK as well.
+    """
+    queue a message in the outbox of the current session, it is delivered
+    by deliver_outbox() once the caller commits
+    """
     app = current_app._get_current_object()
-    msg = Message(
-        app.config["FLASKY_MAIL_SUBJECT_PREFIX"] + " " + subject,
+    message = OutboxMessage(
+        subject=app.config["FLASKY_MAIL_SUBJECT_PREFIX"] + " " + subject,
         sender=app.config["FLASKY_MAIL_SENDER"],
-        recipients=[to],
+        recipients=to,
+        body=render_template(template + ".txt", **kw),
+        html=render_template(template + ".html", **kw),
+    )
+    db.session.add(message)
+    return message
+
+
+def claim_messages(limit):
+    """lease due messages so concurrent workers don't send them twice"""
+    config = current_app.config
+    now = datetime.utcnow()
+    lease = now + timedelta(seconds=config["FLASKY_MAIL_LEASE_TIME"])
+    due = (
+        db.session.query(OutboxMessage.id)
+        .filter(
+            OutboxMessage.sent_at == None,
+            OutboxMessage.attempts < config["FLASKY_MAIL_MAX_ATTEMPTS"],
+            OutboxMessage.next_attempt_at <= now,
+        )
+        .order_by(OutboxMessage.next_attempt_at)
+        .limit(limit)
+        .all()
+    )
+    claimed = []
+    for (id,) in due:
+        updated = OutboxMessage.query.filter(
+            OutboxMessage.id == id, OutboxMessage.next_attempt_at <= now
+        ).update({"next_attempt_at": lease}, synchronize_session=False)
+        if updated:
+            claimed.append(id)
+    db.session.commit()
+    return OutboxMessage.query.filter(OutboxMessage.id.in_(claimed)).all()
+
+
+def deliver_outbox(batch_size=None):
+    """
+    Send one batch of due messages over a single SMTP connection. Failed
+    messages are retried with exponential backoff up to
+    FLASKY_MAIL_MAX_ATTEMPTS. Return the number of messages handled.
+    """
+    config = current_app.config
+    messages = claim_messages(batch_size or config["FLASKY_MAIL_BATCH_SIZE"])
+    if not messages:
+        return 0
+    try:
+        with mail.connect() as connection:
+            for message in messages:
+                try:
+                    connection.send(
+                        Message(
+                            message.subject,
+                            sender=message.sender,
+                            recipients=message.recipients.split(","),
+                            body=message.body,
+                            html=message.html,
+                        )
+                    )
+                except Exception as e:
+                    _failed(message, e)
+                else:
+                    message.sent_at = datetime.utcnow()
+                    message.last_error = None
+    except Exception as e:
+        # connecting failed, none of the unsent messages went out
+        for message in messages:
+            if message.sent_at is None:
+                _failed(message, e)
+    db.session.commit()
+    return len(messages)
+
+
+def _failed(message, error):
+    message.attempts = (message.attempts or 0) + 1
+    message.last_error = repr(error)
+    backoff = current_app.config["FLASKY_MAIL_RETRY_BACKOFF"] * 2 ** (
+        message.attempts - 1
+    )
+    message.next_attempt_at = datetime.utcnow() + timedelta(seconds=backoff)
+    current_app.logger.warning(
+        "Sending %r failed (attempt %d): %r" % (message, message.attempts, error)
     )
-    msg.body = render_template(template + ".txt", **kw)
-    msg.html = render_template(template + ".html", **kw)
-    thr = Thread(target=send_async_email, args=[app, msg])
-    thr.start()
-    return thr
+
+
+class Outbox(BoundedDrain):
+    """
+    Deliver the outbox on FLASKY_MAIL_POOL_SIZE threads of the web process,
+    after every commit that queued a message and every
+    FLASKY_MAIL_POLL_INTERVAL seconds for retries and messages left by a
+    restart. With a pool size of 0, run 'flask mail-worker' instead.
+    """
+
+    def __init__(self):
+        super().__init__("mail", "FLASKY_MAIL_POOL_SIZE", "FLASKY_MAIL_POLL_INTERVAL")
+
+    def work(self):
+        return deliver_outbox()
+
+    def wanted(self, instance):
+        return isinstance(instance, OutboxMessage)
+
+
+outbox = Outbox()
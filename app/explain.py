@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+import re
+from . import db
+from .models import User, Post, Comment, Timeline
+
+# plan lines that read a whole table or index: SQLite, then PostgreSQL
+_full_scan = re.compile(r"^SCAN |Seq Scan on ")
+_table_scan = re.compile(r"^SCAN (TABLE )?\w+( AS \w+)?$|Seq Scan on ")
+
+_sort = re.compile(r"USE TEMP B-TREE FOR (RIGHT PART OF |LAST TERM OF )?ORDER BY|Sort ")
+
+# newest rows of a whole table: walking the timestamp index is the plan,
+# it stops after a page
+ordered_walks = {"main.index", "main.moderate", "api.get_posts"}
+
+# read in index order, a sort means every row of the reader is read
+index_ordered = {"main.index followed", "api.get_user_followed_posts"}
+
+
+def hot_queries(user, post, per_page=20):
+    """
+    (name, query) of the queries behind the hot endpoints, built the way the
+    views build them, for a sample user and post.
+    """
+    # the seek condition of CursorPagination, past the sample post
+    posts_after = db.or_(
+        Post.timestamp < post.timestamp,
+        db.and_(Post.timestamp == post.timestamp, Post.id < post.id),
+    )
+    timeline, timestamp, post_id = user.timeline()
+    timeline_after = db.or_(
+        timestamp < post.timestamp,
+        db.and_(timestamp == post.timestamp, post_id < post.id),
+    )
+    comments_after = db.or_(
+        Comment.timestamp > post.timestamp,
+        db.and_(Comment.timestamp == post.timestamp, Comment.id > 0),
+    )
+    return [
+        (
+            "main.index",
+            Post.query.order_by(Post.timestamp.desc()).limit(per_page).offset(per_page),
+        ),
+        (
+            "main.index followed",
+            timeline.order_by(timestamp.desc(), post_id.desc()).limit(per_page),
+        ),
+        ("main.user", User.query.filter_by(username=user.username).limit(1)),
+        (
+            "main.user posts",
+            user.posts.order_by(Post.timestamp.desc()).limit(per_page),
+        ),
+        (
+            "main.user posts count",
+            user.posts.order_by(None).with_entities(db.func.count()),
+        ),
+        (
+            "main.post comments",
+            post.comments.order_by(Comment.timestamp.asc()).limit(per_page),
+        ),
+        ("main.followers", user.followers.limit(per_page)),
+        (
+            "main.followers count",
+            user.followers.order_by(None).with_entities(db.func.count()),
+        ),
+        ("main.followed_by", user.followed.limit(per_page)),
+        (
+            "main.moderate",
+            Comment.query.order_by(Comment.timestamp.desc()).limit(per_page),
+        ),
+        (
+            "api.get_posts",
+            Post.query.filter(posts_after)
+            .order_by(Post.timestamp.desc(), Post.id.desc())
+            .limit(per_page + 1),
+        ),
+        (
+            "api.get_user_posts",
+            user.posts.filter(posts_after)
+            .order_by(Post.timestamp.desc(), Post.id.desc())
+            .limit(per_page + 1),
+        ),
+        (
+            "api.get_user_followed_posts",
+            timeline.filter(timeline_after)
+            .order_by(timestamp.desc(), post_id.desc())
+            .limit(per_page + 1),
+        ),
+        (
+            "api.get_post_comments",
+            post.comments.filter(comments_after)
+            .order_by(Comment.timestamp.asc(), Comment.id.asc())
+            .limit(per_page + 1),
+        ),
+        (
+            "user.is_followed_by",
+            user.followers.filter_by(follower_id=user.id).limit(1),
+        ),
+        (
+            "follow backfill",
+            db.select([Post.id, Post.timestamp]).where(Post.author_id == user.id),
+        ),
+        (
+            "unfollow prune",
+            db.select([Timeline.post_id]).where(
+                db.and_(
+                    Timeline.user_id == user.id,
+                    Timeline.post_id.in_(
+                        db.select([Post.id]).where(Post.author_id == post.author_id)
+                    ),
+                )
+            ),
+        ),
+    ]
+
+
+def explain(connection, query):
+    """the plan of a Query or select, one line per step"""
+    statement = getattr(query, "statement", query)
+    compiled = statement.compile(dialect=connection.dialect)
+    params = compiled.params
+    if compiled.positional:
+        params = tuple(params[name] for name in compiled.positiontup)
+    if connection.dialect.name == "sqlite":
+        rows = connection.execute("EXPLAIN QUERY PLAN " + str(compiled), params)
+        return [row[-1] for row in rows]
+    return [row[0] for row in connection.execute("EXPLAIN " + str(compiled), params)]
+
+
+def full_scans(plan, ordered_walk=False):
+    """the lines of plan that read a whole table, or index unless ordered_walk"""
+    pattern = _table_scan if ordered_walk else _full_scan
+    return [line for line in plan if pattern.search(line.strip())]
+
+
+def sorts(plan):
+    """the lines of plan that sort rows instead of reading them in order"""
+    return [line for line in plan if _sort.search(line.strip())]
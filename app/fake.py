@@ -1,87 +1,441 @@
 #!/usr/bin/env python3
 # vim: fileencoding=utf-8 fdm=indent sw=4 ts=4 sts=4
-from random import randint
-from sqlalchemy.exc import IntegrityError
+import hashlib
+import os
+import random
+import re
+import time
+from array import array
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
 from faker import Faker
-from . import db
-from .models import User, Post, Comment
+from flask import current_app
+from werkzeug.security import generate_password_hash
+from . import db, page_cache, role_table
+from .models import User, Follow, Post, Comment, Timeline, not_celebrity
+from .rendering import render
+from . import search
 
+PASSWORD = "password"
 
-def user(count=100):
+
+def _people(seed, count):
+    """fake (username base, name, location, about_me, email domain) tuples"""
     fake = Faker()
-    i = 0
-    while i < count:
-        u = User(
-            email=fake.email(),
-            username=fake.user_name(),
-            password="password",
-            confirm=True,
-            name=fake.name(),
-            location=fake.city(),
-            about_me=fake.text(),
-            member_since=fake.past_date(),
+    fake.seed_instance(seed)
+    return [
+        (
+            # usable as the base of a username accepted by the forms
+            re.sub(r"[^A-Za-z0-9_.]", "", fake.user_name()) or "user",
+            fake.name(),
+            fake.city(),
+            fake.text(),
+            fake.free_email_domain(),
         )
-        db.session.add(u)
-        # use try...except cause user must be unique
-        try:
+        for _ in range(count)
+    ]
+
+
+def _bodies(seed, count, profile):
+    """fake (body, body_html) pairs, rendered with the profile"""
+    fake = Faker()
+    fake.seed_instance(seed)
+    max_chars = 400 if profile == "post" else 120
+    bodies = []
+    for _ in range(count):
+        body = fake.text(max_nb_chars=max_chars)
+        bodies.append((body, render(body, profile)))
+    return bodies
+
+
+def _pool(task):
+    """one slice of a pool of values, run in the worker processes"""
+    kind, seed, count = task
+    if kind == "people":
+        return _people(seed, count)
+    return _bodies(seed, count, kind)
+
+
+class BulkFaker:
+    """
+    Fake users, follows, posts and comments in bulk. Faker and markdown take
+    milliseconds per value, so `distinct` values of each kind are made once
+    on a process pool and rows draw from them. Rows get their ids up front
+    and are written with executemany, `batch_size` rows per transaction,
+    together with what the model events would maintain for them: counters,
+    timeline and search index.
+
+    Every method is a generator of (rows added, rows written, rows written
+    per second) per batch, rows written include the follows and timeline
+    rows implied by the added ones.
+    """
+
+    def __init__(self, distinct=1000, batch_size=50000, workers=None, seed=None):
+        self.distinct = distinct
+        self.batch_size = batch_size
+        self.workers = workers
+        self.rng = random.Random(seed)
+        self._pools = None
+
+    @property
+    def pools(self):
+        if self._pools is None:
+            self._pools = self._make_pools()
+        return self._pools
+
+    def _make_pools(self):
+        workers = self.workers or os.cpu_count() or 1
+        size = -(-self.distinct // workers)  # per task, rounded up
+        tasks = [
+            (kind, self.rng.randrange(2**31), size)
+            for kind in ("people", "post", "comment")
+            for _ in range(workers)
+        ]
+        if workers == 1:
+            results = [_pool(task) for task in tasks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(_pool, tasks))
+        pools = {"people": [], "post": [], "comment": []}
+        for (kind, _, _), values in zip(tasks, results):
+            pools[kind].extend(values)
+        return pools
+
+    @staticmethod
+    def _ids(model):
+        table = model.__table__
+        result = db.session.execute(db.select([table.c.id]).order_by(table.c.id))
+        return array("i", (row[0] for row in result))
+
+    @staticmethod
+    def _next_id(model):
+        return (db.session.query(db.func.max(model.id)).scalar() or 0) + 1
+
+    @staticmethod
+    def _bump(column, counts):
+        """add counts {id: n} to a counter column with one executemany"""
+        if counts:
+            table = column.table
+            db.session.execute(
+                table.update()
+                .where(table.c.id == db.bindparam("_id"))
+                .values({column: column + db.bindparam("_n")}),
+                [{"_id": id, "_n": n} for id, n in sorted(counts.items())],
+            )
+
+    @staticmethod
+    def _sync_sequence(table):
+        # explicit ids don't advance the serial sequence on PostgreSQL
+        if db.engine.dialect.name == "postgresql":
+            db.session.execute(
+                "SELECT setval(pg_get_serial_sequence('%s', 'id'), "
+                "(SELECT max(id) FROM %s))" % (table.name, table.name)
+            )
+
+    def _timestamps(self, days=365):
+        now = datetime.utcnow()
+        span = days * 86400
+        return lambda: now - timedelta(seconds=self.rng.random() * span)
+
+    def _batches(self, first_id, count, write):
+        """
+        call write(start, end) per batch of ids, which returns the number of
+        rows it wrote, commit and report progress
+        """
+        done = written = 0
+        started = time.perf_counter()
+        for start in range(first_id, first_id + count, self.batch_size):
+            end = min(start + self.batch_size, first_id + count)
+            written += write(start, end)
             db.session.commit()
-            # increase count number only if commit succeeds
-            i += 1
-        except IntegrityError:
-            db.session.rollback()
-    follow_user()
+            done += end - start
+            yield done, written, written / (time.perf_counter() - started)
+        page_cache.invalidate()
+
+    def users(self, count=100, follows=10):
+        """`count` users, each following itself and `follows` random users"""
+        users = User.__table__
+        people = self.pools["people"]
+        taken = set()
+        for username, email in db.session.query(User.username, User.email):
+            taken.update((username, email))
+        ids = self._ids(User)
+        first_id = self._next_id(User)
+        ids.extend(range(first_id, first_id + count))
+        password_hash = generate_password_hash(
+            PASSWORD, method=current_app.config["FLASKY_PASSWORD_HASH_METHOD"]
+        )
+        default = role_table.get().default
+        if default is None:
+            raise RuntimeError(
+                "no default role, run 'flask deploy' or Role.insert_roles() first"
+            )
+        role_id = default.id
+        existing = len(ids) - count
+        timestamp = self._timestamps()
+        now = datetime.utcnow()
+        rng = self.rng
+
+        def write(start, end):
+            rows, edges, follower_counts = [], [], Counter()
+            # follow users that exist by the end of this batch
+            known = existing + end - first_id
+            k = min(follows, known - 1)
+            for id in range(start, end):
+                while True:
+                    # the id suffix makes new names unique among themselves
+                    base, name, location, about_me, domain = rng.choice(people)
+                    username = "%s_%d" % (base, id)
+                    email = "%s@%s" % (username, domain)
+                    if username not in taken and email not in taken:
+                        break
+                followed = {id}
+                while len(followed) <= k:
+                    followed.add(ids[rng.randrange(known)])
+                follower_counts.update(followed)
+                edges.extend(
+                    {"follower_id": id, "followed_id": followed_id, "timestamp": now}
+                    for followed_id in followed
+                )
+                member_since = timestamp()
+                rows.append(
+                    {
+                        "id": id,
+                        "email": email,
+                        "username": username,
+                        "password_hash": password_hash,
+                        "confirmed": True,
+                        "role_id": role_id,
+                        "name": name,
+                        "location": location,
+                        "about_me": about_me,
+                        "member_since": member_since,
+                        "last_seen": member_since,
+                        "avatar_hash": hashlib.md5(email.encode("utf-8")).hexdigest(),
+                        "celebrity": False,
+                        "post_count": 0,
+                        "comment_count": 0,
+                        "follower_count": 0,
+                        "followed_count": len(followed),
+                        "follows_version": len(followed),
+                    }
+                )
+            db.session.execute(users.insert(), rows)
+            db.session.execute(Follow.__table__.insert(), edges)
+            self._bump(users.c.follower_count, follower_counts)
+            self._bump(users.c.follows_version, follower_counts)
+            return len(rows) + len(edges) + self._backfill_timelines(start, end - 1)
+
+        yield from self._batches(first_id, count, write)
+        self._sync_sequence(users)
+        db.session.commit()
+
+    @staticmethod
+    def _backfill_timelines(first_id, last_id):
+        """timelines of new users from the posts of the users they follow"""
+        follows, posts, users = Follow.__table__, Post.__table__, User.__table__
+        return db.session.execute(
+            Timeline.__table__.insert().from_select(
+                ["user_id", "post_id", "timestamp"],
+                db.select([follows.c.follower_id, posts.c.id, posts.c.timestamp])
+                .select_from(
+                    follows.join(
+                        posts, posts.c.author_id == follows.c.followed_id
+                    ).join(users, users.c.id == posts.c.author_id)
+                )
+                .where(follows.c.follower_id.between(first_id, last_id))
+                .where(not_celebrity(users))
+                .order_by(follows.c.follower_id, posts.c.id),
+            )
+        ).rowcount
+
+    def follows(self, count=10):
+        """
+        up to `count` more random follows for every existing user, reported
+        per batch of followers
+        """
+        follows, posts, users = Follow.__table__, Post.__table__, User.__table__
+        ids = self._ids(User)
+        k = min(count, len(ids) - 1)
+        if k <= 0:
+            return
+        existing = set(db.session.query(Follow.follower_id, Follow.followed_id))
+        now = datetime.utcnow()
+        rng = self.rng
+        # same as Follow.on_inserted: the posts of the followed user
+        backfill = Timeline.__table__.insert().from_select(
+            ["user_id", "post_id", "timestamp"],
+            db.select(
+                [
+                    db.bindparam("_follower_id", type_=db.Integer),
+                    posts.c.id,
+                    posts.c.timestamp,
+                ]
+            )
+            .select_from(posts.join(users, users.c.id == posts.c.author_id))
+            .where(posts.c.author_id == db.bindparam("_followed_id"))
+            .where(not_celebrity(users)),
+        )
+
+        def write(start, end):
+            edges, follower_counts, followed_counts = [], Counter(), Counter()
+            for follower_id in ids[start:end]:
+                for _ in range(k):
+                    followed_id = ids[rng.randrange(len(ids))]
+                    if (
+                        followed_id == follower_id
+                        or (follower_id, followed_id) in existing
+                    ):
+                        continue
+                    existing.add((follower_id, followed_id))
+                    follower_counts[followed_id] += 1
+                    followed_counts[follower_id] += 1
+                    edges.append((follower_id, followed_id))
+            if not edges:
+                return 0
+            db.session.execute(
+                follows.insert(),
+                [
+                    {"follower_id": a, "followed_id": b, "timestamp": now}
+                    for a, b in edges
+                ],
+            )
+            self._bump(users.c.follower_count, follower_counts)
+            self._bump(users.c.followed_count, followed_counts)
+            self._bump(users.c.follows_version, follower_counts + followed_counts)
+            fanned_out = db.session.execute(
+                backfill,
+                [{"_follower_id": a, "_followed_id": b} for a, b in edges],
+            ).rowcount
+            # executemany may not report a row count
+            return len(edges) + max(fanned_out, 0)
+
+        yield from self._batches(0, len(ids), write)
+        db.session.commit()
+
+    def posts(self, count=100):
+        """`count` posts by random authors"""
+        posts, users = Post.__table__, User.__table__
+        authors = self._ids(User)
+        if not authors:
+            return
+        bodies = self.pools["post"]
+        first_id = self._next_id(Post)
+        timestamp = self._timestamps()
+        rng = self.rng
+        limit = current_app.config["FLASKY_TIMELINE_FANOUT_LIMIT"]
+
+        def write(start, end):
+            rows, post_counts = [], Counter()
+            for id in range(start, end):
+                body, body_html = rng.choice(bodies)
+                author_id = rng.choice(authors)
+                post_counts[author_id] += 1
+                rows.append(
+                    {
+                        "id": id,
+                        "body": body,
+                        "body_html": body_html,
+                        "render_pending": False,
+                        "timestamp": timestamp(),
+                        "author_id": author_id,
+                        "comment_count": 0,
+                    }
+                )
+            db.session.execute(posts.insert(), rows)
+            self._bump(users.c.post_count, post_counts)
+            # same fan-out rule as Post.on_inserted
+            db.session.execute(
+                users.update()
+                .where(users.c.id.in_(list(post_counts)))
+                .where(users.c.follower_count > limit)
+                .values(celebrity=True)
+            )
+            follows = Follow.__table__
+            # in timeline key order, so the index pages are written in sequence
+            fanned_out = db.session.execute(
+                Timeline.__table__.insert().from_select(
+                    ["user_id", "post_id", "timestamp"],
+                    db.select([follows.c.follower_id, posts.c.id, posts.c.timestamp])
+                    .select_from(
+                        posts.join(
+                            follows, follows.c.followed_id == posts.c.author_id
+                        ).join(users, users.c.id == posts.c.author_id)
+                    )
+                    .where(posts.c.id.between(start, end - 1))
+                    .where(not_celebrity(users))
+                    .order_by(follows.c.follower_id, posts.c.id),
+                )
+            ).rowcount
+            search.index_range(db.session.connection(), "posts", start, end - 1)
+            return len(rows) + fanned_out
+
+        yield from self._batches(first_id, count, write)
+        self._sync_sequence(posts)
+        db.session.commit()
+
+    def comments(self, count=200, post=None):
+        """`count` comments by random authors, on `post` or random posts"""
+        comments, posts, users = Comment.__table__, Post.__table__, User.__table__
+        authors = self._ids(User)
+        post_ids = array("i", [post.id]) if post is not None else self._ids(Post)
+        if not (authors and post_ids):
+            return
+        bodies = self.pools["comment"]
+        first_id = self._next_id(Comment)
+        timestamp = self._timestamps()
+        rng = self.rng
+
+        def write(start, end):
+            rows, comment_counts, post_counts = [], Counter(), Counter()
+            for id in range(start, end):
+                body, body_html = rng.choice(bodies)
+                author_id, post_id = rng.choice(authors), rng.choice(post_ids)
+                comment_counts[author_id] += 1
+                post_counts[post_id] += 1
+                rows.append(
+                    {
+                        "id": id,
+                        "body": body,
+                        "body_html": body_html,
+                        "render_pending": False,
+                        "timestamp": timestamp(),
+                        "disabled": False,
+                        "author_id": author_id,
+                        "post_id": post_id,
+                    }
+                )
+            db.session.execute(comments.insert(), rows)
+            self._bump(users.c.comment_count, comment_counts)
+            self._bump(posts.c.comment_count, post_counts)
+            search.index_range(db.session.connection(), "comments", start, end - 1)
+            return len(rows)
+
+        yield from self._batches(first_id, count, write)
+        self._sync_sequence(comments)
+        db.session.commit()
+
+
+def user(count=100):
+    for _ in BulkFaker(distinct=min(count, 1000)).users(count):
+        pass
 
 
 def follow_user():
-    users = User.query.all()
-    user_count = len(users)
-    follow_number = min(user_count // 10, 10)
-    if follow_number > 0:
-        for follower in users:
-            i = 0
-            while i < follow_number:
-                followed = users[randint(0, user_count - 1)]
-                follower.follow(followed)
-                # use try...except cause user must be unique
-                try:
-                    db.session.commit()
-                    # increase count number only if commit succeeds
-                    i += 1
-                except IntegrityError:
-                    db.session.rollback()
+    """random follows between the existing users, up to 10 each"""
+    for _ in BulkFaker().follows(min(User.query.count() // 10, 10)):
+        pass
 
 
 def post(count=100):
-    fake = Faker()
-    user_count = User.query.count()
-    for i in range(count):
-        u = User.query.offset(randint(0, user_count - 1)).first()
-        p = Post(body=fake.text(), timestamp=fake.past_date(), author=u)
-        db.session.add(u)
-    db.session.commit()
+    for _ in BulkFaker(distinct=min(count, 1000)).posts(count):
+        pass
 
 
 def comment(post=None, count=200):
-    fake = Faker()
-    user_count = User.query.count()
-    post_count = Post.query.count()
-    if not (user_count and post_count):
-        print("No available user or post. Generate thme first.")
-    else:
-        if post is not None and post in Post.query.all():
-            for i in range(count):
-                u = User.query.offset(randint(0, user_count - 1)).first()
-                c = Comment(
-                    body=fake.text(), timestamp=fake.past_data(), author=u, post=post
-                )
-                db.session.add(c)
-            db.session.commit()
-        else:
-            for i in range(count):
-                u = User.query.offset(randint(0, user_count - 1)).first()
-                p = Post.query.offset(randint(0, post_count - 1)).first()
-                c = Comment(
-                    body=fake.text(), timestamp=fake.past_date(), author=u, post=p
-                )
-                db.session.add(c)
-            db.session.commit()
+    if not (User.query.count() and Post.query.count()):
+        print("No available user or post. Generate them first.")
+        return
+    for _ in BulkFaker(distinct=min(count, 1000)).comments(count, post):
+        pass
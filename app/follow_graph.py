@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from array import array
+from bisect import bisect_left
+from itertools import chain
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class Adjacency:
+    """
+    One direction of the follow graph in CSR form: the sorted neighbour ids
+    of user u are targets[offsets[u]:offsets[u + 1]]. Users changed after
+    the load get their own sorted array in `changed`, which takes precedence.
+    """
+
+    def __init__(self, pairs=()):
+        """pairs of (user id, neighbour id), sorted"""
+        self.offsets = array("i", [0])
+        self.targets = array("i")
+        self.changed = {}
+        for user_id, neighbour_id in pairs:
+            while len(self.offsets) <= user_id:
+                self.offsets.append(len(self.targets))
+            self.targets.append(neighbour_id)
+        self.offsets.append(len(self.targets))
+
+    def _span(self, user_id):
+        if 0 <= user_id < len(self.offsets) - 1:
+            return self.offsets[user_id], self.offsets[user_id + 1]
+        return 0, 0
+
+    def get(self, user_id):
+        ids = self.changed.get(user_id)
+        if ids is not None:
+            return ids
+        lo, hi = self._span(user_id)
+        return self.targets[lo:hi]
+
+    def count(self, user_id):
+        ids = self.changed.get(user_id)
+        if ids is not None:
+            return len(ids)
+        lo, hi = self._span(user_id)
+        return hi - lo
+
+    def contains(self, user_id, neighbour_id):
+        ids = self.changed.get(user_id)
+        if ids is not None:
+            lo, hi = 0, len(ids)
+        else:
+            ids = self.targets
+            lo, hi = self._span(user_id)
+        i = bisect_left(ids, neighbour_id, lo, hi)
+        return i < hi and ids[i] == neighbour_id
+
+    def _own(self, user_id):
+        ids = self.changed.get(user_id)
+        if ids is None:
+            ids = self.changed[user_id] = self.get(user_id)
+        return ids
+
+    def add(self, user_id, neighbour_id):
+        ids = self._own(user_id)
+        i = bisect_left(ids, neighbour_id)
+        if i == len(ids) or ids[i] != neighbour_id:
+            ids.insert(i, neighbour_id)
+
+    def remove(self, user_id, neighbour_id):
+        ids = self._own(user_id)
+        i = bisect_left(ids, neighbour_id)
+        if i < len(ids) and ids[i] == neighbour_id:
+            del ids[i]
+
+    def replace(self, user_id, neighbour_ids):
+        self.changed[user_id] = array("i", sorted(neighbour_ids))
+
+    def users(self):
+        ids = set(self.changed)
+        offsets = self.offsets
+        ids.update(u for u in range(len(offsets) - 1) if offsets[u] != offsets[u + 1])
+        return ids
+
+
+class FollowGraph:
+    """
+    Per-worker index of the follows table, so that follow checks on profile
+    pages don't query the database. Loaded on first use, updated with the
+    Follow rows of every committed session.
+
+    Other workers' changes are not seen directly, but every follow write
+    bumps the follows_version column of both users, which is read with the
+    user row anyway: a user whose version differs from the one the index
+    was built from has its follows reloaded.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        event.listen(Session, "after_flush", self.on_after_flush)
+        event.listen(Session, "after_commit", self.on_after_commit)
+        event.listen(Session, "after_rollback", self.on_after_rollback)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # {"following": Adjacency, "followers": Adjacency} once loaded
+        app.extensions["follow_graph"] = (
+            {} if app.config["FLASKY_FOLLOW_GRAPH"] else None
+        )
+
+    @staticmethod
+    def read(connection):
+        """both directions of the graph as stored in the follows table"""
+        from .models import Follow, User
+
+        users = User.__table__
+        # read first, so that the follows are at least as new as the versions
+        versions = dict(
+            connection.execute(
+                users.select()
+                .with_only_columns([users.c.id, users.c.follows_version])
+                .where(users.c.follows_version != 0)
+            ).fetchall()
+        )
+        follows = Follow.__table__
+        c = follows.c
+        return {
+            "versions": versions,
+            "following": Adjacency(
+                connection.execute(
+                    follows.select()
+                    .with_only_columns([c.follower_id, c.followed_id])
+                    .order_by(c.follower_id, c.followed_id)
+                )
+            ),
+            "followers": Adjacency(
+                connection.execute(
+                    follows.select()
+                    .with_only_columns([c.followed_id, c.follower_id])
+                    .order_by(c.followed_id, c.follower_id)
+                )
+            ),
+        }
+
+    @property
+    def graph(self):
+        graph = current_app.extensions.get("follow_graph")
+        if graph is None or graph:
+            return graph
+        from . import db
+
+        with self._lock:
+            if not graph:
+                graph.update(self.read(db.session.connection()))
+        return graph
+
+    def load(self):
+        """(re)load the whole graph from the database"""
+        from . import db
+
+        graph = current_app.extensions.get("follow_graph")
+        if graph is not None:
+            with self._lock:
+                graph.update(self.read(db.session.connection()))
+
+    @staticmethod
+    def _pending(session):
+        from .models import Follow
+
+        return session.info.get("follow_graph") or any(
+            isinstance(instance, Follow)
+            for instance in chain(session.new, session.deleted)
+        )
+
+    def _neighbours(self, direction, user):
+        from . import db
+        from .models import Follow
+
+        graph = self.graph
+        # the session's own uncommitted follows are only in the database
+        if graph is None or user.id is None or self._pending(db.session):
+            return None
+        version = user.follows_version
+        if version is not None and graph["versions"].get(user.id, 0) != version:
+            followed = db.session.query(Follow.followed_id).filter_by(
+                follower_id=user.id
+            )
+            followers = db.session.query(Follow.follower_id).filter_by(
+                followed_id=user.id
+            )
+            with self._lock:
+                graph["following"].replace(user.id, [id for (id,) in followed])
+                graph["followers"].replace(user.id, [id for (id,) in followers])
+                graph["versions"][user.id] = version
+        return graph[direction]
+
+    def following(self, user):
+        """Adjacency of followed ids to look user up in, or None"""
+        return self._neighbours("following", user)
+
+    def followers(self, user):
+        """Adjacency of follower ids to look user up in, or None"""
+        return self._neighbours("followers", user)
+
+    def common_followed(self, user, other):
+        """ids followed by both users, None if the index can't answer"""
+        a, b = self.following(user), self.following(other)
+        if a is None or b is None:
+            return None
+        return sorted(set(a.get(user.id)).intersection(b.get(other.id)))
+
+    def check(self):
+        """ids of the users whose adjacency differs from the database"""
+        from . import db
+
+        graph = self.graph
+        if graph is None:
+            return []
+        stored = self.read(db.session.connection())
+        wrong = set()
+        for direction in ("following", "followers"):
+            index, truth = graph[direction], stored[direction]
+            for user_id in index.users() | truth.users():
+                if index.get(user_id) != truth.get(user_id):
+                    wrong.add(user_id)
+        return sorted(wrong)
+
+    def on_after_flush(self, session, flush_context):
+        from .models import Follow
+
+        ops = session.info.setdefault("follow_graph", [])
+        for instance in session.new:
+            if isinstance(instance, Follow):
+                ops.append((True, instance.follower_id, instance.followed_id))
+        for instance in session.deleted:
+            if isinstance(instance, Follow):
+                ops.append((False, instance.follower_id, instance.followed_id))
+
+    def on_after_commit(self, session):
+        ops = session.info.pop("follow_graph", None)
+        if not ops or not has_app_context():
+            return
+        graph = current_app.extensions.get("follow_graph")
+        if not graph:  # disabled or not loaded yet
+            return
+        versions = graph["versions"]
+        with self._lock:
+            for added, follower_id, followed_id in ops:
+                # the bumps of Follow.on_inserted/on_deleted, so that only
+                # other workers' writes make the versions disagree
+                for user_id in {follower_id, followed_id}:
+                    versions[user_id] = versions.get(user_id, 0) + 1
+                if added:
+                    graph["following"].add(follower_id, followed_id)
+                    graph["followers"].add(followed_id, follower_id)
+                else:
+                    graph["following"].remove(follower_id, followed_id)
+                    graph["followers"].remove(followed_id, follower_id)
+
+    def on_after_rollback(self, session):
+        session.info.pop("follow_graph", None)
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from flask import current_app, has_app_context
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from .cache import TTLCache
+
+# kept up to date with Core UPDATEs by the model events, never snapshotted:
+# left unloaded, they are read from the row on first access
+_volatile = {
+    "celebrity",
+    "post_count",
+    "comment_count",
+    "follower_count",
+    "followed_count",
+    "follows_version",
+}
+
+
+class IdentityCache:
+    """
+    Per-worker snapshots of the users rows behind current_user, so that the
+    user_loader doesn't query the database; permissions come from the role
+    table. Entries expire after FLASKY_IDENTITY_CACHE_TTL
+    seconds, which bounds how long changes made by other workers go unseen,
+    and are dropped at once by the after_update/after_delete events of this
+    worker. A TTL of 0 disables the cache.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        ttl = app.config["FLASKY_IDENTITY_CACHE_TTL"]
+        size = app.config["FLASKY_IDENTITY_CACHE_SIZE"]
+        app.extensions["identity_cache"] = (
+            {"users": TTLCache(size, ttl)} if ttl else None
+        )
+
+    @staticmethod
+    def _caches():
+        if not has_app_context():
+            return None
+        return current_app.extensions.get("identity_cache")
+
+    @staticmethod
+    def snapshot(obj):
+        """the loaded column values of a User"""
+        state = obj.__dict__
+        return {
+            column.key: state[column.key]
+            for column in obj.__mapper__.column_attrs
+            if column.key in state and column.key not in _volatile
+        }
+
+    @staticmethod
+    def _restore(session, model, values):
+        """a persistent instance from a snapshot, without a query"""
+        obj = model.__mapper__.class_manager.new_instance()
+        for key, value in values.items():
+            set_committed_value(obj, key, value)
+        make_transient_to_detached(obj)
+        return session.merge(obj, load=False)
+
+    def load_user(self, session, user_id):
+        """the User, from its snapshot when present"""
+        from .models import User
+
+        caches = self._caches()
+        if caches is None:
+            return session.query(User).get(user_id)
+        values = caches["users"].get(user_id)
+        if values is None:
+            user = session.query(User).get(user_id)
+            if user is not None:
+                caches["users"].set(user_id, self.snapshot(user))
+            return user
+        return self._restore(session, User, values)
+
+    def touch(self, user_id, **values):
+        """update a snapshot in place, for writes that bypass the ORM"""
+        caches = self._caches()
+        if caches is not None:
+            snapshot = caches["users"].peek(user_id)
+            if snapshot is not None:
+                snapshot.update(values)
+
+    def on_user_changed(self, mapper, connection, target):
+        caches = self._caches()
+        if caches is not None:
+            caches["users"].delete(target.id)
+
+    def stats(self):
+        """hit/miss counters of the cache of the current app"""
+        caches = self._caches()
+        if caches is None:
+            return {}
+        return {name: cache.stats() for name, cache in caches.items()}
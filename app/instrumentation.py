@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+import json
+import re
+import time
+from collections import Counter, defaultdict
+from flask import current_app, g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_whitespace = re.compile(r"\s+")
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_in_lists = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+
+def fingerprint(statement):
+    """shape of a statement, the same for every run with different values"""
+    statement = _whitespace.sub(" ", statement).strip()
+    statement = _literals.sub("?", statement)
+    return _in_lists.sub("(?)", statement)
+
+
+class RequestQueries:
+    """statements sent to the database while serving the current request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+        self.slow = []
+
+    def record(self, statement, parameters, duration):
+        self.count += 1
+        self.duration += duration
+        self.shapes[fingerprint(statement)] += 1
+        if duration >= current_app.config["FLASKY_SLOW_DB_QUERY_TIME"]:
+            self.slow.append((statement, parameters, duration))
+
+    def repeated(self, threshold):
+        return {
+            shape: count for shape, count in self.shapes.items() if count > threshold
+        }
+
+
+class QueryInstrumentation:
+    """
+    Per-request query budget: count and time every statement of a request,
+    flag statement shapes repeated more than FLASKY_N_PLUS_ONE_THRESHOLD times
+    as N+1 candidates, and report them through a Server-Timing header and one
+    structured log line. Totals per endpoint are kept in `endpoints`.
+    """
+
+    def __init__(self, app=None):
+        self.endpoints = defaultdict(lambda: {"requests": 0, "queries": 0, "time": 0.0})
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        if not event.contains(Engine, "before_cursor_execute", _before_execute):
+            event.listen(Engine, "before_cursor_execute", _before_execute)
+            event.listen(Engine, "after_cursor_execute", _after_execute)
+
+    def _before_request(self):
+        g.queries = RequestQueries()
+
+    def _after_request(self, response):
+        queries = g.pop("queries", None)
+        if queries is None:
+            return response
+        config = current_app.config
+        elapsed = time.perf_counter() - queries.started
+        endpoint = request.endpoint or "<unknown>"
+        totals = self.endpoints[endpoint]
+        totals["requests"] += 1
+        totals["queries"] += queries.count
+        totals["time"] += queries.duration
+
+        response.headers.add(
+            "Server-Timing",
+            'db;dur=%.1f;desc="%d queries", app;dur=%.1f'
+            % (queries.duration * 1000, queries.count, elapsed * 1000),
+        )
+        for statement, parameters, duration in queries.slow:
+            current_app.logger.warning(
+                "Slow query: %s\nParameters: %s\nDuration: %fs\nEndpoint: %s\n"
+                % (statement, parameters, duration, endpoint)
+            )
+        repeated = queries.repeated(config["FLASKY_N_PLUS_ONE_THRESHOLD"])
+        line = json.dumps(
+            {
+                "endpoint": endpoint,
+                "method": request.method,
+                "status": response.status_code,
+                "queries": queries.count,
+                "db_ms": round(queries.duration * 1000, 1),
+                "total_ms": round(elapsed * 1000, 1),
+                "n_plus_one": repeated,
+            }
+        )
+        if repeated:
+            current_app.logger.warning("Query budget: %s" % line)
+        else:
+            current_app.logger.info("Query budget: %s" % line)
+        return response
+
+
+# the start time lives on the execution context of the statement: a
+# statement that raises never reaches after_cursor_execute, and its context
+# is discarded with it instead of leaving a start time on the connection
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start_time = time.perf_counter()
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_query_start_time", None)
+    if started is None or not has_request_context():
+        return
+    queries = g.get("queries")
+    if queries is not None:
+        queries.record(statement, parameters, time.perf_counter() - started)
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import threading
+import time
+import weakref
+from flask import current_app
+from sqlalchemy import bindparam
+
+
+class LastSeenBuffer:
+    """
+    Write-behind buffer for User.last_seen. User.ping() records the time here
+    instead of dirtying the users row on every request, and the pending values
+    are written with one executemany UPDATE once FLASKY_LAST_SEEN_FLUSH_SIZE
+    users are pending or FLASKY_LAST_SEEN_FLUSH_INTERVAL seconds have passed.
+    Each app buffers for its own database, and all of them are flushed at
+    exit.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._apps = weakref.WeakSet()
+        atexit.register(self._flush_at_exit)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["last_seen"] = {"pending": {}, "flushed_at": time.monotonic()}
+        app.teardown_request(self._teardown_request)
+        self._apps.add(app)
+
+    @staticmethod
+    def _state():
+        return current_app.extensions["last_seen"]
+
+    def pending(self, user_id):
+        return self._state()["pending"].get(user_id)
+
+    def record(self, user_id, last_seen):
+        state = self._state()
+        with self._lock:
+            state["pending"][user_id] = last_seen
+
+    def flush_if_due(self):
+        config = current_app.config
+        state = self._state()
+        pending = state["pending"]
+        due = len(pending) >= config["FLASKY_LAST_SEEN_FLUSH_SIZE"] or (
+            pending
+            and time.monotonic() - state["flushed_at"]
+            >= config["FLASKY_LAST_SEEN_FLUSH_INTERVAL"]
+        )
+        if due:
+            self.flush()
+
+    def flush(self):
+        """write all pending last_seen values in one bulk UPDATE"""
+        from . import db
+        from .models import User
+
+        state = self._state()
+        with self._lock:
+            pending, state["pending"] = state["pending"], {}
+            state["flushed_at"] = time.monotonic()
+        if not pending:
+            return
+        users = User.__table__
+        try:
+            # own transaction, outside of the request session
+            with db.engine.begin() as connection:
+                connection.execute(
+                    users.update()
+                    .where(users.c.id == bindparam("user_id"))
+                    .values(last_seen=bindparam("last_seen")),
+                    [
+                        {"user_id": user_id, "last_seen": last_seen}
+                        for user_id, last_seen in pending.items()
+                    ],
+                )
+        except Exception:
+            # keep the values for the next flush, unless newer ones came in
+            with self._lock:
+                pending.update(state["pending"])
+                state["pending"] = pending
+            raise
+
+    def _teardown_request(self, exc):
+        # the response is out already, a failed write must not break teardown
+        try:
+            self.flush_if_due()
+        except Exception:
+            current_app.logger.exception("Flushing last_seen failed")
+
+    def _flush_at_exit(self):
+        for app in list(self._apps):
+            with app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    app.logger.exception("Flushing last_seen at exit failed")
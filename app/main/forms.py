@@ -18,7 +18,8 @@ from wtforms.validators import (
     EqualTo,
 )
 from flask_pagedown.fields import PageDownField
-from ..models import User, Role
+from .. import role_table
+from ..models import User
 
 
 class EditProfileForm(FlaskForm):
@@ -65,7 +66,7 @@ class EditProfileAdminForm(FlaskForm):
         # SelectField list for role field in the form:
         # role.id: select value, role.name: display choice for dropdown list
         self.role.choices = [
-            (role.id, role.name) for role in Role.query.order_by(Role.name).all()
+            (role.id, role.name) for role in role_table.get().by_name.values()
         ]
         self.user = user
 
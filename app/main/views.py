@@ -12,24 +12,82 @@ from flask import (
     make_response,
 )
 from flask_login import login_required, current_user
-from flask_sqlalchemy import get_debug_queries
 
 from . import main  # the blueprint
-from .. import db
+from .. import db, page_cache
+from ..conditional import conditional
 from ..models import User, Role, Permission, Post, Comment
 from .forms import EditProfileForm, EditProfileAdminForm, PostForm, CommentForm
 from ..decorators import permission_required, admin_required
+from ..exceptions import ValidationError
+from ..search import fts_enabled, paginate_search
+
+# what user.html shows of the user, and _posts.html of the author
+_profile_columns = (
+    User.id,
+    User.email,
+    User.username,
+    User.name,
+    User.location,
+    User.about_me,
+    User.member_since,
+    User.last_seen,
+    User.avatar_hash,
+    User.post_count,
+    User.comment_count,
+    User.follower_count,
+    User.followed_count,
+)
+
 
-# TODO: define hook func conditionally
-@main.after_app_request
-def after_request(response):
-    for query in get_debug_queries():
-        if query.duration >= current_app.config["FLASKY_SLOW_DB_QUERY_TIME"]:
-            current_app.logger.warning(
-                "Slow query: %s\nParameters: %s\nDuration: %fs\nContext: %s\n"
-                % (query.statement, query.parameters, query.duration, query.context)
-            )
-    return response
+def _page_keys(query, columns, page, per_page):
+    """the given columns of the rows of a paginate() page, and of no object"""
+    page = max(page, 1)
+    return [
+        tuple(row)
+        for row in query.with_entities(*columns)
+        .limit(per_page)
+        .offset((page - 1) * per_page)
+    ]
+
+
+def user_validators(username):
+    """anonymous user.html: the profile and the keys of the page of posts"""
+    profile = db.session.query(*_profile_columns).filter_by(username=username).first()
+    if profile is None:
+        return None
+    keys = _page_keys(
+        Post.query.filter_by(author_id=profile.id).order_by(Post.timestamp.desc()),
+        (Post.id, Post.updated_at),
+        request.args.get("page", 1, type=int),
+        current_app.config["FLASKY_POSTS_PER_PAGE"],
+    )
+    return [tuple(profile), keys], None
+
+
+def post_validators(id):
+    """anonymous post.html: post, author and the page of comments with theirs"""
+    row = (
+        db.session.query(Post.updated_at, Post.comment_count, *_profile_columns)
+        .join(User, User.id == Post.author_id)
+        .filter(Post.id == id)
+        .first()
+    )
+    if row is None:
+        return None
+    per_page = current_app.config["FLASKY_COMMENTS_PER_PAGE"]
+    page = request.args.get("page", 1, type=int)
+    if page == -1:
+        page = (row.comment_count - 1) // per_page + 1
+    keys = _page_keys(
+        Comment.query.filter_by(post_id=id)
+        .join(User, User.id == Comment.author_id)
+        .order_by(Comment.timestamp.asc()),
+        (Comment.id, Comment.updated_at, User.username, User.avatar_hash),
+        page,
+        per_page,
+    )
+    return [tuple(row), keys], None
 
 
 @main.route("/shutdown")
@@ -44,6 +102,7 @@ def server_shutdown():
 
 
 @main.route("/", methods=["GET", "POST"])
+@page_cache.cached
 def index():
     form = PostForm()
     if current_user.can(Permission.WRITE) and form.validate_on_submit():
@@ -57,11 +116,18 @@ def index():
         # show_followed control flag is stored in cookies
         show_followed = bool(request.cookies.get("show_followed", ""))
     if show_followed:
-        query = current_user.followed_posts
+        query, timestamp, id = current_user.timeline()
+        order = (timestamp.desc(), id.desc())
     else:
         query = Post.query
-    pagination = query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config["FLASKY_POSTS_PER_PAGE"], error_out=False
+        order = (Post.timestamp.desc(),)
+    # load the authors of a page in one batch instead of one SELECT per post
+    pagination = (
+        query.options(db.selectinload(Post.author))
+        .order_by(*order)
+        .paginate(
+            page, per_page=current_app.config["FLASKY_POSTS_PER_PAGE"], error_out=False
+        )
     )
     posts = pagination.items
     return render_template(
@@ -74,7 +140,24 @@ def index():
     )
 
 
+@main.route("/search")
+@page_cache.cached
+def search():
+    """ranked full-text search in posts and comments"""
+    if not fts_enabled(db.engine):
+        abort(501)
+    try:
+        results = paginate_search(
+            db.session, current_app.config["FLASKY_SEARCH_RESULTS_PER_PAGE"]
+        )
+    except ValidationError:
+        abort(400)
+    return render_template("search.html", results=results)
+
+
 @main.route("/user/<username>")
+@conditional(user_validators, when=page_cache.cacheable)
+@page_cache.cached
 def user(username):
     """user profile page"""
     user = User.query.filter_by(username=username).first_or_404()
@@ -83,8 +166,16 @@ def user(username):
         page, per_page=current_app.config["FLASKY_POSTS_PER_PAGE"], error_out=False
     )
     posts = pagination.items
+    suggestions = []
+    if current_user == user:
+        suggestions = user.follow_suggestions()
     return render_template(
-        "user.html", user=user, posts=posts, pagination=pagination, endpoint="main.user"
+        "user.html",
+        user=user,
+        posts=posts,
+        pagination=pagination,
+        endpoint="main.user",
+        suggestions=suggestions,
     )
 
 
@@ -141,6 +232,8 @@ def edit_profile_admin(id):
 
 
 @main.route("/post/<int:id>", methods=["GET", "POST"])
+@conditional(post_validators, when=page_cache.cacheable)
+@page_cache.cached
 def post(id):
     post = Post.query.get_or_404(id)
     form = CommentForm()
@@ -155,11 +248,17 @@ def post(id):
         return redirect(url_for("main.post", id=post.id, page=-1))
     page = request.args.get("page", 1, type=int)
     if page == -1:
-        page = (post.comments.count() - 1) // current_app.config[
+        page = (post.comment_count - 1) // current_app.config[
             "FLASKY_COMMENTS_PER_PAGE"
         ] + 1
-    pagination = post.comments.order_by(Comment.timestamp.asc()).paginate(
-        page, per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"], error_out=False
+    pagination = (
+        post.comments.options(db.selectinload(Comment.author))
+        .order_by(Comment.timestamp.asc())
+        .paginate(
+            page,
+            per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
+            error_out=False,
+        )
     )
     comments = pagination.items
     # posts param as a list since the need of template _posts.html
@@ -227,6 +326,7 @@ def unfollow(username):
 
 
 @main.route("/followers/<username>")
+@page_cache.cached
 def followers(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
@@ -254,6 +354,7 @@ def followers(username):
 
 
 @main.route("/followed-by/<username>")
+@page_cache.cached
 def followed_by(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
@@ -304,8 +405,14 @@ def show_followed():
 @permission_required(Permission.MODERATE)
 def moderate():
     page = request.args.get("page", 1, type=int)
-    pagination = Comment.query.order_by(Comment.timestamp.desc()).paginate(
-        page, per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"], error_out=False
+    pagination = (
+        Comment.query.options(db.selectinload(Comment.author))
+        .order_by(Comment.timestamp.desc())
+        .paginate(
+            page,
+            per_page=current_app.config["FLASKY_COMMENTS_PER_PAGE"],
+            error_out=False,
+        )
     )
     comments = pagination.items
     return render_template(
@@ -6,11 +6,38 @@ import base64
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin, AnonymousUserMixin
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
-from flask import current_app, request, url_for
-from markdown import markdown
-import bleach
-from . import db, login_manager  # app/__init__.py
+from flask import current_app, g, request, url_for, has_request_context
+from markupsafe import escape
+from sqlalchemy.orm.attributes import set_committed_value
+from . import db, login_manager, last_seen_buffer, follow_graph
+from . import identity_cache, role_table
 from .exceptions import ValidationError
+from .rendering import render_body, defer_rendering
+from . import search
+
+
+def update_counter(connection, column, id, delta):
+    """bump a denormalized counter column in place during the flush"""
+    connection.execute(
+        column.table.update()
+        .where(column.table.c.id == id)
+        .values({column: column + delta})
+    )
+
+
+def not_celebrity(users):
+    """users that are not celebrities, for the set-based timeline writes"""
+    return users.c.celebrity == False
+
+
+def reindex_body(connection, table, target):
+    """swap the old body of an updated post or comment for the new one"""
+    history = db.inspect(target).attrs.body.history
+    if not history.has_changes():
+        return
+    for body in history.deleted:
+        search.unindex_body(connection, table, target.id, body)
+    search.index_body(connection, table, target.id, target.body)
 
 
 class Permission:
@@ -21,6 +48,20 @@ class Permission:
     ADMIN = 0x80  # 128
 
 
+# payload of the API tokens: 2 carries id, token generation, confirmed flag,
+# role and permissions, tokens without a version only carry the id
+AUTH_TOKEN_VERSION = 2
+
+
+def to_json(obj, fields=None):
+    """the json_fields of a model instance, only those in fields if given"""
+    return {
+        name: value(obj)
+        for name, (_, value) in obj.json_fields.items()
+        if fields is None or name in fields
+    }
+
+
 # ORM models
 class Role(db.Model):
     __tablename__ = "roles"
@@ -53,14 +94,23 @@ class Role(db.Model):
             "Administrator": (0xFF,),
         }
         default_role = "User"
+        # one query, and no writes on the usual deploy where nothing changed
+        existing = {role.name: role for role in Role.query}
+        changed = False
         for r in roles.keys():
-            role = Role.query.filter_by(name=r).first()
+            role = existing.get(r)
             if role is None:
                 role = Role(name=r)
+            elif role.permissions == roles[r][0] and role.default == (
+                r == default_role
+            ):
+                continue
             role.permissions = roles[r][0]
             role.default = role.name == default_role
             db.session.add(role)
-        db.session.commit()
+            changed = True
+        if changed:
+            db.session.commit()
 
     def add_permission(self, perm):
         if not self.has_permission(perm):
@@ -82,10 +132,91 @@ class Role(db.Model):
 
 class Follow(db.Model):
     __tablename__ = "follows"
+    # the primary key serves lookups by follower, this one the followers pages
+    __table_args__ = (
+        db.Index("ix_follows_followed_id_timestamp", "followed_id", "timestamp"),
+    )
     follower_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
     followed_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+    @staticmethod
+    def on_inserted(mapper, connection, target):
+        """backfill the follower's timeline with posts of the followed user"""
+        update_counter(
+            connection, User.__table__.c.followed_count, target.follower_id, 1
+        )
+        update_counter(
+            connection, User.__table__.c.follower_count, target.followed_id, 1
+        )
+        for id in {target.follower_id, target.followed_id}:
+            update_counter(connection, User.__table__.c.follows_version, id, 1)
+        celebrity = connection.execute(
+            db.select([User.celebrity]).where(User.id == target.followed_id)
+        ).scalar()
+        if celebrity:
+            # posts of celebrities are joined in on read, see followed_posts
+            return
+        connection.execute(
+            Timeline.__table__.insert().from_select(
+                ["user_id", "post_id", "timestamp"],
+                db.select(
+                    [db.literal(target.follower_id), Post.id, Post.timestamp]
+                ).where(Post.author_id == target.followed_id),
+            )
+        )
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        """prune posts of the unfollowed user from the follower's timeline"""
+        update_counter(
+            connection, User.__table__.c.followed_count, target.follower_id, -1
+        )
+        update_counter(
+            connection, User.__table__.c.follower_count, target.followed_id, -1
+        )
+        for id in {target.follower_id, target.followed_id}:
+            update_counter(connection, User.__table__.c.follows_version, id, 1)
+        connection.execute(
+            Timeline.__table__.delete().where(
+                db.and_(
+                    Timeline.user_id == target.follower_id,
+                    Timeline.post_id.in_(
+                        db.select([Post.id]).where(Post.author_id == target.followed_id)
+                    ),
+                )
+            )
+        )
+
+
+class Timeline(db.Model):
+    """
+    Materialized home timeline: one row per (reader, post) written on post
+    creation (fan-out-on-write), so followed_posts becomes a range scan on
+    (user_id, timestamp, post_id) instead of a join of posts against follows.
+    """
+
+    __tablename__ = "timeline"
+    __table_args__ = (
+        db.Index("ix_timeline_user_id_timestamp", "user_id", "timestamp", "post_id"),
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("posts.id"), primary_key=True)
+    timestamp = db.Column(db.DateTime)
+
+
+class FollowSuggestion(db.Model):
+    """
+    Precomputed "who to follow": the top suggestions of each user, written by
+    'flask recommend', read in rank order with a primary key range scan.
+    """
+
+    __tablename__ = "follow_suggestions"
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    suggested_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    score = db.Column(db.Float)
+
 
 class User(UserMixin, db.Model):
     """inherit UserMixin class for login detection method"""
@@ -108,6 +239,21 @@ class User(UserMixin, db.Model):
 
     avatar_hash = db.Column(db.String(32))
 
+    # set once the user has too many followers to fan out posts on write
+    celebrity = db.Column(db.Boolean, default=False, nullable=False, index=True)
+
+    # denormalized counters, maintained by the Post, Comment and Follow events
+    post_count = db.Column(db.Integer, default=0, nullable=False)
+    comment_count = db.Column(db.Integer, default=0, nullable=False)
+    # self-follows are included, same as followers.count()
+    follower_count = db.Column(db.Integer, default=0, nullable=False)
+    followed_count = db.Column(db.Integer, default=0, nullable=False)
+    # bumped on every follow or unfollow of or by the user, see FollowGraph
+    follows_version = db.Column(db.Integer, default=0, nullable=False)
+
+    # carried by the API tokens, which are revoked by incrementing it
+    token_generation = db.Column(db.Integer, default=0, nullable=False)
+
     posts = db.relationship("Post", backref="author", lazy="dynamic")
 
     # self reference, return Follow instance
@@ -129,24 +275,101 @@ class User(UserMixin, db.Model):
     comments = db.relationship("Comment", backref="author", lazy="dynamic")
 
     @staticmethod
-    def add_self_follows():
+    def add_self_follows(first_id, last_id):
         """
-        create new func to upgrade db: follow oneself
+        create the missing self-follows of users with id in [first_id, last_id]
+        set-based, with their counters and timelines, return how many
         Note: watch out the side-effect on count and pagination
         """
-        for user in User.query.all():
-            if not user.is_following(user):
-                user.follow(user)
-                db.session.add(user)
-                db.session.commit()
+        users, follows = User.__table__, Follow.__table__
+        posts, timeline = Post.__table__, Timeline.__table__
+        missing = [
+            id
+            for (id,) in db.session.execute(
+                db.select([users.c.id])
+                .where(users.c.id.between(first_id, last_id))
+                .where(
+                    ~db.exists()
+                    .where(follows.c.follower_id == users.c.id)
+                    .where(follows.c.followed_id == users.c.id)
+                )
+            )
+        ]
+        if not missing:
+            return 0
+        db.session.execute(
+            follows.insert().from_select(
+                ["follower_id", "followed_id", "timestamp"],
+                db.select(
+                    [
+                        users.c.id.label("follower_id"),
+                        users.c.id.label("followed_id"),
+                        db.literal(datetime.utcnow()),
+                    ]
+                ).where(users.c.id.in_(missing)),
+            )
+        )
+        db.session.execute(
+            users.update()
+            .where(users.c.id.in_(missing))
+            .values(
+                follower_count=users.c.follower_count + 1,
+                followed_count=users.c.followed_count + 1,
+                follows_version=users.c.follows_version + 1,
+            )
+        )
+        # same as Follow.on_inserted: own posts, unless joined in on read
+        db.session.execute(
+            timeline.insert().from_select(
+                ["user_id", "post_id", "timestamp"],
+                db.select([posts.c.author_id, posts.c.id, posts.c.timestamp])
+                .select_from(posts.join(users, users.c.id == posts.c.author_id))
+                .where(posts.c.author_id.in_(missing))
+                .where(not_celebrity(users))
+                .where(
+                    ~db.exists()
+                    .where(timeline.c.user_id == posts.c.author_id)
+                    .where(timeline.c.post_id == posts.c.id)
+                ),
+            )
+        )
+        return len(missing)
+
+    @staticmethod
+    def reconcile_counters(first_id, last_id):
+        """recount the denormalized counters of users with id in [first_id, last_id]"""
+        users = User.__table__
+
+        def count(table, column):
+            return (
+                db.select([db.func.count()])
+                .select_from(table)
+                .where(column == users.c.id)
+                .as_scalar()
+            )
+
+        db.session.execute(
+            users.update()
+            .where(users.c.id.between(first_id, last_id))
+            .values(
+                post_count=count(Post.__table__, Post.__table__.c.author_id),
+                comment_count=count(Comment.__table__, Comment.__table__.c.author_id),
+                follower_count=count(Follow.__table__, Follow.__table__.c.followed_id),
+                followed_count=count(Follow.__table__, Follow.__table__.c.follower_id),
+            )
+        )
 
     def __init__(self, **kw):
         super(User, self).__init__(**kw)
-        if self.role is None:
+        if self.role is None and self.role_id is None:
+            roles = role_table.get()
+            role = None
             if self.email == current_app.config["FLASKY_ADMIN"]:
-                self.role = Role.query.filter_by(name="Administrator").first()
-            if self.role is None:
-                self.role = Role.query.filter_by(default=True).first()
+                role = roles.by_name.get("Administrator")
+            if role is None:
+                role = roles.default
+            if role is not None:
+                self.role_id = role.id
 
         if self.email is not None and self.avatar_hash is None:
             self.avatar_hash = self.gravatar_hash()
@@ -161,10 +384,26 @@ class User(UserMixin, db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        if self.password_hash is not None:
+            self.revoke_tokens()
+        self.password_hash = self._hash_password(password)
+
+    @staticmethod
+    def _hash_password(password):
+        return generate_password_hash(
+            password, method=current_app.config["FLASKY_PASSWORD_HASH_METHOD"]
+        )
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not check_password_hash(self.password_hash, password):
+            return False
+        method = self.password_hash.split("$", 1)[0]
+        if method != current_app.config["FLASKY_PASSWORD_HASH_METHOD"]:
+            # upgrade to the configured method while the password is at hand,
+            # same password so the tokens stay valid
+            self.password_hash = self._hash_password(password)
+            db.session.add(self)
+        return True
 
     def generate_confirmation_token(self, expiration=3600):
         """generate token from User.id"""
@@ -226,17 +465,39 @@ class User(UserMixin, db.Model):
         db.session.add(self)
         return True
 
+    @property
+    def permissions(self):
+        """permission bits of the role, from the role table"""
+        # an assigned Role only sets role_id on flush
+        role = self.__dict__.get("role")
+        if role is not None:
+            identity = db.inspect(role).identity
+            if identity is None:
+                return role.permissions or 0
+            return role_table.permissions(identity[0])
+        return role_table.permissions(self.role_id)
+
     def can(self, perm):
         """verify user's permissions"""
-        return self.role is not None and self.role.has_permission(perm)
+        return self.permissions & perm == perm
 
     def is_administrator(self):
         return self.can(Permission.ADMIN)
 
     def ping(self):
-        """update last_seen date"""
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
+        """update last_seen date, written behind by last_seen_buffer"""
+        now = datetime.utcnow()
+        if self.id is None:
+            self.last_seen = now
+            return
+        last_seen = last_seen_buffer.pending(self.id) or self.last_seen
+        resolution = current_app.config["FLASKY_LAST_SEEN_RESOLUTION"]
+        if last_seen is not None and (now - last_seen).total_seconds() < resolution:
+            return
+        last_seen_buffer.record(self.id, now)
+        # show the new value without dirtying the row in the session
+        set_committed_value(self, "last_seen", now)
+        identity_cache.touch(self.id, last_seen=now)
 
     def gravatar_hash(self):
         return hashlib.md5(self.email.lower().encode("utf-8")).hexdigest()
@@ -249,32 +510,109 @@ class User(UserMixin, db.Model):
         )
 
     def is_following(self, user):
+        if user.id is None:
+            return False
+        following = follow_graph.following(self)
+        if following is not None:
+            return following.contains(self.id, user.id)
         return self.followed.filter_by(followed_id=user.id).first() is not None
 
     def is_followed_by(self, user):
+        if user.id is None:
+            return False
+        followers = follow_graph.followers(self)
+        if followers is not None:
+            return followers.contains(self.id, user.id)
         return self.followers.filter_by(follower_id=user.id).first() is not None
 
     def follow(self, user):
-        if not self.is_following(user):
+        # checked against the database, the index may lag other workers
+        if (
+            self.id is None
+            or user.id is None
+            or self.followed.filter_by(followed_id=user.id).first() is None
+        ):
             f = Follow(follower=self, followed=user)
             db.session.add(f)
+            if has_request_context():
+                g.pop("follows_celebrity", None)
 
     def unfollow(self, user):
         # Specific followed_id is needed to undo the relationship
         f = self.followed.filter_by(followed_id=user.id).first()
         if f:
             db.session.delete(f)  # delete the Follow instance
+            if has_request_context():
+                g.pop("follows_celebrity", None)
+
+    def follow_suggestions(self, limit=5):
+        """users suggested by the last recommend job, minus those followed since"""
+        users = (
+            User.query.join(FollowSuggestion, FollowSuggestion.suggested_id == User.id)
+            .filter(FollowSuggestion.user_id == self.id)
+            .order_by(FollowSuggestion.rank)
+            .limit(limit * 2)
+            .all()
+        )
+        return [user for user in users if not self.is_following(user)][:limit]
 
     @property
     def followed_posts(self):
-        return Post.query.join(Follow, Follow.followed_id == Post.author_id).filter(
-            Follow.follower_id == self.id
+        return self.timeline()[0]
+
+    def timeline(self):
+        return User.timeline_of(self.id)
+
+    @staticmethod
+    def timeline_of(user_id):
+        """
+        (query, timestamp, id): followed_posts of user_id and the columns to
+        order and seek it by. Those of the timeline index, so that a page is
+        a single range scan of it, unless posts of celebrities are joined in;
+        then the union is sorted by the post columns.
+        """
+        query = Post.query.join(Timeline, Timeline.post_id == Post.id).filter(
+            Timeline.user_id == user_id
         )
+        if User.follows_celebrity(user_id):
+            # posts of celebrities are not fanned out, join them in on read
+            query = query.union(
+                Post.query.join(Follow, Follow.followed_id == Post.author_id)
+                .join(User, User.id == Post.author_id)
+                .filter(Follow.follower_id == user_id, User.celebrity == True)
+            )
+            return query, Post.timestamp, Post.id
+        return query, Timeline.timestamp, Timeline.post_id
+
+    @staticmethod
+    def follows_celebrity(user_id):
+        """whether user_id follows a celebrity, asked once per request"""
+        known = g.setdefault("follows_celebrity", {}) if has_request_context() else {}
+        if user_id not in known:
+            known[user_id] = db.session.query(
+                Follow.query.join(User, User.id == Follow.followed_id)
+                .filter(Follow.follower_id == user_id, User.celebrity == True)
+                .exists()
+            ).scalar()
+        return known[user_id]
 
     def generate_auth_token(self, expiration):
-        """temp auth token to avoid sensitive password auth at each request"""
+        """
+        temp auth token to avoid sensitive password auth at each request.
+        Carries what the API checks on every request, so a token can be
+        verified without loading the user; see AUTH_TOKEN_VERSION.
+        """
         s = Serializer(current_app.config["SECRET_KEY"], expires_in=expiration)
-        return s.dumps({"id": self.id}).decode("utf-8")
+        return s.dumps(
+            {
+                "v": AUTH_TOKEN_VERSION,
+                "id": self.id,
+                "gen": self.token_generation or 0,
+                "confirmed": bool(self.confirmed),
+                "role": self.role_id,
+                "perm": self.permissions,
+            }
+        ).decode("utf-8")
 
     @staticmethod
     def verify_auth_token(token):
@@ -283,35 +621,70 @@ class User(UserMixin, db.Model):
             data = s.loads(token)
         except:
             return None
-        return User.query.get_or_404(data["id"])
+        user = User.query.get_or_404(data["id"])
+        if data.get("v") == AUTH_TOKEN_VERSION and data["gen"] != user.token_generation:
+            return None
+        return user
+
+    def revoke_tokens(self):
+        """invalidate every API token issued to the user so far"""
+        self.token_generation = (self.token_generation or 0) + 1
+
+    @staticmethod
+    def on_changed_grants(target, value, oldvalue, initiator):
+        """tokens carry the confirmed flag and the permissions of the role"""
+        if target.id is not None and value != oldvalue:
+            target.revoke_tokens()
 
     @staticmethod
     def on_changed_email(target, value, oldvalue, initiator):
         """Update avatar_hash once email is changed"""
         target.avatar_hash = hashlib.md5(value.lower().encode("utf-8")).hexdigest()
 
-    def to_json(self):
-        json_user = {
-            "url": url_for("api.get_user", id=self.id, _external=True),
-            "username": self.username,
-            "name": self.name,
-            "location": self.location,
-            "about_me": self.about_me,
-            "member_since": self.member_since,
-            "last_seen": self.last_seen,
-            "posts": url_for("api.get_user_posts", id=self.id, _external=True),
-            "followed_posts": url_for(
+    # field of to_json() -> (columns it reads, value)
+    json_fields = {
+        "url": (
+            ("id",),
+            lambda self: url_for("api.get_user", id=self.id, _external=True),
+        ),
+        "username": (("username",), lambda self: self.username),
+        "name": (("name",), lambda self: self.name),
+        "location": (("location",), lambda self: self.location),
+        "about_me": (("about_me",), lambda self: self.about_me),
+        "member_since": (("member_since",), lambda self: self.member_since),
+        "last_seen": (("last_seen",), lambda self: self.last_seen),
+        "posts": (
+            ("id",),
+            lambda self: url_for("api.get_user_posts", id=self.id, _external=True),
+        ),
+        "followed_posts": (
+            ("id",),
+            lambda self: url_for(
                 "api.get_user_followed_posts", id=self.id, _external=True
             ),
-            "post_count": self.posts.count(),
-        }
-        return json_user
+        ),
+        "post_count": (("post_count",), lambda self: self.post_count),
+    }
+
+    def to_json(self, fields=None):
+        return to_json(self, fields)
 
     def __repr__(self):
         return "<User %r>" % self.username
 
 
 db.event.listen(User.email, "set", User.on_changed_email)
+# the old values are compared, load them when they were expired; a change
+# of User.role sets role_id as well, in the flush
+db.event.listen(User.confirmed, "set", User.on_changed_grants, active_history=True)
+db.event.listen(User.role_id, "set", User.on_changed_grants, active_history=True)
+db.event.listen(User, "after_update", identity_cache.on_user_changed)
+db.event.listen(User, "after_delete", identity_cache.on_user_changed)
+db.event.listen(Role, "after_insert", role_table.on_role_changed)
+db.event.listen(Role, "after_update", role_table.on_role_changed)
+db.event.listen(Role, "after_delete", role_table.on_role_changed)
+for attribute in (Role.name, Role.permissions, Role.default):
+    db.event.listen(attribute, "set", role_table.on_role_edited)
 
 
 class AnonymousUser(AnonymousUserMixin):
@@ -328,60 +701,126 @@ login_manager.anonymous_user = AnonymousUser
 
 @login_manager.user_loader
 def load_user(user_id):
-    """load user into current_user?"""
-    return User.query.get(int(user_id))
+    """load user into current_user, from the identity cache when possible"""
+    return identity_cache.load_user(db.session, int(user_id))
 
 
 class Post(db.Model):
     __tablename__ = "posts"
+    # a user's posts newest first, also in (timestamp, id) cursor order
+    __table_args__ = (
+        db.Index("ix_posts_author_id_timestamp", "author_id", "timestamp", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)  # auto generated from Post.body
+    # body_html is rendered in the background, see defer_rendering()
+    render_pending = db.Column(db.Boolean, default=False, index=True)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    # denormalized comments.count(), maintained by the Comment events
+    comment_count = db.Column(db.Integer, default=0, nullable=False)
+    # set by every UPDATE of the row, Core ones included: the HTTP validators
+    updated_at = db.Column(
+        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
 
     comments = db.relationship("Comment", backref="post", lazy="dynamic")
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
         """transform markdown text into html text and save it"""
-        allowed_tags = [
-            "a",
-            "abbr",
-            "acronym",
-            "b",
-            "blockquote",
-            "code",
-            "em",
-            "i",
-            "li",
-            "ol",
-            "pre",
-            "strong",
-            "ul",
-            "h1",
-            "h2",
-            "h3",
-            "p",
-        ]
-        # linkify during markdown trans, which is not supported by the later
-        target.body_html = bleach.linkify(
-            bleach.clean(
-                markdown(value, output_format="html"), tags=allowed_tags, strip=True
+        if defer_rendering(value):
+            # shown escaped until the worker has rendered it
+            target.body_html = None
+            target.render_pending = True
+        else:
+            target.body_html = render_body(value, "post")
+            target.render_pending = False
+
+    @staticmethod
+    def on_inserted(mapper, connection, target):
+        """fan out the new post into the timelines of the author's followers"""
+        search.index_body(connection, "posts", target.id, target.body)
+        update_counter(connection, User.__table__.c.post_count, target.author_id, 1)
+        follower_count = connection.execute(
+            db.select([User.follower_count]).where(User.id == target.author_id)
+        ).scalar()
+        if (
+            follower_count is not None
+            and follower_count > current_app.config["FLASKY_TIMELINE_FANOUT_LIMIT"]
+        ):
+            # one post must not turn into millions of writes
+            connection.execute(
+                User.__table__.update()
+                .where(User.id == target.author_id)
+                .values(celebrity=True)
+            )
+            return
+        connection.execute(
+            Timeline.__table__.insert().from_select(
+                ["user_id", "post_id", "timestamp"],
+                db.select([Follow.follower_id, Post.id, Post.timestamp])
+                .where(Follow.followed_id == Post.author_id)
+                .where(Post.id == target.id),
             )
         )
 
-    def to_json(self):
-        json_post = {
-            "url": url_for("api.get_post", id=self.id, _external=True),
-            "body": self.body,
-            "body_html": self.body_html,
-            "timestamp": self.timestamp,
-            "author": url_for("api.get_user", id=self.author_id, _external=True),
-            "comments": url_for("api.get_post_comments", id=self.id, _external=True),
-            "comment_count": self.comments.count(),
-        }
-        return json_post
+    @staticmethod
+    def on_updated(mapper, connection, target):
+        """replace the indexed body of an edited post"""
+        reindex_body(connection, "posts", target)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        search.unindex_body(connection, "posts", target.id, target.body)
+        update_counter(connection, User.__table__.c.post_count, target.author_id, -1)
+        connection.execute(
+            Timeline.__table__.delete().where(Timeline.post_id == target.id)
+        )
+
+    @staticmethod
+    def reconcile_counters(first_id, last_id):
+        """recount comment_count for posts with id in [first_id, last_id]"""
+        posts = Post.__table__
+        comments = Comment.__table__
+        db.session.execute(
+            posts.update()
+            .where(posts.c.id.between(first_id, last_id))
+            .values(
+                comment_count=db.select([db.func.count()])
+                .where(comments.c.post_id == posts.c.id)
+                .as_scalar()
+            )
+        )
+
+    def rendered_body(self):
+        """body_html, or the escaped body while rendering is pending"""
+        if self.body_html is None and self.body is not None:
+            return str(escape(self.body))
+        return self.body_html
+
+    json_fields = {
+        "url": (
+            ("id",),
+            lambda self: url_for("api.get_post", id=self.id, _external=True),
+        ),
+        "body": (("body",), lambda self: self.body),
+        "body_html": (("body", "body_html"), lambda self: self.rendered_body()),
+        "timestamp": (("timestamp",), lambda self: self.timestamp),
+        "author": (
+            ("author_id",),
+            lambda self: url_for("api.get_user", id=self.author_id, _external=True),
+        ),
+        "comments": (
+            ("id",),
+            lambda self: url_for("api.get_post_comments", id=self.id, _external=True),
+        ),
+        "comment_count": (("comment_count",), lambda self: self.comment_count),
+    }
+
+    def to_json(self, fields=None):
+        return to_json(self, fields)
 
     @staticmethod
     def from_json(json_post):
@@ -394,39 +833,83 @@ class Post(db.Model):
 
 
 # execute Post.on_change_body() func once new value is set for Post.body
-db.event.listen(Post.body, "set", Post.on_changed_body)
+# active_history loads the old body, which the search index needs to drop it
+db.event.listen(Post.body, "set", Post.on_changed_body, active_history=True)
+# keep the materialized timeline in sync with posts and follows
+db.event.listen(Post, "after_insert", Post.on_inserted)
+db.event.listen(Post, "after_update", Post.on_updated)
+db.event.listen(Post, "after_delete", Post.on_deleted)
+db.event.listen(Follow, "after_insert", Follow.on_inserted)
+db.event.listen(Follow, "after_delete", Follow.on_deleted)
 
 
 class Comment(db.Model):
     __tablename__ = "comments"
+    # the comments of a post in page order, also in (timestamp, id) cursor order
+    __table_args__ = (
+        db.Index("ix_comments_post_id_timestamp", "post_id", "timestamp", "id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     body_html = db.Column(db.Text)
+    render_pending = db.Column(db.Boolean, default=False, index=True)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     disabled = db.Column(db.Boolean, default=False)
     author_id = db.Column(db.Integer, db.ForeignKey("users.id"))
     post_id = db.Column(db.Integer, db.ForeignKey("posts.id"))
+    updated_at = db.Column(
+        db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
 
     @staticmethod
     def on_changed_body(target, value, oldvalue, initiator):
         """markdown text --> html"""
-        allowed_tags = ["a", "abbr", "acronym", "b", "code", "em", "i", "strong"]
-        target.body_html = bleach.linkify(
-            bleach.clean(
-                markdown(value, output_format="html"), tags=allowed_tags, strip=True
-            )
-        )
+        if defer_rendering(value):
+            # shown escaped until the worker has rendered it
+            target.body_html = None
+            target.render_pending = True
+        else:
+            target.body_html = render_body(value, "comment")
+            target.render_pending = False
 
-    def to_json(self):
-        json_comment = {
-            "url": url_for("api.get_comment", id=self.id, _external=True),
-            "post": url_for("api.get_post", id=self.post_id, _external=True),
-            "body": self.body,
-            "body_html": self.body_html,
-            "timestamp": self.timestamp,
-            "author": url_for("api.get_user", id=self.author_id, _external=True),
-        }
-        return json_comment
+    @staticmethod
+    def on_inserted(mapper, connection, target):
+        search.index_body(connection, "comments", target.id, target.body)
+        update_counter(connection, Post.__table__.c.comment_count, target.post_id, 1)
+        update_counter(connection, User.__table__.c.comment_count, target.author_id, 1)
+
+    @staticmethod
+    def on_updated(mapper, connection, target):
+        reindex_body(connection, "comments", target)
+
+    @staticmethod
+    def on_deleted(mapper, connection, target):
+        search.unindex_body(connection, "comments", target.id, target.body)
+        update_counter(connection, Post.__table__.c.comment_count, target.post_id, -1)
+        update_counter(connection, User.__table__.c.comment_count, target.author_id, -1)
+
+    rendered_body = Post.rendered_body
+
+    json_fields = {
+        "url": (
+            ("id",),
+            lambda self: url_for("api.get_comment", id=self.id, _external=True),
+        ),
+        "post": (
+            ("post_id",),
+            lambda self: url_for("api.get_post", id=self.post_id, _external=True),
+        ),
+        "body": (("body",), lambda self: self.body),
+        "body_html": (("body", "body_html"), lambda self: self.rendered_body()),
+        "timestamp": (("timestamp",), lambda self: self.timestamp),
+        "author": (
+            ("author_id",),
+            lambda self: url_for("api.get_user", id=self.author_id, _external=True),
+        ),
+    }
+
+    def to_json(self, fields=None):
+        return to_json(self, fields)
 
     @staticmethod
     def from_json(json_comment):
@@ -437,4 +920,49 @@ class Comment(db.Model):
         return Comment(body=body)
 
 
-db.event.listen(Comment.body, "set", Comment.on_changed_body)
+db.event.listen(Comment.body, "set", Comment.on_changed_body, active_history=True)
+db.event.listen(Comment, "after_insert", Comment.on_inserted)
+db.event.listen(Comment, "after_update", Comment.on_updated)
+db.event.listen(Comment, "after_delete", Comment.on_deleted)
+# full-text indexes of the bodies, on SQLite only
+search.create_fts(db.metadata)
+
+
+class Backfill(db.Model):
+    """
+    Progress of a data backfill run by 'flask deploy', see app/backfills.py.
+    A completed one is never run again.
+    """
+
+    __tablename__ = "backfills"
+    name = db.Column(db.String(64), primary_key=True)
+    last_id = db.Column(db.Integer, default=0, nullable=False)
+    completed_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<Backfill %r>" % self.name
+
+
+class OutboxMessage(db.Model):
+    """
+    Durable outbox for emails. send_email() only inserts a row here, delivery
+    happens later in app.email.deliver_outbox() so queued mail survives
+    restarts and can be retried.
+    """
+
+    __tablename__ = "outbox"
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(256))
+    sender = db.Column(db.String(128))
+    recipients = db.Column(db.Text)  # comma separated
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    # also used as a lease while a worker is sending the message
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    attempts = db.Column(db.Integer, default=0)
+    sent_at = db.Column(db.DateTime, index=True)
+    last_error = db.Column(db.Text)
+
+    def __repr__(self):
+        return "<OutboxMessage %r>" % self.id
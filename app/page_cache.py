@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import os
+import pickle
+import time
+from functools import wraps
+from flask import current_app, request, session, has_app_context
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from .cache import TTLCache, atomic_write
+
+
+class MemoryBackend:
+    """per-worker LRU, invalidations are only seen by the same worker"""
+
+    def __init__(self, app):
+        self._cache = TTLCache(maxsize=app.config["FLASKY_PAGE_CACHE_SIZE"])
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        self._cache.set(key, value, ttl)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class FileSystemBackend:
+    """shared by every worker on the host through a cache directory"""
+
+    def __init__(self, app):
+        self.path = app.config["FLASKY_PAGE_CACHE_DIR"]
+        os.makedirs(self.path, exist_ok=True)
+
+    def _filename(self, key):
+        return os.path.join(
+            self.path, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".page"
+        )
+
+    def get(self, key):
+        try:
+            with open(self._filename(key), "rb") as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.PickleError):
+            return None
+        if expires < time.time():
+            return None
+        return value
+
+    def set(self, key, value, ttl):
+        atomic_write(self._filename(key), pickle.dumps((time.time() + ttl, value)))
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith(".page"):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+
+backends = {"memory": MemoryBackend, "filesystem": FileSystemBackend}
+
+
+class PageCache:
+    """
+    Full-page cache for anonymous visitors. The rendered page is identical
+    for every anonymous visitor, so views decorated with @page_cache.cached
+    store it keyed by (endpoint, view args, query args). Any committed change
+    of a Post, Comment, User or Follow clears the cache.
+    """
+
+    def __init__(self, app=None):
+        event.listen(Session, "after_flush", self.on_after_flush)
+        event.listen(Session, "after_commit", self.on_after_commit)
+        event.listen(Session, "after_rollback", self.on_after_rollback)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        backend = app.config["FLASKY_PAGE_CACHE"]
+        app.extensions["page_cache"] = backends[backend](app) if backend else None
+
+    @property
+    def backend(self):
+        return current_app.extensions.get("page_cache")
+
+    def invalidate(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    @staticmethod
+    def cacheable():
+        return (
+            request.method == "GET"
+            and current_user.is_anonymous
+            and not session.get("_flashes")
+        )
+
+    @staticmethod
+    def key():
+        return "%s|%s|%s" % (
+            request.endpoint,
+            sorted(request.view_args.items()),
+            sorted(request.args.items(multi=True)),
+        )
+
+    def cached(self, f):
+        @wraps(f)
+        def decorated_function(*args, **kw):
+            backend = self.backend
+            ttl = current_app.config["FLASKY_PAGE_CACHE_TTL"]
+            if not self.cacheable():
+                response = current_app.make_response(f(*args, **kw))
+                response.headers.setdefault("Cache-Control", "private, no-cache")
+                return response
+            if backend is not None:
+                hit = backend.get(self.key())
+                if hit is not None:
+                    status, headers, body = hit
+                    response = current_app.response_class(
+                        body, status=status, headers=headers
+                    )
+                    response.headers["X-Cache"] = "HIT"
+                    return response
+            response = current_app.make_response(f(*args, **kw))
+            if response.status_code == 200 and "Set-Cookie" not in response.headers:
+                # nginx may microcache these for anonymous visitors as well
+                response.headers["Cache-Control"] = "public, max-age=%d" % ttl
+                if backend is not None:
+                    backend.set(
+                        self.key(),
+                        (
+                            response.status_code,
+                            list(response.headers.items()),
+                            response.get_data(),
+                        ),
+                        ttl,
+                    )
+                    response.headers["X-Cache"] = "MISS"
+            return response
+
+        return decorated_function
+
+    def on_after_flush(self, session, flush_context):
+        from .models import User, Post, Comment, Follow
+
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(instance, (User, Post, Comment, Follow)):
+                session.info["page_cache_stale"] = True
+                return
+
+    def on_after_commit(self, session):
+        # only after the commit, or a request could cache the old data again
+        if session.info.pop("page_cache_stale", False) and has_app_context():
+            self.invalidate()
+
+    def on_after_rollback(self, session):
+        session.info.pop("page_cache_stale", None)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+
+from itertools import chain
+from sqlalchemy import func
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:  # only the offline job needs them, requirements/recommend.txt
+    np = sparse = None
+
+
+def available():
+    return np is not None and sparse is not None
+
+
+def load_matrix(connection, batch_size=100000):
+    """
+    The follow graph as a CSR matrix A with A[u, v] = 1 if u follows v,
+    self-follows left out. Rows are read in batches into int32 arrays, so
+    the Python objects of only one batch exist at a time.
+    """
+    from .models import Follow, User
+
+    follows = Follow.__table__
+    result = connection.execution_options(stream_results=True).execute(
+        follows.select()
+        .with_only_columns([follows.c.follower_id, follows.c.followed_id])
+        .where(follows.c.follower_id != follows.c.followed_id)
+    )
+    batches = []
+    while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+            break
+        # fromiter over the flat values, np.array() is slow on result rows
+        batches.append(
+            np.fromiter(
+                chain.from_iterable(rows), dtype=np.int32, count=2 * len(rows)
+            ).reshape(-1, 2)
+        )
+    edges = np.concatenate(batches) if batches else np.empty((0, 2), dtype=np.int32)
+    n = (
+        connection.execute(
+            User.__table__.select().with_only_columns([func.max(User.__table__.c.id)])
+        ).scalar()
+        or 0
+    ) + 1
+    return sparse.csr_matrix(
+        (np.ones(len(edges), dtype=np.float32), (edges[:, 0], edges[:, 1])),
+        shape=(n, n),
+    )
+
+
+def matrix_bytes(matrix):
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def chunks(matrix, max_nnz):
+    """
+    Row ranges [start, end) whose friends-of-friends product has at most
+    max_nnz entries. The entries of row u are bounded by the sum of the out
+    degrees of the users u follows, a single row over the bound is a chunk
+    of its own.
+    """
+    out_degree = np.diff(matrix.indptr).astype(np.float64)
+    work = np.cumsum(matrix @ out_degree)
+    n = matrix.shape[0]
+    start = 0
+    while start < n:
+        done = work[start - 1] if start else 0.0
+        end = int(np.searchsorted(work, done + max_nnz, side="right"))
+        end = min(max(end, start + 1), n)
+        yield start, end
+        start = end
+
+
+def suggest(matrix, top_k=10, max_nnz=5000000):
+    """
+    Friends-of-friends scores in chunks of rows: (A[start:end] @ A)[u, v] is
+    the number of users followed by u who follow v. Users u already follows
+    and u itself are dropped, the top_k by score (then id) are kept.
+    Yield (start, end, [(user_id, rank, suggested_id, score), ...]) per chunk.
+    """
+    for start, end in chunks(matrix, max_nnz):
+        block = matrix[start:end]
+        scores = (block @ matrix).tocsr()
+        # drop followed users and the diagonal
+        known = block + sparse.csr_matrix(
+            (
+                np.ones(end - start, dtype=np.float32),
+                (np.arange(end - start), np.arange(start, end)),
+            ),
+            shape=block.shape,
+        )
+        scores = scores - scores.multiply(known > 0)
+        scores.eliminate_zeros()
+        rows = []
+        for i in range(end - start):
+            lo, hi = scores.indptr[i], scores.indptr[i + 1]
+            if lo == hi:
+                continue
+            data, ids = scores.data[lo:hi], scores.indices[lo:hi]
+            top = np.argpartition(-data, top_k)[:top_k] if hi - lo > top_k else None
+            if top is not None:
+                data, ids = data[top], ids[top]
+            order = np.lexsort((ids, -data))
+            rows.extend(
+                (start + i, rank, int(ids[j]), float(data[j]))
+                for rank, j in enumerate(order, 1)
+            )
+        yield start, end, rows
+
+
+def write_suggestions(connection, start, end, rows):
+    """replace the suggestions of users in [start, end) in one transaction"""
+    from .models import FollowSuggestion
+
+    suggestions = FollowSuggestion.__table__
+    with connection.begin():
+        connection.execute(
+            suggestions.delete().where(suggestions.c.user_id.between(start, end - 1))
+        )
+        if rows:
+            connection.execute(
+                suggestions.insert(),
+                [
+                    {"user_id": u, "rank": r, "suggested_id": s, "score": score}
+                    for u, r, s, score in rows
+                ],
+            )
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app
+import bleach
+import markdown as markdown_module
+from markdown import markdown
+from bleach.linkifier import Linker
+from bleach.sanitizer import ALLOWED_ATTRIBUTES, ALLOWED_PROTOCOLS, Cleaner
+from .cache import TTLCache, atomic_write
+from .drain import BoundedDrain
+
+# sanitizer profile -> tags kept in the rendered html
+allowed_tags = {
+    "post": [
+        "a",
+        "abbr",
+        "acronym",
+        "b",
+        "blockquote",
+        "code",
+        "em",
+        "i",
+        "li",
+        "ol",
+        "pre",
+        "strong",
+        "ul",
+        "h1",
+        "h2",
+        "h3",
+        "p",
+    ],
+    "comment": ["a", "abbr", "acronym", "b", "code", "em", "i", "strong"],
+}
+
+
+# Cleaner and Linker are not thread safe, build them once per thread
+_sanitizers = threading.local()
+
+
+def sanitizer(profile):
+    """prebuilt (Cleaner, Linker) of a profile for the current thread"""
+    built = _sanitizers.__dict__.get(profile)
+    if built is None:
+        built = (Cleaner(tags=allowed_tags[profile], strip=True), Linker())
+        setattr(_sanitizers, profile, built)
+    return built
+
+
+def fingerprint(profile):
+    """
+    what the html of a profile depends on besides the body: the sanitizer
+    settings and the library versions
+    """
+    settings = json.dumps(
+        [
+            markdown_module.__version__,
+            bleach.__version__,
+            allowed_tags[profile],
+            ALLOWED_ATTRIBUTES,
+            ALLOWED_PROTOCOLS,
+        ],
+        sort_keys=True,
+    )
+    return hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
+
+
+def render(body, profile):
+    """transform markdown text into sanitized html text, without the cache"""
+    cleaner, linker = sanitizer(profile)
+    # linkify during markdown trans, which is not supported by the later
+    return linker.linkify(cleaner.clean(markdown(body, output_format="html")))
+
+
+class RenderCache:
+    """
+    Memoized rendering keyed by (profile, fingerprint of the profile, sha256
+    of the markdown), so the many identical short bodies are rendered once,
+    while a changed whitelist or library upgrade misses the old entries. A
+    bounded LRU per process, optionally backed by a directory of rendered
+    files that survives restarts and is shared with other processes, e.g. the
+    workers of 'flask rerender'.
+    """
+
+    def __init__(self, app=None):
+        self.memory = TTLCache(maxsize=10000, ttl=float("inf"))
+        self.path = None
+        self.disk_hits = 0
+        self.fingerprints = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.memory = TTLCache(
+            maxsize=app.config["FLASKY_RENDER_CACHE_SIZE"], ttl=float("inf")
+        )
+        self.path = app.config["FLASKY_RENDER_CACHE_DIR"]
+        self.fingerprints = {}
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+
+    def key(self, body, profile):
+        settings = self.fingerprints.get(profile)
+        if settings is None:
+            settings = self.fingerprints[profile] = fingerprint(profile)
+        return "%s-%s-%s" % (
+            profile,
+            settings,
+            hashlib.sha256(body.encode("utf-8")).hexdigest(),
+        )
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + ".html")
+
+    def _load(self, key):
+        try:
+            with open(self._filename(key), encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _store(self, key, html):
+        atomic_write(self._filename(key), html)
+
+    def render(self, body, profile):
+        key = self.key(body, profile)
+        html = self.memory.get(key)
+        if html is not None:
+            return html
+        if self.path:
+            html = self._load(key)
+            if html is not None:
+                self.disk_hits += 1
+        if html is None:
+            html = render(body, profile)
+            if self.path:
+                self._store(key, html)
+        self.memory.set(key, html)
+        return html
+
+    def clear(self):
+        self.memory.clear()
+        if self.path:
+            for name in os.listdir(self.path):
+                if name.endswith(".html"):
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except OSError:
+                        pass
+
+    def stats(self):
+        stats = self.memory.stats()
+        lookups = stats["hits"] + stats["misses"]
+        stats["disk_hits"] = self.disk_hits
+        stats["hit_rate"] = (
+            (stats["hits"] + self.disk_hits) / lookups if lookups else 0.0
+        )
+        return stats
+
+
+def render_body(body, profile):
+    """transform markdown text into sanitized html text, memoized"""
+    from . import render_cache
+
+    return render_cache.render(body, profile)
+
+
+def defer_rendering(body):
+    """whether a new body is committed raw and rendered in the background"""
+    config = current_app.config
+    return (
+        body is not None
+        and config["FLASKY_RENDER_ASYNC"]
+        and len(body) >= config["FLASKY_RENDER_ASYNC_MIN_LENGTH"]
+    )
+
+
+def render_pending(limit=100):
+    """
+    Render up to limit deferred bodies of posts and of comments, return the
+    number of rows found. A row is only written if its body is still the one
+    that was rendered, a newer edit stays pending for the next batch.
+    """
+    from . import db, page_cache
+    from .models import Post, Comment
+
+    found = 0
+    for table, profile in ((Post.__table__, "post"), (Comment.__table__, "comment")):
+        rows = db.session.execute(
+            db.select([table.c.id, table.c.body])
+            .where(table.c.render_pending == True)
+            .order_by(table.c.id)
+            .limit(limit)
+        ).fetchall()
+        if not rows:
+            continue
+        db.session.execute(
+            table.update()
+            .where(table.c.id == db.bindparam("_id"))
+            .where(table.c.body == db.bindparam("_body"))
+            .values(body_html=db.bindparam("_html"), render_pending=False),
+            [
+                {"_id": id, "_body": body, "_html": render_body(body, profile)}
+                for id, body in rows
+            ],
+        )
+        found += len(rows)
+    db.session.commit()
+    if found:
+        # cached pages still show the escaped bodies
+        page_cache.invalidate()
+    return found
+
+
+class DeferredRendering(BoundedDrain):
+    """
+    Render deferred bodies on a bounded in-process thread pool of
+    FLASKY_RENDER_POOL_SIZE workers, after the commit that stored them and
+    every FLASKY_RENDER_POLL_INTERVAL seconds, which picks up rows left
+    pending by a stopped process. 'flask rerender --pending' does the same
+    from the command line.
+    """
+
+    def __init__(self):
+        super().__init__(
+            "render", "FLASKY_RENDER_POOL_SIZE", "FLASKY_RENDER_POLL_INTERVAL"
+        )
+
+    def work(self):
+        return render_pending()
+
+    def wanted(self, instance):
+        from .models import Post, Comment
+
+        return isinstance(instance, (Post, Comment)) and instance.render_pending
+
+
+def render_rows(rows, profile):
+    """render a chunk of (id, body) rows, run in the worker processes"""
+    return [
+        (id, body, render_body(body, profile) if body is not None else None)
+        for id, body in rows
+    ]
+
+
+def load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_checkpoint(path, checkpoint):
+    atomic_write(path, json.dumps(checkpoint))
+
+
+def rerender(table, profile, chunk_size=1000, workers=None, checkpoint_path=None):
+    """
+    Regenerate body_html of every row of table. Rows are streamed in primary
+    key chunks, rendered on a process pool and written back with one
+    executemany UPDATE per chunk. A row is only written if its body is
+    still the one that was rendered, an edit made meanwhile keeps its own
+    html. The last written id is kept in the checkpoint file, so an
+    interrupted run resumes where it stopped. Yield (rows done, rows per
+    second) after every chunk.
+    """
+    from . import db
+
+    checkpoint = load_checkpoint(checkpoint_path) if checkpoint_path else {}
+    last_id = checkpoint.get(table.name, 0)
+    select = (
+        db.select([table.c.id, table.c.body]).order_by(table.c.id).limit(chunk_size)
+    )
+    update = (
+        table.update()
+        .where(table.c.id == db.bindparam("_id"))
+        .where(table.c.body.isnot_distinct_from(db.bindparam("_body")))
+        .values(body_html=db.bindparam("_html"))
+    )
+
+    def chunks():
+        nonlocal last_id
+        while True:
+            rows = db.session.execute(select.where(table.c.id > last_id)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            yield [tuple(row) for row in rows]
+
+    def write(rendered):
+        db.session.execute(
+            update,
+            [{"_id": id, "_body": body, "_html": html} for id, body, html in rendered],
+        )
+        db.session.commit()
+        if checkpoint_path:
+            checkpoint[table.name] = rendered[-1][0]
+            save_checkpoint(checkpoint_path, checkpoint)
+
+    done = 0
+    started = time.perf_counter()
+    if workers == 1:
+        for rows in chunks():
+            write(render_rows(rows, profile))
+            done += len(rows)
+            yield done, done / (time.perf_counter() - started)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        limit = (workers or os.cpu_count() or 1) * 2
+        for rows in chunks():
+            pending.append(pool.submit(render_rows, rows, profile))
+            # write in submission order, so the checkpoint only moves forward
+            while len(pending) >= limit or (pending and pending[0].done()):
+                rendered = pending.popleft().result()
+                write(rendered)
+                done += len(rendered)
+                yield done, done / (time.perf_counter() - started)
+        while pending:
+            rendered = pending.popleft().result()
+            write(rendered)
+            done += len(rendered)
+            yield done, done / (time.perf_counter() - started)
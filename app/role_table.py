@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import time
+from collections import namedtuple
+from types import MappingProxyType
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+RoleRow = namedtuple("RoleRow", "id name permissions default")
+
+
+class Roles:
+    """an immutable copy of the roles table, by id and by name"""
+
+    def __init__(self, rows):
+        self.by_id = MappingProxyType({row.id: row for row in rows})
+        self.by_name = MappingProxyType({row.name: row for row in rows})
+        self.default = next((row for row in rows if row.default), None)
+        self.loaded_at = time.monotonic()
+
+    def permissions(self, role_id):
+        row = self.by_id.get(role_id)
+        return (row.permissions or 0) if row is not None else 0
+
+
+class RoleTable:
+    """
+    Per-worker copy of the roles table, so that permission checks, new users
+    and the role choices of the admin form don't query it. Loaded on first
+    use and dropped whenever a session of this worker writes a role, and on
+    commit or rollback of that session. Role edits not flushed yet are
+    flushed before a load, as a query would autoflush them. Other workers'
+    changes are seen after FLASKY_ROLE_TABLE_TTL seconds.
+    """
+
+    def __init__(self, app=None):
+        event.listen(Session, "after_commit", self.on_after_end)
+        event.listen(Session, "after_rollback", self.on_after_end)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        # {"roles": Roles} once loaded
+        app.extensions["role_table"] = {}
+
+    @staticmethod
+    def read(connection):
+        from .models import Role
+
+        roles = Role.__table__
+        c = roles.c
+        return Roles(
+            [
+                RoleRow(*row)
+                for row in connection.execute(
+                    roles.select()
+                    .with_only_columns([c.id, c.name, c.permissions, c.default])
+                    .order_by(c.name)
+                )
+            ]
+        )
+
+    def get(self):
+        """the Roles of the current app, loaded through db.session if needed"""
+        from . import db
+
+        session = db.session()
+        if session.autoflush and session.info.pop("roles_edited", False):
+            session.flush()
+        state = current_app.extensions["role_table"]
+        roles = state.get("roles")
+        ttl = current_app.config["FLASKY_ROLE_TABLE_TTL"]
+        if roles is None or time.monotonic() - roles.loaded_at >= ttl:
+            roles = state["roles"] = self.read(db.session.connection())
+        return roles
+
+    def permissions(self, role_id):
+        return self.get().permissions(role_id)
+
+    def invalidate(self):
+        if has_app_context():
+            current_app.extensions["role_table"].pop("roles", None)
+
+    def on_role_changed(self, mapper, connection, target):
+        self.invalidate()
+        # loads before the end of the transaction may have seen the change,
+        # drop them again once it is committed or rolled back
+        session = object_session(target)
+        if session is not None:
+            session.info["roles_changed"] = True
+
+    def on_role_edited(self, target, value, oldvalue, initiator):
+        session = object_session(target)
+        if session is not None:
+            session.info["roles_edited"] = True
+
+    def on_after_end(self, session):
+        session.info.pop("roles_edited", None)
+        if session.info.pop("roles_changed", False):
+            self.invalidate()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import base64
+import json
+from collections import namedtuple
+from flask import current_app, request, url_for
+from markupsafe import escape
+from sqlalchemy import DDL, event, text
+from .exceptions import ValidationError
+
+# FTS5 index over the body of each table, external content: the text itself
+# stays in posts and comments, the index only holds the tokens
+fts_tables = {"posts": "posts_fts", "comments": "comments_fts"}
+
+# snippet() markers, replaced by <mark> after the snippet is escaped
+_open, _close = "\x02", "\x03"
+
+SearchHit = namedtuple("SearchHit", "kind id post_id rank snippet")
+
+
+def fts_enabled(bind):
+    return bind.dialect.name == "sqlite"
+
+
+def create_fts(metadata):
+    """create the FTS5 tables along with the others on SQLite"""
+    for table, fts in fts_tables.items():
+        event.listen(
+            metadata,
+            "after_create",
+            DDL(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5"
+                "(body, content='%s', content_rowid='id')" % (fts, table)
+            ).execute_if(dialect="sqlite"),
+        )
+        event.listen(
+            metadata,
+            "before_drop",
+            DDL("DROP TABLE IF EXISTS %s" % fts).execute_if(dialect="sqlite"),
+        )
+
+
+def index_body(connection, table, id, body):
+    if body is not None and fts_enabled(connection):
+        connection.execute(
+            text("INSERT INTO %s(rowid, body) VALUES (:id, :body)" % fts_tables[table]),
+            id=id,
+            body=body,
+        )
+
+
+def unindex_body(connection, table, id, body):
+    # external content tables need the indexed text to remove its tokens
+    if body is not None and fts_enabled(connection):
+        fts = fts_tables[table]
+        connection.execute(
+            text(
+                "INSERT INTO %s(%s, rowid, body) VALUES ('delete', :id, :body)"
+                % (fts, fts)
+            ),
+            id=id,
+            body=body,
+        )
+
+
+def index_range(connection, table, first_id, last_id):
+    """index rows with id in [first_id, last_id] that were inserted in bulk"""
+    if fts_enabled(connection):
+        connection.execute(
+            text(
+                "INSERT INTO %s(rowid, body) SELECT id, body FROM %s "
+                "WHERE id BETWEEN :first AND :last AND body IS NOT NULL"
+                % (fts_tables[table], table)
+            ),
+            first=first_id,
+            last=last_id,
+        )
+
+
+def rebuild(connection):
+    """rebuild both indexes from the content tables in one pass each"""
+    for fts in fts_tables.values():
+        connection.execute(text("INSERT INTO %s(%s) VALUES ('rebuild')" % (fts, fts)))
+        connection.execute(text("INSERT INTO %s(%s) VALUES ('optimize')" % (fts, fts)))
+
+
+def match_query(q):
+    """every word of the user's query as a quoted FTS5 term, all required"""
+    terms = ['"%s"' % term.replace('"', '""') for term in q.split()]
+    return " ".join(terms)
+
+
+def encode_cursor(hit, floors):
+    data = json.dumps([hit.rank, hit.kind, hit.id, floors])
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("utf-8")
+
+
+def decode_cursor(cursor):
+    try:
+        rank, kind, id, floors = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("utf-8")).decode("utf-8")
+        )
+        rank, id, floors = float(rank), int(id), [int(floor) for floor in floors]
+    except (ValueError, TypeError):
+        raise ValidationError("invalid cursor")
+    if kind not in ("comment", "post") or len(floors) != 2:
+        raise ValidationError("invalid cursor")
+    return (rank, kind, id), floors
+
+
+# bm25() has to be computed for every match before the best can be picked, so
+# a common term is only ranked among its newest matches: rowid >= floor
+_floor = """
+SELECT rowid FROM %(fts)s WHERE %(fts)s MATCH :q
+ORDER BY rowid DESC LIMIT 1 OFFSET :candidates
+"""
+
+# bm25() is lower for better matches, ties are broken by (kind, id)
+_ranked = """
+SELECT kind, id, post_id, rank FROM (
+    SELECT 'post' AS kind, posts_fts.rowid AS id, posts_fts.rowid AS post_id,
+           bm25(posts_fts) AS rank
+    FROM posts_fts WHERE posts_fts MATCH :q AND posts_fts.rowid >= :post_floor
+    UNION ALL
+    SELECT 'comment', comments.id, comments.post_id, bm25(comments_fts)
+    FROM comments_fts JOIN comments ON comments.id = comments_fts.rowid
+    WHERE comments_fts MATCH :q AND comments_fts.rowid >= :comment_floor
+    AND NOT coalesce(comments.disabled, 0)
+)
+WHERE (rank, kind, id) > (:rank, :kind, :id)
+ORDER BY rank, kind, id
+LIMIT :limit
+"""
+
+_snippets = """
+SELECT rowid, snippet(%(fts)s, 0, :open, :close, '...', 16) FROM %(fts)s
+WHERE %(fts)s MATCH :q AND rowid IN (%(ids)s)
+"""
+
+
+class SearchResults:
+    """
+    One page of ranked matches in posts and comments. Keyset pagination on
+    (rank, kind, id) like the API collections, and snippets are only built
+    for the rows of the page. Only the newest `candidates` matches of each
+    table are ranked, the cursor keeps that window fixed across pages.
+    """
+
+    def __init__(self, session, q, per_page, cursor=None, candidates=1000):
+        self.q = q
+        query = match_query(q)
+        if not query:
+            self.items, self.has_next = [], False
+            return
+        if cursor:
+            after, self.floors = decode_cursor(cursor)
+        else:
+            after = (float("-inf"), "", 0)
+            self.floors = [
+                session.execute(
+                    text(_floor % {"fts": fts_tables[table]}),
+                    {"q": query, "candidates": max(candidates - 1, 0)},
+                ).scalar()
+                or 0
+                for table in ("posts", "comments")
+            ]
+        rows = session.execute(
+            text(_ranked),
+            {
+                "q": query,
+                "post_floor": self.floors[0],
+                "comment_floor": self.floors[1],
+                "rank": after[0],
+                "kind": after[1],
+                "id": after[2],
+                "limit": per_page + 1,
+            },
+        ).fetchall()
+        self.has_next = len(rows) > per_page
+        rows = rows[:per_page]
+        snippets = {}
+        for kind, table in (("post", "posts"), ("comment", "comments")):
+            ids = [row.id for row in rows if row.kind == kind]
+            if not ids:
+                continue
+            sql = _snippets % {
+                "fts": fts_tables[table],
+                "ids": ", ".join(str(int(id)) for id in ids),
+            }
+            for id, snippet in session.execute(
+                text(sql), {"q": query, "open": _open, "close": _close}
+            ):
+                snippets[kind, id] = highlight(snippet)
+        self.items = [
+            SearchHit(
+                row.kind, row.id, row.post_id, row.rank, snippets[row.kind, row.id]
+            )
+            for row in rows
+        ]
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+        return encode_cursor(self.items[-1], self.floors)
+
+    def next_url(self, endpoint, **kw):
+        if self.next_cursor is None:
+            return None
+        return url_for(endpoint, q=self.q, cursor=self.next_cursor, **kw)
+
+
+def highlight(snippet):
+    """escape the user's text, then mark the matched terms"""
+    return str(escape(snippet)).replace(_open, "<mark>").replace(_close, "</mark>")
+
+
+def paginate_search(session, per_page):
+    """search with the q and cursor from request arguments"""
+    return SearchResults(
+        session,
+        request.args.get("q", ""),
+        per_page,
+        cursor=request.args.get("cursor"),
+        candidates=current_app.config["FLASKY_SEARCH_CANDIDATES"],
+    )
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+"""
+Repeatable benchmarks of the hot endpoints: seed a deterministic dataset
+into the benchmark database, request every scenario and compare the
+latency percentiles and queries per request with a stored baseline.
+Run with 'flask bench', see 'flask bench --help'.
+"""
+
+from .dataset import Scale, seed
+from .runner import HTTPDriver, ClientDriver, compare, run, scenarios
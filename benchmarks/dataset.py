@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import random
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+from werkzeug.security import generate_password_hash
+from app import db
+from app.models import Role, User, Follow, Post, Comment, Timeline
+from app.rendering import rerender
+from app.search import fts_enabled, rebuild
+
+PASSWORD = "password"
+
+_words = (
+    "flask python sql index cache query page user post comment follow timeline "
+    "latency worker request response template render markdown token session "
+    "commit row table join scan sort limit offset cursor batch chunk pool thread "
+    "process memory disk network benchmark baseline regression percentile"
+).split()
+
+_start = datetime(2020, 1, 1)
+
+
+class Scale:
+    """size of a seeded dataset"""
+
+    def __init__(self, users=1000, posts=10000, comments=20000, follows=20, seed=1):
+        self.users = users
+        self.posts = posts
+        self.comments = comments
+        self.follows = follows  # per user, besides the self-follow
+        self.seed = seed
+
+    def to_json(self):
+        return dict(self.__dict__)
+
+
+def email(id):
+    return "user%d@example.com" % id
+
+
+def _body(rng, length):
+    words = rng.choices(_words, k=length)
+    # some markdown, so rendering is part of the cost
+    words[0] = "**%s**" % words[0]
+    return " ".join(words)
+
+
+def _insert(table, rows, batch_size=10000):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+    db.session.commit()
+
+
+def seed(scale, log=print):
+    """
+    Recreate the database with a deterministic dataset: the same scale and
+    seed give the same ids, bodies and follow graph. Popularity is skewed
+    like real traffic, a few users write most posts and get most follows.
+    Rows are written with executemany, the data maintained by the model
+    events (timeline, counters, html, search index) is built set-based after.
+    """
+    rng = random.Random(scale.seed)
+    started = time.perf_counter()
+    db.drop_all()
+    db.create_all()
+    Role.insert_roles()
+    role_id = Role.query.filter_by(default=True).first().id
+    password_hash = generate_password_hash(PASSWORD)
+    ids = range(1, scale.users + 1)
+    popularity = list(accumulate(1 / i**0.8 for i in ids))
+
+    _insert(
+        User.__table__,
+        (
+            {
+                "id": id,
+                "email": email(id),
+                "username": "user%d" % id,
+                "password_hash": password_hash,
+                "confirmed": True,
+                "role_id": role_id,
+                "name": "User %d" % id,
+                "member_since": _start,
+                "last_seen": _start,
+                "avatar_hash": hashlib.md5(email(id).encode("utf-8")).hexdigest(),
+                "celebrity": False,
+                "post_count": 0,
+                "comment_count": 0,
+                "follower_count": 0,
+                "followed_count": 0,
+            }
+            for id in ids
+        ),
+    )
+    log("users: %d" % scale.users)
+
+    def follows():
+        for id in ids:
+            followed = {id}
+            followed.update(
+                rng.choices(ids, cum_weights=popularity, k=min(scale.follows, len(ids)))
+            )
+            for followed_id in sorted(followed):
+                yield {
+                    "follower_id": id,
+                    "followed_id": followed_id,
+                    "timestamp": _start,
+                }
+
+    _insert(Follow.__table__, follows())
+    log("follows: %d" % Follow.query.count())
+
+    _insert(
+        Post.__table__,
+        (
+            {
+                "id": id,
+                "body": _body(rng, rng.randint(5, 60)),
+                "timestamp": _start + timedelta(minutes=id),
+                "author_id": rng.choices(ids, cum_weights=popularity)[0],
+                "comment_count": 0,
+                "render_pending": False,
+            }
+            for id in range(1, scale.posts + 1)
+        ),
+    )
+    log("posts: %d" % scale.posts)
+
+    _insert(
+        Comment.__table__,
+        (
+            (
+                {
+                    "id": id,
+                    "body": _body(rng, rng.randint(1, 20)),
+                    "timestamp": _start + timedelta(minutes=scale.posts + id),
+                    "disabled": False,
+                    "author_id": rng.randint(1, scale.users),
+                    "post_id": rng.randint(1, scale.posts),
+                    "render_pending": False,
+                }
+                for id in range(1, scale.comments + 1)
+            )
+            if scale.posts
+            else ()
+        ),
+    )
+    log("comments: %d" % scale.comments)
+
+    derive()
+    log("seeded in %.1fs" % (time.perf_counter() - started))
+
+
+def derive():
+    """what the model events keep up to date, for rows inserted in bulk"""
+    follows, posts = Follow.__table__, Post.__table__
+    db.session.execute(
+        Timeline.__table__.insert().from_select(
+            ["user_id", "post_id", "timestamp"],
+            db.select([follows.c.follower_id, posts.c.id, posts.c.timestamp]).where(
+                follows.c.followed_id == posts.c.author_id
+            ),
+        )
+    )
+    for model in (User, Post):
+        last_id = db.session.query(db.func.max(model.id)).scalar() or 0
+        model.reconcile_counters(1, last_id)
+    db.session.commit()
+    for table, profile in ((Post.__table__, "post"), (Comment.__table__, "comment")):
+        for _ in rerender(table, profile, chunk_size=5000):
+            pass
+    if fts_enabled(db.engine):
+        with db.engine.begin() as connection:
+            rebuild(connection)
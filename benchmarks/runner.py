@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+import json
+import math
+import re
+import resource
+import time
+from types import SimpleNamespace
+from base64 import b64encode
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from .dataset import PASSWORD, email
+
+_queries = re.compile(r'desc="(\d+) queries"')
+
+
+class Scenario:
+    """
+    One endpoint, requested with path(dataset, i) for the i-th request.
+    dataset has the attributes of the Scale and own_post, the id of a post
+    written by the user of the API token.
+    """
+
+    def __init__(self, name, path, method="GET", body=None, auth=False):
+        self.name = name
+        self.path = path
+        self.method = method
+        self.body = body
+        self.auth = auth
+
+
+def _post(scale, i):
+    return 1 + i * 7919 % max(scale.posts, 1)
+
+
+def _user(scale, i):
+    return 1 + i * 104729 % scale.users
+
+
+scenarios = [
+    Scenario("main.index", lambda s, i: "/"),
+    Scenario("main.index?page", lambda s, i: "/?page=%d" % (2 + i % 50)),
+    Scenario("main.user", lambda s, i: "/user/user%d" % _user(s, i)),
+    Scenario("main.post", lambda s, i: "/post/%d" % _post(s, i)),
+    Scenario("main.followers", lambda s, i: "/followers/user%d" % _user(s, i)),
+    Scenario("main.search", lambda s, i: "/search?q=cache"),
+    Scenario("api.get_posts", lambda s, i: "/api/v1.0/posts/", auth=True),
+    Scenario(
+        "api.get_post", lambda s, i: "/api/v1.0/posts/%d" % _post(s, i), auth=True
+    ),
+    Scenario(
+        "api.get_post_comments",
+        lambda s, i: "/api/v1.0/posts/%d/comments/" % _post(s, i),
+        auth=True,
+    ),
+    Scenario("api.get_comments", lambda s, i: "/api/v1.0/comments/", auth=True),
+    Scenario(
+        "api.get_comment",
+        lambda s, i: "/api/v1.0/comments/%d" % (1 + i % max(s.comments, 1)),
+        auth=True,
+    ),
+    Scenario(
+        "api.get_user", lambda s, i: "/api/v1.0/users/%d" % _user(s, i), auth=True
+    ),
+    Scenario(
+        "api.get_user_posts",
+        lambda s, i: "/api/v1.0/users/%d/posts/" % _user(s, i),
+        auth=True,
+    ),
+    Scenario(
+        "api.get_user_followed_posts",
+        lambda s, i: "/api/v1.0/users/%d/timeline/" % _user(s, i),
+        auth=True,
+    ),
+    Scenario(
+        "api.get_user_suggestions",
+        lambda s, i: "/api/v1.0/users/%d/suggestions/" % _user(s, i),
+        auth=True,
+    ),
+    Scenario("api.search", lambda s, i: "/api/v1.0/search/?q=cache", auth=True),
+    Scenario(
+        "api.new_post",
+        lambda s, i: "/api/v1.0/posts/",
+        method="POST",
+        body=lambda s, i: {"body": "benchmark post %d" % i},
+        auth=True,
+    ),
+    Scenario(
+        "api.edit_post",
+        lambda s, i: "/api/v1.0/posts/%d" % s.own_post,
+        method="PUT",
+        body=lambda s, i: {"body": "edited %d times" % i},
+        auth=True,
+    ),
+    Scenario(
+        "api.new_post_comment",
+        lambda s, i: "/api/v1.0/posts/%d/comments/" % _post(s, i),
+        method="POST",
+        body=lambda s, i: {"body": "benchmark comment %d" % i},
+        auth=True,
+    ),
+]
+
+
+class ClientDriver:
+    """requests through the app's test client, in this process"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, headers, body):
+        response = self.client.open(
+            path,
+            method=method,
+            headers=headers,
+            data=json.dumps(body) if body is not None else None,
+        )
+        return (
+            response.status_code,
+            response.headers.get("Server-Timing", ""),
+            response.get_data(as_text=True),
+        )
+
+
+class HTTPDriver:
+    """requests to a running server, e.g. gunicorn with FLASK_CONFIG=benchmark"""
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def request(self, method, path, headers, body):
+        request = Request(
+            self.url + path,
+            data=json.dumps(body).encode("utf-8") if body is not None else None,
+            headers=headers,
+            method=method,
+        )
+        try:
+            with urlopen(request) as response:
+                status, read = response.status, response.read()
+                timing = response.headers.get("Server-Timing", "")
+        except HTTPError as e:
+            status, read, timing = e.code, e.read(), e.headers.get("Server-Timing", "")
+        return status, timing, read.decode("utf-8")
+
+
+def percentile(sorted_values, p):
+    """nearest-rank percentile"""
+    if not sorted_values:
+        return 0.0
+    k = max(math.ceil(p / 100.0 * len(sorted_values)) - 1, 0)
+    return sorted_values[k]
+
+
+def rss_mb():
+    """current resident set size of this process, peak size if unknown"""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() / 2**20
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _token(driver):
+    credentials = b64encode(("%s:%s" % (email(1), PASSWORD)).encode("utf-8"))
+    status, _, body = driver.request(
+        "POST",
+        "/api/v1.0/tokens/",
+        {"Authorization": "Basic " + credentials.decode("utf-8")},
+        None,
+    )
+    if status != 200:
+        raise RuntimeError("could not get an API token: %d %s" % (status, body))
+    return json.loads(body)["token"]
+
+
+def run(driver, scale, requests=200, warmup=20, only=None, log=print):
+    """
+    Request every scenario warmup + requests times, return
+    {name: {"p50", "p95", "p99" (ms), "rps", "queries", "rss_mb", "errors"}}.
+    Queries per request are read from the Server-Timing header.
+    """
+    token = _token(driver)
+    api_headers = {
+        "Authorization": "Basic "
+        + b64encode((token + ":").encode("utf-8")).decode("utf-8"),
+        "Accept": "application/json",
+        "Content-Type": "application/json",
+    }
+    # the post edited by api.edit_post, written by the user of the token
+    status, _, body = driver.request(
+        "POST", "/api/v1.0/posts/", api_headers, {"body": "benchmark post"}
+    )
+    if status != 201:
+        raise RuntimeError("could not write a post: %d %s" % (status, body))
+    own_post = int(json.loads(body)["url"].rstrip("/").rsplit("/", 1)[1])
+    dataset = SimpleNamespace(own_post=own_post, **scale.to_json())
+    results = {}
+    for scenario in scenarios:
+        if only and not any(name in scenario.name for name in only):
+            continue
+        headers = api_headers if scenario.auth else {}
+        latencies, queries, errors = [], 0, 0
+        started = None
+        for i in range(warmup + requests):
+            if i == warmup:
+                started = time.perf_counter()
+            body = scenario.body(dataset, i) if scenario.body else None
+            t = time.perf_counter()
+            status, timing, _ = driver.request(
+                scenario.method, scenario.path(dataset, i), headers, body
+            )
+            elapsed = time.perf_counter() - t
+            if i < warmup:
+                continue
+            latencies.append(elapsed * 1000)
+            if status >= 400:
+                errors += 1
+            match = _queries.search(timing)
+            if match:
+                queries += int(match.group(1))
+        total = time.perf_counter() - started if started else 0.0
+        latencies.sort()
+        results[scenario.name] = {
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "rps": round(requests / total, 1) if total else 0.0,
+            "queries": round(queries / requests, 2) if requests else 0.0,
+            "rss_mb": round(rss_mb(), 1),
+            "errors": errors,
+        }
+        log(format_row(scenario.name, results[scenario.name]))
+    return results
+
+
+def format_row(name, result, flag=""):
+    return "%-30s %8.2f %8.2f %8.2f %8.1f %7.2f %8.1f %6d %s" % (
+        name,
+        result["p50"],
+        result["p95"],
+        result["p99"],
+        result["rps"],
+        result["queries"],
+        result["rss_mb"],
+        result["errors"],
+        flag,
+    )
+
+
+header = "%-30s %8s %8s %8s %8s %7s %8s %6s" % (
+    "scenario",
+    "p50 ms",
+    "p95 ms",
+    "p99 ms",
+    "req/s",
+    "queries",
+    "rss MB",
+    "errors",
+)
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Regressions against a baseline run: {name: [reasons]}. Latency may grow
+    by `threshold` before it counts, queries per request and errors may not
+    grow at all.
+    """
+    regressions = {}
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        reasons = []
+        for key in ("p50", "p95", "p99"):
+            if result[key] > before[key] * (1 + threshold):
+                reasons.append("%s %.2f -> %.2f ms" % (key, before[key], result[key]))
+        if result["queries"] > before["queries"]:
+            reasons.append(
+                "queries %.2f -> %.2f" % (before["queries"], result["queries"])
+            )
+        if result["errors"] > before["errors"]:
+            reasons.append("errors %d -> %d" % (before["errors"], result["errors"]))
+        if reasons:
+            regressions[name] = reasons
+    return regressions
@@ -13,8 +13,11 @@ class Config:
     # SQLALCHEMY_COMMIT_ON_TEARDOWN = True
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
-    SQLALCHEMY_RECORD_QUERIES = True
+    # queries are timed by app.instrumentation instead of get_debug_queries()
+    SQLALCHEMY_RECORD_QUERIES = False
     FLASKY_SLOW_DB_QUERY_TIME = 0.5
+    # same statement shape repeated more often in one request hints at N+1
+    FLASKY_N_PLUS_ONE_THRESHOLD = 5
 
     MAIL_SERVER = os.environ.get("MAIL_SERVER", "smtp.qq.com")
     MAIL_PORT = int(os.environ.get("MAIL_PORT", "25"))
@@ -33,11 +36,81 @@ class Config:
     FLASKY_MAIL_SUBJECT_PREFIX = "[Flasky]"
     FLASKY_MAIL_SENDER = "Flasky Admin <%s>" % MAIL_USERNAME
     FLASKY_ADMIN = os.environ.get("FLASKY_ADMIN")
+    # outbox delivery, 0 workers leaves it to "flask mail-worker"
+    FLASKY_MAIL_POOL_SIZE = int(os.environ.get("FLASKY_MAIL_POOL_SIZE", "2"))
+    FLASKY_MAIL_POLL_INTERVAL = 60  # seconds between checks for due retries
+    FLASKY_MAIL_BATCH_SIZE = 50
+    FLASKY_MAIL_MAX_ATTEMPTS = 5
+    FLASKY_MAIL_RETRY_BACKOFF = 30  # seconds, doubled for every attempt
+    FLASKY_MAIL_LEASE_TIME = 300
 
     # pagination
     FLASKY_POSTS_PER_PAGE = 20
     FLASKY_FOLLOWERS_PER_PAGE = 50
     FLASKY_COMMENTS_PER_PAGE = 30
+    FLASKY_SEARCH_RESULTS_PER_PAGE = 20
+    # matches of a term ranked per table, newest first, keeps common terms fast
+    FLASKY_SEARCH_CANDIDATES = 1000
+
+    # last_seen is only updated if older than the resolution (seconds), and
+    # written in bulk once enough users are pending or the interval passed
+    FLASKY_LAST_SEEN_RESOLUTION = 60
+    FLASKY_LAST_SEEN_FLUSH_INTERVAL = 10
+    FLASKY_LAST_SEEN_FLUSH_SIZE = 100
+
+    # hash method and cost of new passwords, old hashes are upgraded on login
+    FLASKY_PASSWORD_HASH_METHOD = os.environ.get(
+        "FLASKY_PASSWORD_HASH_METHOD", "pbkdf2:sha256:150000"
+    )
+    # seconds verified HTTP Basic credentials are trusted without the KDF
+    FLASKY_CREDENTIAL_CACHE_TTL = 10
+
+    # full-page cache for anonymous visitors: "memory", "filesystem" or ""
+    FLASKY_PAGE_CACHE = os.environ.get("FLASKY_PAGE_CACHE", "memory")
+    FLASKY_PAGE_CACHE_DIR = os.path.join(base_dir, "tmp/page-cache")
+    FLASKY_PAGE_CACHE_SIZE = 1000
+    FLASKY_PAGE_CACHE_TTL = 10
+
+    # rendered html memoized by content hash, optionally persisted to a directory
+    FLASKY_RENDER_CACHE_SIZE = 10000
+    FLASKY_RENDER_CACHE_DIR = os.environ.get("FLASKY_RENDER_CACHE_DIR")
+
+    # commit long bodies raw and render them on a background pool
+    FLASKY_RENDER_ASYNC = os.environ.get("FLASKY_RENDER_ASYNC", "false").lower() in [
+        "true",
+        "on",
+        "1",
+    ]
+    FLASKY_RENDER_ASYNC_MIN_LENGTH = 2000
+    FLASKY_RENDER_POOL_SIZE = 2
+    FLASKY_RENDER_POLL_INTERVAL = 60  # seconds between checks for pending rows
+
+    # per-worker index of the follows table for follow checks
+    FLASKY_FOLLOW_GRAPH = os.environ.get("FLASKY_FOLLOW_GRAPH", "true").lower() in [
+        "true",
+        "on",
+        "1",
+    ]
+
+    # seconds a worker trusts the token generation of a user, so how long
+    # tokens revoked by another worker may still be used
+    FLASKY_TOKEN_CACHE_TTL = 60
+
+    # seconds the users and roles rows behind current_user are trusted without
+    # a query, 0 to load them on every request
+    FLASKY_IDENTITY_CACHE_TTL = 30
+    FLASKY_IDENTITY_CACHE_SIZE = 10000
+    # seconds before a worker reloads the roles table changed by another one
+    FLASKY_ROLE_TABLE_TTL = 300
+
+    # authors with more followers are not fanned out into timelines on write
+    FLASKY_TIMELINE_FANOUT_LIMIT = int(
+        os.environ.get("FLASKY_TIMELINE_FANOUT_LIMIT", "10000")
+    )
+
+    # part of every ETag, set it to the release so that a deploy with changed
+    # templates or serializers doesn't validate the copies clients hold
+    FLASKY_ETAG_SALT = os.environ.get("FLASKY_ETAG_SALT", "")
 
     SSL_REDIRECT = False
 
@@ -60,6 +133,19 @@ class TestingConfig(Config):
     ) or "sqlite:///" + os.path.join(base_dir, "data-test.sqlite")
     # disable csrf protection during test to avoid extraction of token
     WTF_CSRF_ENABLED = False
+    # deliver queued mail explicitly in tests
+    FLASKY_MAIL_POOL_SIZE = 0
+    FLASKY_RENDER_POOL_SIZE = 0
+    # listing pages must not issue extra queries for each rendered row
+    FLASKY_MAX_QUERIES_PER_ROW = 0
+
+
+class BenchmarkConfig(Config):
+    # recreated by 'flask bench --seed', never point it at real data
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        "BENCH_DATABASE_URL"
+    ) or "sqlite:///" + os.path.join(base_dir, "data-bench.sqlite")
+    FLASKY_MAIL_POOL_SIZE = 0
 
 
 class ProductionConfig(Config):
@@ -147,6 +233,7 @@ class UnixConfig(ProductionConfig):
 config = {
     "development": DevelopmentConfig,
     "testing": TestingConfig,
+    "benchmark": BenchmarkConfig,
     "production": ProductionConfig,
     "heroku": HerokuConfig,
     "docker": DockerConfig,
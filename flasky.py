@@ -95,10 +95,341 @@ def profile(length, profile_dir):
 
 
 @app.cli.command()
-def deploy():
+@click.option("--seed/--no-seed", default=True, help="Recreate the dataset first")
+@click.option("--users", default=1000, help="Users to seed")
+@click.option("--posts", default=10000, help="Posts to seed")
+@click.option("--comments", default=20000, help="Comments to seed")
+@click.option("--follows", default=20, help="Users followed by each user")
+@click.option("--random-seed", default=1, help="Seed of the dataset generator")
+@click.option("--requests", default=200, help="Measured requests per scenario")
+@click.option("--warmup", default=20, help="Unmeasured requests per scenario")
+@click.option("--only", multiple=True, help="Run the scenarios with this in the name")
+@click.option("--url", default=None, help="Benchmark a running server instead")
+@click.option("--baseline", default=None, help="JSON results to compare with")
+@click.option("--save", default=None, help="Write the results to this JSON file")
+@click.option("--threshold", default=0.2, help="Latency growth that is a regression")
+def bench(
+    seed,
+    users,
+    posts,
+    comments,
+    follows,
+    random_seed,
+    requests,
+    warmup,
+    only,
+    url,
+    baseline,
+    save,
+    threshold,
+):
+    """Benchmark the hot endpoints against a seeded dataset.
+
+    Uses the "benchmark" configuration and its own database, BENCH_DATABASE_URL.
+    To benchmark a real server, seed with --requests 0, start it with
+    FLASK_CONFIG=benchmark, e.g. "gunicorn -w 4 flasky:app", and pass --url.
+    """
+    import json
+    import sys
+    import benchmarks
+
+    bench_app = create_app("benchmark")
+    scale = benchmarks.Scale(users, posts, comments, follows, random_seed)
+    with bench_app.app_context():
+        if seed:
+            benchmarks.seed(scale)
+        if not requests:
+            return
+        if url:
+            driver = benchmarks.HTTPDriver(url)
+        else:
+            driver = benchmarks.ClientDriver(bench_app)
+        print(benchmarks.runner.header)
+        results = benchmarks.run(driver, scale, requests, warmup, only)
+    if save:
+        with open(save, "w") as f:
+            json.dump({"scale": scale.to_json(), "results": results}, f, indent=2)
+    if baseline:
+        with open(baseline) as f:
+            before = json.load(f)
+        if before["scale"] != scale.to_json():
+            print("Baseline was measured at another scale: %s" % before["scale"])
+        regressions = benchmarks.compare(results, before["results"], threshold)
+        for name, reasons in regressions.items():
+            print("REGRESSION %s: %s" % (name, ", ".join(reasons)))
+        if regressions:
+            sys.exit(1)
+        print("No regressions against %s" % baseline)
+
+
+@app.cli.command()
+@click.option("--users", default=0, help="Users to add")
+@click.option("--posts", default=0, help="Posts to add")
+@click.option("--comments", default=0, help="Comments to add")
+@click.option("--follows", default=10, help="Users followed by each new user")
+@click.option("--distinct", default=1000, help="Distinct fake values of each kind")
+@click.option("--batch-size", default=50000, help="Rows per transaction")
+@click.option("--workers", default=None, type=int, help="Faker and render processes")
+@click.option("--seed", default=None, type=int, help="Seed of the generator")
+def fake(users, posts, comments, follows, distinct, batch_size, workers, seed):
+    """Add fake users, posts and comments in bulk."""
+    from app.fake import BulkFaker
+
+    faker = BulkFaker(distinct, batch_size, workers, seed)
+    for name, rows in (
+        ("users", faker.users(users, follows) if users else ()),
+        ("posts", faker.posts(posts) if posts else ()),
+        ("comments", faker.comments(comments) if comments else ()),
+    ):
+        done, written, rate = 0, 0, 0.0
+        for done, written, rate in rows:
+            print(
+                "%s: %d added, %d rows written, %.0f rows/s"
+                % (name, done, written, rate)
+            )
+        if done:
+            print(
+                "%s: done, %d added with %d rows written at %.0f rows/s"
+                % (name, done, written, rate)
+            )
+
+
+@app.cli.command()
+@click.option("--sql", is_flag=True, help="Print the statements too")
+def explain(sql):
+    """Print the query plans of the hot endpoint queries, flag full scans."""
+    import sys
+    from app.explain import explain as explain_query, full_scans, hot_queries
+    from app.explain import index_ordered, ordered_walks, sorts
+
+    user = User.query.order_by(User.id).first()
+    post = Post.query.filter_by(author=user).first() or Post.query.first()
+    if user is None or post is None:
+        print("Needs a user and a post to build the queries, see 'flask fake'")
+        sys.exit(1)
+    per_page = app.config["FLASKY_POSTS_PER_PAGE"]
+    connection = db.session.connection()
+    scanned = []
+    for name, query in hot_queries(user, post, per_page):
+        print(name)
+        if sql:
+            print(getattr(query, "statement", query))
+        plan = explain_query(connection, query)
+        scans = full_scans(plan, name in ordered_walks)
+        sorted_ = sorts(plan) if name in index_ordered else []
+        for line in plan:
+            mark = ""
+            if line in scans:
+                mark = "  <- full scan"
+            elif line in sorted_:
+                mark = "  <- sort"
+            print("    %s%s" % (line, mark))
+        if scans or sorted_:
+            scanned.append(name)
+    if scanned:
+        print("Full scans or sorts in: %s" % ", ".join(scanned))
+        sys.exit(1)
+
+
+@app.cli.command("reconcile-counters")
+@click.option("--chunk-size", default=1000, help="Rows recounted per transaction")
+def reconcile_counters(chunk_size):
+    """Repair drift of the denormalized post/comment/follow counters."""
+    for model in (User, Post):
+        last_id = db.session.query(db.func.max(model.id)).scalar() or 0
+        for first_id in range(1, last_id + 1, chunk_size):
+            end_id = min(first_id + chunk_size - 1, last_id)
+            model.reconcile_counters(first_id, end_id)
+            db.session.commit()
+            print("%s: %d/%d" % (model.__tablename__, end_id, last_id))
+
+
+@app.cli.command()
+@click.option(
+    "--model",
+    type=click.Choice(["all", "post", "comment"]),
+    default="all",
+    help="Bodies to re-render",
+)
+@click.option("--chunk-size", default=1000, help="Rows per chunk and UPDATE")
+@click.option("--workers", default=None, type=int, help="Render processes")
+@click.option(
+    "--checkpoint",
+    default=os.path.join(os.path.dirname(__file__), "tmp/rerender.json"),
+    help="Progress file to resume from",
+)
+@click.option("--restart", is_flag=True, help="Ignore the saved progress")
+@click.option(
+    "--pending", is_flag=True, help="Only render bodies left by FLASKY_RENDER_ASYNC"
+)
+def rerender(model, chunk_size, workers, checkpoint, restart, pending):
+    """Regenerate body_html of posts and comments, e.g. after changing tags."""
+    from app import render_cache
+    from app.rendering import rerender as rerender_table, render_pending
+
+    if pending:
+        done = 0
+        while True:
+            found = render_pending(chunk_size)
+            if not found:
+                break
+            done += found
+        print("Rendered %d pending bodies" % done)
+        return
+
+    os.makedirs(os.path.dirname(checkpoint), exist_ok=True)
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    for name, table in (("post", Post.__table__), ("comment", Comment.__table__)):
+        if model not in ("all", name):
+            continue
+        done, rate = 0, 0.0
+        for done, rate in rerender_table(
+            table, name, chunk_size, workers, checkpoint_path=checkpoint
+        ):
+            print("%s: %d rows, %.0f rows/s" % (table.name, done, rate))
+        print("%s: done, %d rows re-rendered at %.0f rows/s" % (table.name, done, rate))
+    if os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    if workers == 1:
+        stats = render_cache.stats()
+        print(
+            "render cache: %.1f%% hit rate, %d entries"
+            % (stats["hit_rate"] * 100, stats["size"])
+        )
+
+
+@app.cli.command("search-index")
+def search_index():
+    """Rebuild the full-text indexes of posts and comments."""
+    import time
+    from app.search import fts_enabled, rebuild
+
+    if not fts_enabled(db.engine):
+        print("Full-text search needs SQLite FTS5")
+        return
+    started = time.perf_counter()
+    with db.engine.begin() as connection:
+        rebuild(connection)
+    print(
+        "Indexed %d posts and %d comments in %.1fs"
+        % (Post.query.count(), Comment.query.count(), time.perf_counter() - started)
+    )
+
+
+@app.cli.command("follow-graph")
+@click.option("--check", is_flag=True, help="Compare the index with the database")
+def follow_graph_command(check):
+    """Load the in-memory follow graph and report its size and speed."""
+    import time
+    from app import follow_graph
+
+    started = time.perf_counter()
+    follow_graph.load()
+    graph = follow_graph.graph
+    if graph is None:
+        print("The follow graph is disabled, see FLASKY_FOLLOW_GRAPH")
+        return
+    following = graph["following"]
+    print(
+        "Loaded %d follows in %.2fs"
+        % (len(following.targets), time.perf_counter() - started)
+    )
+    user_ids = [id for (id,) in db.session.query(User.id).limit(1000)]
+    started = time.perf_counter()
+    for follower_id in user_ids:
+        for followed_id in user_ids[:100]:
+            following.contains(follower_id, followed_id)
+    lookups = len(user_ids) * min(len(user_ids), 100)
+    if lookups:
+        print(
+            "%.2f us per membership test"
+            % ((time.perf_counter() - started) / lookups * 1e6)
+        )
+    if check:
+        wrong = follow_graph.check()
+        if wrong:
+            print("Out of sync for %d users: %s" % (len(wrong), wrong[:20]))
+        else:
+            print("In sync with the follows table")
+
+
+@app.cli.command()
+@click.option("--top-k", default=10, help="Suggestions kept per user")
+@click.option(
+    "--max-nnz",
+    default=5000000,
+    help="Scores computed at once, about 12 bytes each, bounds the memory",
+)
+def recommend(top_k, max_nnz):
+    """Precompute "who to follow" from friends of friends."""
+    import time
+    from app import recommend as job
+
+    if not job.available():
+        raise click.ClickException(
+            "flask recommend needs numpy and scipy, see requirements/recommend.txt"
+        )
+    started = time.perf_counter()
+    connection = db.engine.connect()
+    try:
+        matrix = job.load_matrix(connection)
+        print(
+            "Loaded %d follows of %d users in %.1fs, %.1f MB"
+            % (
+                matrix.nnz,
+                matrix.shape[0],
+                time.perf_counter() - started,
+                job.matrix_bytes(matrix) / 2**20,
+            )
+        )
+        computing = time.perf_counter()
+        written = 0
+        for start, end, rows in job.suggest(matrix, top_k, max_nnz):
+            job.write_suggestions(connection, start, end, rows)
+            written += len(rows)
+            print(
+                "users %d-%d: %d suggestions, %.1fs"
+                % (start, end - 1, len(rows), time.perf_counter() - computing)
+            )
+    finally:
+        connection.close()
+    print("Wrote %d suggestions in %.1fs" % (written, time.perf_counter() - started))
+
+
+@app.cli.command("mail-worker")
+@click.option("--interval", default=5.0, help="Seconds to wait on an empty outbox")
+@click.option("--once", is_flag=True, help="Drain the outbox and exit")
+def mail_worker(interval, once):
+    """Deliver queued emails from the outbox.
+
+    Needed where the web processes don't deliver themselves, i.e. with
+    FLASKY_MAIL_POOL_SIZE=0; it can also run next to them.
+
+    Try it against a local debugging SMTP server, e.g. start
+    "python -m smtpd -n -c DebuggingServer localhost:1025" and run the worker
+    with MAIL_SERVER=localhost MAIL_PORT=1025.
+    """
+    import time
+    from app.email import deliver_outbox
+
+    while True:
+        sent = deliver_outbox()
+        if sent:
+            print("Delivered %d message(s)" % sent)
+            continue
+        if once:
+            break
+        time.sleep(interval)
+
+
+@app.cli.command()
+@click.option("--chunk-size", default=1000, help="Rows per backfill transaction")
+def deploy(chunk_size):
     """Run deployment tasks."""
     from flask_migrate import upgrade
-    from app.models import Role, User
+    from app import backfills
+    from app.models import Role
 
     # migrate database to the latest version
     upgrade()
@@ -106,5 +437,9 @@ def deploy():
     # create user roles
     Role.insert_roles()
 
-    # create self-follows for all users
-    User.add_self_follows()
+    # data backfills not completed yet, e.g. self-follows for all users
+    for name, model, fn in backfills.pending():
+        changed = 0
+        for done, last_id, changed in backfills.run(name, model, fn, chunk_size):
+            print("%s: %d/%d, %d rows changed" % (name, done, last_id, changed))
+        print("%s: completed, %d rows changed" % (name, changed))
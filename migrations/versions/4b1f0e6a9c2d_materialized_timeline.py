@@ -0,0 +1,43 @@
+"""materialized timeline
+
+Revision ID: 4b1f0e6a9c2d
+Revises: 08cf07f70eb5
+Create Date: 2026-10-17 09:12:40.218377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b1f0e6a9c2d'
+down_revision = '08cf07f70eb5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('timeline',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['post_id'], ['posts.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_timeline_user_id_timestamp', 'timeline', ['user_id', 'timestamp'], unique=False)
+    op.add_column('users', sa.Column('celebrity', sa.Boolean(), nullable=True))
+    op.create_index(op.f('ix_users_celebrity'), 'users', ['celebrity'], unique=False)
+    # fill the timeline of existing follows in one set-based statement
+    op.execute(
+        'INSERT INTO timeline (user_id, post_id, timestamp) '
+        'SELECT follows.follower_id, posts.id, posts.timestamp '
+        'FROM follows JOIN posts ON posts.author_id = follows.followed_id'
+    )
+
+
+def downgrade():
+    op.drop_index(op.f('ix_users_celebrity'), table_name='users')
+    op.drop_column('users', 'celebrity')
+    op.drop_index('ix_timeline_user_id_timestamp', table_name='timeline')
+    op.drop_table('timeline')
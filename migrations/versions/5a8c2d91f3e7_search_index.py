@@ -0,0 +1,32 @@
+"""full-text search index
+
+Revision ID: 5a8c2d91f3e7
+Revises: e3f1a7b52d60
+Create Date: 2026-10-17 17:11:05.362210
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a8c2d91f3e7'
+down_revision = 'e3f1a7b52d60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    for table in ('posts', 'comments'):
+        op.execute("CREATE VIRTUAL TABLE %s_fts USING fts5"
+                   "(body, content='%s', content_rowid='id')" % (table, table))
+        op.execute("INSERT INTO %s_fts(%s_fts) VALUES ('rebuild')" % (table, table))
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute('DROP TABLE comments_fts')
+    op.execute('DROP TABLE posts_fts')
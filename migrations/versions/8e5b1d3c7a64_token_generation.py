@@ -0,0 +1,24 @@
+"""token generation
+
+Revision ID: 8e5b1d3c7a64
+Revises: f2a9b7c41d38
+Create Date: 2026-10-17 23:41:08.215734
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e5b1d3c7a64'
+down_revision = 'f2a9b7c41d38'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('token_generation', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('users', 'token_generation')
@@ -0,0 +1,44 @@
+"""denormalized counters
+
+Revision ID: 9d3e57c1b8a4
+Revises: 4b1f0e6a9c2d
+Create Date: 2026-10-17 11:03:27.540981
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d3e57c1b8a4'
+down_revision = '4b1f0e6a9c2d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('users', sa.Column('post_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('users', sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('users', sa.Column('follower_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('users', sa.Column('followed_count', sa.Integer(), server_default='0', nullable=False))
+    # initial counts, use "flask reconcile-counters" to repair drift later
+    op.execute(
+        'UPDATE posts SET comment_count = '
+        '(SELECT count(*) FROM comments WHERE comments.post_id = posts.id)'
+    )
+    op.execute(
+        'UPDATE users SET '
+        'post_count = (SELECT count(*) FROM posts WHERE posts.author_id = users.id), '
+        'comment_count = (SELECT count(*) FROM comments WHERE comments.author_id = users.id), '
+        'follower_count = (SELECT count(*) FROM follows WHERE follows.followed_id = users.id), '
+        'followed_count = (SELECT count(*) FROM follows WHERE follows.follower_id = users.id)'
+    )
+
+
+def downgrade():
+    op.drop_column('users', 'followed_count')
+    op.drop_column('users', 'follower_count')
+    op.drop_column('users', 'comment_count')
+    op.drop_column('users', 'post_count')
+    op.drop_column('posts', 'comment_count')
@@ -0,0 +1,24 @@
+"""follows version
+
+Revision ID: a91f4c6d2e58
+Revises: c3e8f15a9d27
+Create Date: 2026-10-18 10:12:44.508216
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a91f4c6d2e58'
+down_revision = 'c3e8f15a9d27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('follows_version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('users', 'follows_version')
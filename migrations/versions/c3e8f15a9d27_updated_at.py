@@ -0,0 +1,29 @@
+"""updated_at of posts and comments
+
+Revision ID: c3e8f15a9d27
+Revises: 8e5b1d3c7a64
+Create Date: 2026-10-18 01:12:47.903518
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3e8f15a9d27'
+down_revision = '8e5b1d3c7a64'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    op.add_column('comments', sa.Column('updated_at', sa.DateTime(), nullable=True))
+    # never edited as far as anyone can tell
+    op.execute('UPDATE posts SET updated_at = timestamp')
+    op.execute('UPDATE comments SET updated_at = timestamp')
+
+
+def downgrade():
+    op.drop_column('comments', 'updated_at')
+    op.drop_column('posts', 'updated_at')
@@ -0,0 +1,41 @@
+"""mail outbox
+
+Revision ID: c7a2e4f09b16
+Revises: 9d3e57c1b8a4
+Create Date: 2026-10-17 14:26:51.803112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7a2e4f09b16'
+down_revision = '9d3e57c1b8a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('subject', sa.String(length=256), nullable=True),
+    sa.Column('sender', sa.String(length=128), nullable=True),
+    sa.Column('recipients', sa.Text(), nullable=True),
+    sa.Column('body', sa.Text(), nullable=True),
+    sa.Column('html', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('next_attempt_at', sa.DateTime(), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('sent_at', sa.DateTime(), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_outbox_next_attempt_at'), 'outbox', ['next_attempt_at'], unique=False)
+    op.create_index(op.f('ix_outbox_sent_at'), 'outbox', ['sent_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_outbox_sent_at'), table_name='outbox')
+    op.drop_index(op.f('ix_outbox_next_attempt_at'), table_name='outbox')
+    op.drop_table('outbox')
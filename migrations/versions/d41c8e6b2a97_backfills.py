@@ -0,0 +1,29 @@
+"""backfills
+
+Revision ID: d41c8e6b2a97
+Revises: b6d04f3e8a15
+Create Date: 2026-10-17 20:05:12.481903
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd41c8e6b2a97'
+down_revision = 'b6d04f3e8a15'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('backfills',
+    sa.Column('name', sa.String(length=64), nullable=False),
+    sa.Column('last_id', sa.Integer(), nullable=False),
+    sa.Column('completed_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('backfills')
@@ -0,0 +1,27 @@
+"""timeline index post_id
+
+Revision ID: d7c4e2a81b39
+Revises: a91f4c6d2e58
+Create Date: 2026-10-18 11:03:27.614092
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd7c4e2a81b39'
+down_revision = 'a91f4c6d2e58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # post_id breaks timestamp ties in page order, without a sort
+    op.drop_index('ix_timeline_user_id_timestamp', table_name='timeline')
+    op.create_index('ix_timeline_user_id_timestamp', 'timeline', ['user_id', 'timestamp', 'post_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_timeline_user_id_timestamp', table_name='timeline')
+    op.create_index('ix_timeline_user_id_timestamp', 'timeline', ['user_id', 'timestamp'], unique=False)
@@ -0,0 +1,30 @@
+"""deferred body rendering
+
+Revision ID: e3f1a7b52d60
+Revises: c7a2e4f09b16
+Create Date: 2026-10-17 16:02:37.418925
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3f1a7b52d60'
+down_revision = 'c7a2e4f09b16'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('posts', sa.Column('render_pending', sa.Boolean(), nullable=True))
+    op.create_index(op.f('ix_posts_render_pending'), 'posts', ['render_pending'], unique=False)
+    op.add_column('comments', sa.Column('render_pending', sa.Boolean(), nullable=True))
+    op.create_index(op.f('ix_comments_render_pending'), 'comments', ['render_pending'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_comments_render_pending'), table_name='comments')
+    op.drop_column('comments', 'render_pending')
+    op.drop_index(op.f('ix_posts_render_pending'), table_name='posts')
+    op.drop_column('posts', 'render_pending')
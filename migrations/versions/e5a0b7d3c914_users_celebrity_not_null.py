@@ -0,0 +1,28 @@
+"""users celebrity not null
+
+Revision ID: e5a0b7d3c914
+Revises: d7c4e2a81b39
+Create Date: 2026-10-19 10:21:54.730118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a0b7d3c914'
+down_revision = 'd7c4e2a81b39'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # users that existed before the celebrity column are NULL
+    op.execute('UPDATE users SET celebrity = false WHERE celebrity IS NULL')
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.alter_column('celebrity', existing_type=sa.Boolean(), server_default=sa.false(), nullable=False)
+
+
+def downgrade():
+    with op.batch_alter_table('users') as batch_op:
+        batch_op.alter_column('celebrity', existing_type=sa.Boolean(), server_default=None, nullable=True)
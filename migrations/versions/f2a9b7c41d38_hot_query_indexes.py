@@ -0,0 +1,28 @@
+"""hot query indexes
+
+Revision ID: f2a9b7c41d38
+Revises: d41c8e6b2a97
+Create Date: 2026-10-17 21:10:37.902114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a9b7c41d38'
+down_revision = 'd41c8e6b2a97'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_posts_author_id_timestamp', 'posts', ['author_id', 'timestamp', 'id'], unique=False)
+    op.create_index('ix_comments_post_id_timestamp', 'comments', ['post_id', 'timestamp', 'id'], unique=False)
+    op.create_index('ix_follows_followed_id_timestamp', 'follows', ['followed_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_follows_followed_id_timestamp', table_name='follows')
+    op.drop_index('ix_comments_post_id_timestamp', table_name='comments')
+    op.drop_index('ix_posts_author_id_timestamp', table_name='posts')
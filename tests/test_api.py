@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import unittest
+from unittest import mock
 from base64 import b64encode
 import json
 import re
+from datetime import datetime, timedelta
 from flask import url_for
+from werkzeug.security import check_password_hash
 from app import create_app, db
 from app.models import User, Role, Post, Comment
+from app.api_1_0.authentication import generation_cache, credential_cache
 
 
 class APITestCase(unittest.TestCase):
@@ -155,7 +159,7 @@ class APITestCase(unittest.TestCase):
 
         # get the post from the user
         response = self.client.get(
-            url_for("api.get_user_posts", id=u.id),
+            url_for("api.get_user_posts", id=u.id, count=1),
             headers=self.get_api_headers("john@example.com", "cat"),
         )
         self.assertTrue(response.status_code == 200)
@@ -166,7 +170,7 @@ class APITestCase(unittest.TestCase):
 
         # get the post from the user as a follower
         response = self.client.get(
-            url_for("api.get_user_followed_posts", id=u.id),
+            url_for("api.get_user_followed_posts", id=u.id, count=1),
             headers=self.get_api_headers("john@example.com", "cat"),
         )
         self.assertTrue(response.status_code == 200)
@@ -271,7 +275,7 @@ class APITestCase(unittest.TestCase):
 
         # get the two comments from the post
         response = self.client.get(
-            url_for("api.get_post_comments", id=post.id),
+            url_for("api.get_post_comments", id=post.id, count=1),
             headers=self.get_api_headers("susan@example.com", "dog"),
         )
         self.assertTrue(response.status_code == 200)
@@ -281,10 +285,272 @@ class APITestCase(unittest.TestCase):
 
         # get all the comments
         response = self.client.get(
-            url_for("api.get_comments", id=post.id),
+            url_for("api.get_comments", count=1),
             headers=self.get_api_headers("susan@example.com", "dog"),
         )
         self.assertTrue(response.status_code == 200)
         json_response = json.loads(response.get_data(as_text=True))
         self.assertIsNotNone(json_response.get("comments"))
         self.assertTrue(json_response.get("count", 0) == 2)
+
+    def test_cursor_pagination(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        now = datetime.utcnow()
+        # two posts share a timestamp to exercise the id tie-breaker
+        timestamps = [now, now, now - timedelta(minutes=1), now - timedelta(minutes=2)]
+        posts = [
+            Post(body="post %d" % i, author=u, timestamp=t)
+            for i, t in enumerate(timestamps)
+        ]
+        db.session.add_all(posts)
+        db.session.commit()
+        self.app.config["FLASKY_POSTS_PER_PAGE"] = 3
+        headers = self.get_api_headers("john@example.com", "cat")
+
+        # first page, count is only computed when asked for
+        response = self.client.get(url_for("api.get_posts"), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertNotIn("count", json_response)
+        self.assertIsNone(json_response["prev"])
+        self.assertIsNotNone(json_response["next"])
+        first_page = [p["body"] for p in json_response["posts"]]
+        self.assertEqual(first_page, ["post 1", "post 0", "post 2"])
+
+        # seek to the next page
+        response = self.client.get(json_response["next"], headers=headers)
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual([p["body"] for p in json_response["posts"]], ["post 3"])
+        self.assertIsNone(json_response["next"])
+        self.assertIsNotNone(json_response["prev"])
+
+        # and back again
+        response = self.client.get(json_response["prev"], headers=headers)
+        json_response = json.loads(response.get_data(as_text=True))
+        self.assertEqual([p["body"] for p in json_response["posts"]], first_page)
+        self.assertIsNone(json_response["prev"])
+
+        # a tampered cursor is a bad request
+        response = self.client.get(
+            url_for("api.get_posts", cursor="garbage"), headers=headers
+        )
+        self.assertEqual(response.status_code, 400)
+
+    def test_stateless_token(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        generation_cache().clear()
+        response = self.client.post(
+            "/api/v1.0/tokens/",
+            headers=self.get_api_headers("john@example.com", "cat"),
+        )
+        self.assertEqual(response.status_code, 200)
+        token = json.loads(response.get_data(as_text=True))["token"]
+
+        # only the token generation is read, once
+        stats = generation_cache().stats()
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            for i in range(3):
+                response = self.client.get(
+                    "/api/v1.0/comments/", headers=self.get_api_headers(token, "")
+                )
+                self.assertEqual(response.status_code, 200)
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(generation_cache().stats()["misses"] - stats["misses"], 1)
+        self.assertEqual(generation_cache().stats()["hits"] - stats["hits"], 2)
+        self.assertEqual(
+            [s for s in statements if "FROM users" in s and "token_generation" in s],
+            [statements[0]],
+        )
+
+        # writes work with the principal as well
+        response = self.client.post(
+            "/api/v1.0/posts/",
+            headers=self.get_api_headers(token, ""),
+            data=json.dumps({"body": "body of the post"}),
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Post.query.one().author_id, u.id)
+
+        # changing the confirmed flag revokes the token
+        u.confirmed = False
+        db.session.commit()
+        response = self.client.get(
+            "/api/v1.0/comments/", headers=self.get_api_headers(token, "")
+        )
+        self.assertEqual(response.status_code, 401)
+
+    def test_timeline_checks_celebrities_once(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            response = self.client.get(
+                "/api/v1.0/users/%d/timeline/" % u.id,
+                headers=self.get_api_headers("john@example.com", "cat"),
+            )
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(response.status_code, 200)
+        # validators and view share the answer
+        self.assertEqual(len([s for s in statements if "EXISTS" in s]), 1)
+
+    def test_conditional_requests(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        post = Post(body="body of the post", author=u)
+        db.session.add_all([u, post])
+        db.session.commit()
+        headers = self.get_api_headers("john@example.com", "cat")
+        for path in (
+            "/api/v1.0/posts/",
+            "/api/v1.0/posts/%d" % post.id,
+            "/api/v1.0/users/%d" % u.id,
+            "/api/v1.0/users/%d/posts/" % u.id,
+            "/api/v1.0/users/%d/timeline/" % u.id,
+            "/api/v1.0/posts/%d/comments/" % post.id,
+        ):
+            response = self.client.get(path, headers=headers)
+            self.assertEqual(response.status_code, 200, path)
+            etag = response.headers["ETag"]
+            response = self.client.get(
+                path, headers=dict(headers, **{"If-None-Match": etag})
+            )
+            self.assertEqual(response.status_code, 304, path)
+            self.assertEqual(response.get_data(), b"", path)
+
+        # an edit changes the validators of the post and of the collections
+        response = self.client.get("/api/v1.0/posts/", headers=headers)
+        etag = response.headers["ETag"]
+        # deletes don't make a page newer, collections only have an ETag
+        self.assertNotIn("Last-Modified", response.headers)
+        path = "/api/v1.0/posts/%d" % post.id
+        last_modified = self.client.get(path, headers=headers).headers["Last-Modified"]
+        post.body = "edited body"
+        post.updated_at = datetime.utcnow() + timedelta(seconds=2)
+        db.session.commit()
+        response = self.client.get(
+            "/api/v1.0/posts/", headers=dict(headers, **{"If-None-Match": etag})
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("edited body", response.get_data(as_text=True))
+        response = self.client.get(
+            path, headers=dict(headers, **{"If-Modified-Since": last_modified})
+        )
+        self.assertEqual(response.status_code, 200)
+
+        # a deleted row changes the page
+        etag = self.client.get("/api/v1.0/posts/", headers=headers).headers["ETag"]
+        db.session.delete(post)
+        db.session.commit()
+        response = self.client.get(
+            "/api/v1.0/posts/", headers=dict(headers, **{"If-None-Match": etag})
+        )
+        self.assertEqual(response.status_code, 200)
+
+    def test_fields_and_embed(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(
+            email="john@example.com",
+            username="john",
+            password="cat",
+            confirmed=True,
+            role=r,
+        )
+        post = Post(body="body of the post", author=u)
+        comment = Comment(body="a comment", author=u, post=post)
+        db.session.add_all([u, post, comment])
+        db.session.commit()
+        headers = self.get_api_headers("john@example.com", "cat")
+
+        # only the fields asked for
+        response = self.client.get(
+            "/api/v1.0/posts/?fields=url,body&embed=author", headers=headers
+        )
+        self.assertEqual(response.status_code, 200)
+        json_post = json.loads(response.get_data(as_text=True))["posts"][0]
+        self.assertEqual(set(json_post), {"url", "body", "author"})
+        self.assertEqual(json_post["body"], "body of the post")
+        self.assertEqual(json_post["author"]["username"], "john")
+
+        response = self.client.get(
+            "/api/v1.0/posts/%d/comments/?fields=body&embed=author" % post.id,
+            headers=headers,
+        )
+        self.assertEqual(response.status_code, 200)
+        json_comment = json.loads(response.get_data(as_text=True))["comments"][0]
+        self.assertEqual(json_comment["author"]["username"], "john")
+
+        response = self.client.get(
+            "/api/v1.0/users/%d?fields=username" % u.id, headers=headers
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            json.loads(response.get_data(as_text=True)), {"username": "john"}
+        )
+
+        # an edit of the embedded author changes the ETag of the page
+        path = "/api/v1.0/posts/%d?embed=author" % post.id
+        etag = self.client.get(path, headers=headers).headers["ETag"]
+        u.name = "John Doe"
+        db.session.commit()
+        response = self.client.get(
+            path, headers=dict(headers, **{"If-None-Match": etag})
+        )
+        self.assertEqual(response.status_code, 200)
+        json_post = json.loads(response.get_data(as_text=True))
+        self.assertEqual(json_post["author"]["name"], "John Doe")
+
+        # unknown fields and embeds
+        for path in (
+            "/api/v1.0/posts/?fields=nope",
+            "/api/v1.0/posts/?embed=post",
+            "/api/v1.0/users/%d?embed=author" % u.id,
+        ):
+            response = self.client.get(path, headers=headers)
+            self.assertEqual(response.status_code, 400, path)
+
+    def test_credential_cache(self):
+        r = Role.query.filter_by(name="User").first()
+        u = User(email="john@example.com", password="cat", confirmed=True, role=r)
+        db.session.add(u)
+        db.session.commit()
+        credential_cache.clear()
+        with mock.patch(
+            "app.models.check_password_hash", wraps=check_password_hash
+        ) as check:
+            for i in range(3):
+                response = self.client.get(
+                    url_for("api.get_posts"),
+                    headers=self.get_api_headers("john@example.com", "cat"),
+                )
+                self.assertEqual(response.status_code, 200)
+            # a wrong password never hits the cache
+            response = self.client.get(
+                url_for("api.get_posts"),
+                headers=self.get_api_headers("john@example.com", "dog"),
+            )
+            self.assertEqual(response.status_code, 401)
+        self.assertEqual(check.call_count, 2)
+
+        # a new password invalidates the cached credentials
+        u.password = "dog"
+        db.session.commit()
+        response = self.client.get(
+            url_for("api.get_posts"),
+            headers=self.get_api_headers("john@example.com", "cat"),
+        )
+        self.assertEqual(response.status_code, 401)
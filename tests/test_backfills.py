@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from app import create_app, db, backfills
+from app.models import Role, User, Follow, Post, Timeline
+
+
+class BackfillTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_self_follows(self):
+        users = [User(email="user%d@example.com" % i, password="cat") for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        db.session.add(Post(body="mine", author=users[2]))
+        db.session.commit()
+        # rows from before self-follows existed
+        follows = Follow.__table__
+        db.session.execute(
+            follows.delete()
+            .where(follows.c.follower_id == follows.c.followed_id)
+            .where(follows.c.follower_id.in_([users[1].id, users[2].id]))
+        )
+        db.session.execute(Timeline.__table__.delete())
+        db.session.execute(
+            User.__table__.update()
+            .where(User.id.in_([users[1].id, users[2].id]))
+            .values(follower_count=0, followed_count=0)
+        )
+        db.session.commit()
+
+        self.assertEqual([name for name, _, _ in backfills.pending()], ["self-follows"])
+        for name, model, fn in backfills.pending():
+            progress = list(backfills.run(name, model, fn, chunk_size=2))
+        self.assertEqual(progress[-1], (5, 5, 2))
+        self.assertEqual(backfills.pending(), [])
+        db.session.expire_all()
+        for user in users:
+            self.assertTrue(user.is_following(user))
+            self.assertEqual(user.follower_count, 1)
+        self.assertEqual(
+            db.session.query(Timeline.user_id, Timeline.post_id).all(),
+            [(users[2].id, 1)],
+        )
+
+    def test_insert_roles_unchanged(self):
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        db.event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            Role.insert_roles()
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(len(statements), 1)
+        Role.query.filter_by(name="Moderator").first().permissions = 0
+        db.session.commit()
+        Role.insert_roles()
+        self.assertNotEqual(
+            Role.query.filter_by(name="Moderator").first().permissions, 0
+        )
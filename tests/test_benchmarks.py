@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from app import create_app, db
+from benchmarks import Scale, ClientDriver, compare, run, seed
+from benchmarks.runner import percentile
+
+
+class BenchmarkTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_scenarios_run_on_seeded_dataset(self):
+        scale = Scale(users=20, posts=50, comments=100, follows=3)
+        seed(scale, log=lambda message: None)
+        results = run(
+            ClientDriver(self.app),
+            scale,
+            requests=2,
+            warmup=0,
+            log=lambda message: None,
+        )
+        for name, result in results.items():
+            self.assertEqual(result["errors"], 0, name)
+            self.assertGreater(result["queries"], 0, name)
+
+    def test_compare(self):
+        before = {"p50": 10.0, "p95": 20.0, "p99": 30.0, "queries": 2, "errors": 0}
+        after = dict(before, p50=11.0, p99=40.0, queries=3)
+        regressions = compare({"a": after, "b": before}, {"a": before, "b": before})
+        self.assertEqual(list(regressions), ["a"])
+        self.assertEqual(len(regressions["a"]), 2)
+        self.assertEqual(percentile([1, 2, 3, 4], 50), 2)
+        self.assertEqual(percentile([1, 2, 3, 4], 99), 4)
+        self.assertEqual(percentile([], 50), 0.0)
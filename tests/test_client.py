@@ -4,7 +4,7 @@ import unittest
 import re
 from flask import url_for
 from app import create_app, db
-from app.models import User, Role
+from app.models import User, Role, Post, Comment
 
 
 class FlaskClientTestCase(unittest.TestCase):
@@ -70,3 +70,57 @@ class FlaskClientTestCase(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         data = response.get_data(as_text=True)
         self.assertTrue("You have been logged out" in data)
+
+    def test_page_cache(self):
+        u = User(email="john@example.com", username="john", password="cat")
+        db.session.add(u)
+        db.session.commit()
+        response = self.client.get(url_for("main.index"))
+        self.assertEqual(response.headers["X-Cache"], "MISS")
+        self.assertIn("public", response.headers["Cache-Control"])
+        response = self.client.get(url_for("main.index"))
+        self.assertEqual(response.headers["X-Cache"], "HIT")
+
+        # a new post invalidates the cached page
+        db.session.add(Post(body="fresh post", author=u))
+        db.session.commit()
+        response = self.client.get(url_for("main.index"))
+        self.assertEqual(response.headers["X-Cache"], "MISS")
+        self.assertTrue("fresh post" in response.get_data(as_text=True))
+
+    def test_page_cache_skips_authenticated(self):
+        u = User(
+            email="john@example.com", username="john", password="cat", confirmed=True
+        )
+        db.session.add(u)
+        db.session.commit()
+        self.client.post(
+            url_for("auth.login"), data={"email": "john@example.com", "password": "cat"}
+        )
+        for i in range(2):
+            response = self.client.get(url_for("main.index"))
+            self.assertNotIn("X-Cache", response.headers)
+            self.assertIn("private", response.headers["Cache-Control"])
+
+    def test_conditional_page(self):
+        u = User(email="john@example.com", username="john", password="cat")
+        post = Post(body="body of the post", author=u)
+        db.session.add_all([u, post])
+        db.session.commit()
+        for path in ("/post/%d" % post.id, "/user/john"):
+            response = self.client.get(path)
+            self.assertEqual(response.status_code, 200)
+            etag = response.headers["ETag"]
+            response = self.client.get(path, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+
+        # a new comment changes the page of the post
+        response = self.client.get("/post/%d" % post.id)
+        etag = response.headers["ETag"]
+        db.session.add(Comment(body="a comment", post=post, author=u))
+        db.session.commit()
+        response = self.client.get(
+            "/post/%d" % post.id, headers={"If-None-Match": etag}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("a comment", response.get_data(as_text=True))
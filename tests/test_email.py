@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import unittest
+from unittest import mock
+from datetime import datetime
+from app import create_app, db, mail
+from app.drain import BoundedDrain
+from app.email import send_email, deliver_outbox
+from app.models import User, Role, OutboxMessage
+
+
+class EmailTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email="john@example.com", username="john", password="cat")
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def queue(self, count):
+        with self.app.test_request_context("/"):
+            for i in range(count):
+                send_email(
+                    self.user.email,
+                    "Confirm Your Account",
+                    "auth/email/confirm",
+                    user=self.user,
+                    token="token",
+                )
+            db.session.commit()
+
+    def test_outbox_is_durable(self):
+        self.queue(2)
+        self.assertEqual(OutboxMessage.query.filter_by(sent_at=None).count(), 2)
+
+    def test_queued_with_the_callers_transaction(self):
+        with self.app.test_request_context("/"):
+            send_email(
+                self.user.email,
+                "Confirm Your Account",
+                "auth/email/confirm",
+                user=self.user,
+                token="token",
+            )
+        db.session.rollback()
+        self.assertEqual(OutboxMessage.query.count(), 0)
+
+    def test_drain_takes_over_dispatches_of_a_busy_pool(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        class Drain(BoundedDrain):
+            def work(self):
+                calls.append(len(calls))
+                if len(calls) == 1:
+                    started.set()
+                    release.wait(5)
+                return False
+
+        self.app.config["FLASKY_TEST_POOL_SIZE"] = 1
+        drain = Drain("test", "FLASKY_TEST_POOL_SIZE", "FLASKY_TEST_POLL_INTERVAL")
+        drain.dispatch(self.app)
+        started.wait(5)
+        # the pool is full, the running drain must run once more for this
+        drain.dispatch(self.app)
+        release.set()
+        drain._executor.shutdown(wait=True)
+        self.assertEqual(calls, [0, 1])
+        self.assertEqual(drain._scheduled, 0)
+
+    def test_delivery_over_one_connection(self):
+        self.queue(3)
+        with mail.record_messages() as outbox:
+            with mock.patch.object(mail, "connect", wraps=mail.connect) as connect:
+                self.assertEqual(deliver_outbox(), 3)
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(len(outbox), 3)
+        self.assertEqual(outbox[0].recipients, ["john@example.com"])
+        self.assertEqual(OutboxMessage.query.filter_by(sent_at=None).count(), 0)
+        self.assertEqual(deliver_outbox(), 0)
+
+    def test_retry_with_backoff(self):
+        self.queue(1)
+        with mock.patch(
+            "flask_mail.Connection.send", side_effect=OSError("connection lost")
+        ):
+            self.assertEqual(deliver_outbox(), 1)
+        message = OutboxMessage.query.one()
+        self.assertEqual(message.attempts, 1)
+        self.assertIsNone(message.sent_at)
+        self.assertIn("connection lost", message.last_error)
+        self.assertGreater(message.next_attempt_at, datetime.utcnow())
+        # not due before the backoff passed
+        self.assertEqual(deliver_outbox(), 0)
+        message.next_attempt_at = datetime.utcnow()
+        db.session.commit()
+        with mail.record_messages() as outbox:
+            self.assertEqual(deliver_outbox(), 1)
+        self.assertEqual(len(outbox), 1)
+        self.assertIsNotNone(OutboxMessage.query.one().sent_at)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from app import create_app, db
+from app.fake import BulkFaker
+from app.models import Role, User, Follow, Post, Comment, Timeline
+from app.rendering import render
+from app.search import SearchResults
+
+
+class BulkFakerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def counters(self):
+        return sorted(
+            db.session.query(
+                User.id,
+                User.post_count,
+                User.comment_count,
+                User.follower_count,
+                User.followed_count,
+            )
+        ) + sorted(db.session.query(Post.id, Post.comment_count))
+
+    def test_users_need_the_roles(self):
+        Role.query.delete()
+        db.session.commit()
+        with self.assertRaisesRegex(RuntimeError, "default role"):
+            list(BulkFaker(distinct=2, workers=1).users(1))
+
+    def test_bulk_rows_match_model_events(self):
+        existing = User(email="john@example.com", username="john", password="cat")
+        db.session.add(existing)
+        db.session.commit()
+        faker = BulkFaker(distinct=20, batch_size=25, workers=1, seed=1)
+        progress = list(faker.users(40, follows=3))
+        self.assertEqual([done for done, _, _ in progress], [25, 40])
+        for _ in faker.posts(60):
+            pass
+        for _ in faker.comments(80):
+            pass
+        self.assertEqual(User.query.count(), 41)
+        self.assertEqual(Follow.query.count(), 1 + 40 * 4)
+        self.assertEqual(Comment.query.count(), 80)
+        usernames = [username for (username,) in db.session.query(User.username)]
+        self.assertEqual(len(set(usernames)), len(usernames))
+        post = Post.query.get(1)
+        self.assertEqual(post.body_html, render(post.body, "post"))
+        # more follows between the existing users, see fake.follow_user()
+        follows = Follow.query.count()
+        timeline = Timeline.query.count()
+        written = list(faker.follows(2))[-1][1]
+        self.assertGreater(Follow.query.count(), follows)
+        # the follows and their timeline rows
+        self.assertEqual(
+            written, Follow.query.count() - follows + Timeline.query.count() - timeline
+        )
+
+        # what the model events would have maintained for the same rows
+        counters = self.counters()
+        User.reconcile_counters(1, 41)
+        Post.reconcile_counters(1, 60)
+        self.assertEqual(self.counters(), counters)
+        timeline = set(db.session.query(Timeline.user_id, Timeline.post_id))
+        expected = set(
+            db.session.query(Follow.follower_id, Post.id).filter(
+                Follow.followed_id == Post.author_id
+            )
+        )
+        self.assertEqual(timeline, expected)
+        word = post.body.split()[0].strip(".")
+        hits = SearchResults(db.session, word, 100).items
+        self.assertIn(("post", 1), [(hit.kind, hit.id) for hit in hits])
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from app import create_app, db, follow_graph
+from app.follow_graph import Adjacency
+from app.models import User, Follow
+
+
+class FollowGraphTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_adjacency(self):
+        adjacency = Adjacency([(1, 1), (1, 3), (1, 7), (3, 1)])
+        self.assertEqual(list(adjacency.get(1)), [1, 3, 7])
+        self.assertEqual(adjacency.count(2), 0)
+        self.assertTrue(adjacency.contains(1, 7))
+        self.assertFalse(adjacency.contains(1, 4))
+        self.assertFalse(adjacency.contains(9, 1))
+        adjacency.add(1, 4)
+        adjacency.add(9, 1)
+        adjacency.remove(3, 1)
+        self.assertEqual(list(adjacency.get(1)), [1, 3, 4, 7])
+        self.assertTrue(adjacency.contains(9, 1))
+        self.assertEqual(adjacency.count(3), 0)
+        self.assertEqual(adjacency.users(), {1, 3, 9})
+
+    def test_follow_checks_use_index(self):
+        u1 = User(email="john@example.com", password="cat")
+        u2 = User(email="susan@example.org", password="dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        # the rows expired with the commit, load them before counting
+        u1.follows_version, u2.follows_version
+        follow_graph.load()
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        db.event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            self.assertTrue(u1.is_following(u2))
+            self.assertTrue(u2.is_followed_by(u1))
+            self.assertFalse(u2.is_following(u1))
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", listener)
+        self.assertEqual(statements, [])
+        self.assertEqual(follow_graph.common_followed(u1, u2), [u2.id])
+        self.assertEqual(follow_graph.check(), [])
+
+    def test_changes_of_other_workers(self):
+        u1 = User(email="john@example.com", password="cat")
+        u2 = User(email="susan@example.org", password="dog")
+        u3 = User(email="david@example.net", password="dog")
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        self.assertTrue(u1.is_following(u2))
+        self.assertFalse(u1.is_following(u3))
+        # written by another process, bypassing this worker's session events:
+        # u1 unfollows u2 and follows u3, which leaves the counters as they were
+        follows, users = Follow.__table__, User.__table__
+        with db.engine.begin() as connection:
+            connection.execute(follows.delete().where(follows.c.follower_id == u1.id))
+            connection.execute(
+                follows.insert().values(follower_id=u1.id, followed_id=u3.id)
+            )
+            connection.execute(
+                users.update()
+                .where(users.c.id.in_([u1.id, u2.id, u3.id]))
+                .values(follows_version=users.c.follows_version + 1)
+            )
+        self.assertEqual(follow_graph.check(), [u1.id, u2.id, u3.id])
+        db.session.expire_all()
+        # the bumped version of u1 makes the index reload its follows
+        self.assertFalse(u1.is_following(u2))
+        self.assertTrue(u1.is_following(u3))
+        self.assertEqual(follow_graph.check(), [u2.id, u3.id])
+        # the index is not trusted for writes
+        u1.follow(u3)
+        db.session.commit()
+        self.assertEqual(u1.followed.count(), 1)
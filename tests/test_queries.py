@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from flask import g, url_for
+from sqlalchemy.exc import OperationalError
+from app import create_app, db, identity_cache
+from app.explain import explain, full_scans, hot_queries, index_ordered
+from app.explain import ordered_walks, sorts
+from app.instrumentation import fingerprint, RequestQueries
+from app.models import User, Role, Post, Comment
+
+
+class QueryCounter:
+    """count the statements sent to the database inside a with block"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    def __enter__(self):
+        db.event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        db.event.remove(self.engine, "before_cursor_execute", self._on_execute)
+
+
+class QueryBudgetTestCase(unittest.TestCase):
+    """
+    Render every listing page with one row and with many rows, the difference
+    must stay within FLASKY_MAX_QUERIES_PER_ROW for each added row.
+    """
+
+    rows = 10
+
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.client = self.app.test_client(use_cookies=True)
+        moderator = Role.query.filter_by(name="Moderator").first()
+        self.reader = User(
+            email="john@example.com",
+            username="john",
+            password="cat",
+            confirmed=True,
+            role=moderator,
+        )
+        db.session.add(self.reader)
+        db.session.commit()
+        self.reader_id = self.reader.id
+        self.post_id = None
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_rows(self, count):
+        """add posts and comments, each one by a different author"""
+        reader = User.query.get(self.reader_id)
+        for i in range(count):
+            n = Post.query.count()
+            author = User(
+                email="user%d@example.com" % n, username="user%d" % n, password="cat"
+            )
+            reader.follow(author)
+            post = Post(body="post %d" % n, author=author)
+            db.session.add_all([author, post])
+            db.session.flush()
+            if self.post_id is None:
+                self.post_id = post.id
+            comment = Comment(
+                body="comment %d" % n, author=author, post_id=self.post_id
+            )
+            db.session.add(comment)
+        db.session.commit()
+
+    def count_queries(self, url):
+        db.session.expunge_all()
+        with QueryCounter(db.engine) as counter:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return counter.count
+
+    def assertQueriesPerRow(self, url_func):
+        self.add_rows(1)
+        single = self.count_queries(url_func())
+        self.add_rows(self.rows - 1)
+        many = self.count_queries(url_func())
+        per_row = (many - single) / (self.rows - 1)
+        self.assertLessEqual(
+            per_row,
+            self.app.config["FLASKY_MAX_QUERIES_PER_ROW"],
+            "%s issues %.1f queries per row" % (url_func(), per_row),
+        )
+
+    def login(self):
+        response = self.client.post(
+            url_for("auth.login"), data={"email": "john@example.com", "password": "cat"}
+        )
+        self.assertEqual(response.status_code, 302)
+
+    def test_index(self):
+        self.assertQueriesPerRow(lambda: url_for("main.index"))
+
+    def test_index_followed(self):
+        self.login()
+        self.client.get(url_for("main.show_followed"))
+        self.assertQueriesPerRow(lambda: url_for("main.index"))
+
+    def test_post(self):
+        self.assertQueriesPerRow(lambda: url_for("main.post", id=self.post_id))
+
+    def test_moderate(self):
+        self.login()
+        self.assertQueriesPerRow(lambda: url_for("main.moderate"))
+
+    def test_followers(self):
+        self.assertQueriesPerRow(lambda: url_for("main.followed_by", username="john"))
+
+    def test_server_timing(self):
+        self.add_rows(3)
+        response = self.client.get(url_for("main.index"))
+        self.assertIn("db;dur=", response.headers["Server-Timing"])
+        self.assertIn("queries", response.headers["Server-Timing"])
+
+    def test_identity_cache(self):
+        response = self.client.post(
+            "/auth/login", data={"email": "john@example.com", "password": "cat"}
+        )
+        self.assertEqual(response.status_code, 302)
+        self.client.get("/edit-profile")
+        db.session.expunge_all()
+        # current_user comes from its snapshot, permissions from the role table
+        with QueryCounter(db.engine) as counter:
+            response = self.client.get("/edit-profile")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("/moderate", response.get_data(as_text=True))
+        self.assertEqual(counter.count, 0)
+        stats = identity_cache.stats()
+        self.assertEqual(stats["users"]["hits"], 1)
+
+        # an update through the ORM drops the snapshot
+        response = self.client.post(
+            "/edit-profile", data={"name": "John", "location": "", "about_me": ""}
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(identity_cache.stats()["users"]["size"], 0)
+        response = self.client.get("/edit-profile")
+        self.assertIn('value="John"', response.get_data(as_text=True))
+
+    def test_n_plus_one_detection(self):
+        self.assertEqual(
+            fingerprint("SELECT * FROM users WHERE id = 42 AND name = 'bob'"),
+            fingerprint("SELECT *\nFROM users WHERE id = 7 AND name = 'alice'"),
+        )
+        self.assertEqual(
+            fingerprint("SELECT * FROM users WHERE id IN (?, ?, ?)"),
+            "SELECT * FROM users WHERE id IN (?)",
+        )
+        queries = RequestQueries()
+        for i in range(6):
+            queries.record("SELECT * FROM users WHERE id = ?", (i,), 0.001)
+        queries.record("SELECT * FROM posts", (), 0.001)
+        self.assertEqual(queries.repeated(5), {"SELECT * FROM users WHERE id = ?": 6})
+        self.assertEqual(queries.count, 7)
+
+    def test_failed_statement_timing(self):
+        with self.app.test_request_context("/"):
+            g.queries = RequestQueries()
+            with self.assertRaises(OperationalError):
+                db.session.execute("SELECT * FROM no_such_table")
+            db.session.rollback()
+            db.session.execute("SELECT 1")
+            # only the statement that ran is timed, nothing is left behind
+            self.assertEqual(g.queries.count, 1)
+            self.assertNotIn("query_start_time", db.session.connection().info)
+
+    def test_hot_queries_use_indexes(self):
+        self.add_rows(3)
+        post = Post.query.first()
+        connection = db.session.connection()
+        for name, query in hot_queries(self.reader, post):
+            plan = explain(connection, query)
+            self.assertTrue(plan, name)
+            self.assertEqual(full_scans(plan, name in ordered_walks), [], name)
+            if name in index_ordered:
+                # a range scan of the timeline index, in page order
+                self.assertEqual(sorts(plan), [], name)
+                self.assertIn("ix_timeline_user_id_timestamp", plan[0], name)
+        self.assertEqual(full_scans(["SCAN posts"], True), ["SCAN posts"])
+        walk = "SCAN posts USING INDEX ix_posts_timestamp"
+        self.assertEqual(full_scans([walk]), [walk])
+        self.assertEqual(full_scans([walk], True), [])
+        sort = "USE TEMP B-TREE FOR RIGHT PART OF ORDER BY"
+        self.assertEqual(sorts([walk, sort]), [sort])
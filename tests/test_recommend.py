@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+from app import create_app, db, recommend
+from app.models import User, FollowSuggestion
+
+
+class RecommendTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.users = [
+            User(email="user%d@example.com" % i, username="user%d" % i, password="cat")
+            for i in range(5)
+        ]
+        db.session.add_all(self.users)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_follow_suggestions(self):
+        u0, u1, u2, u3, u4 = self.users
+        db.session.add_all(
+            [
+                FollowSuggestion(user_id=u0.id, rank=1, suggested_id=u3.id, score=2),
+                FollowSuggestion(user_id=u0.id, rank=2, suggested_id=u1.id, score=1),
+                FollowSuggestion(user_id=u0.id, rank=3, suggested_id=u4.id, score=1),
+            ]
+        )
+        db.session.commit()
+        self.assertEqual(u0.follow_suggestions(), [u3, u1, u4])
+        # followed after the job ran
+        u0.follow(u1)
+        db.session.commit()
+        self.assertEqual(u0.follow_suggestions(limit=2), [u3, u4])
+        response = self.app.test_client().get("/api/v1.0/users/%d/suggestions/" % u0.id)
+        suggestions = json.loads(response.get_data(as_text=True))["suggestions"]
+        self.assertEqual([s["username"] for s in suggestions], ["user3", "user4"])
+
+    @unittest.skipUnless(recommend.available(), "needs numpy and scipy")
+    def test_recommend_job(self):
+        u0, u1, u2, u3, u4 = self.users
+        # u0 -> u1, u2; u1 -> u3, u4; u2 -> u3
+        for follower, followed in ((u0, u1), (u0, u2), (u1, u3), (u1, u4), (u2, u3)):
+            follower.follow(followed)
+        db.session.commit()
+        connection = db.engine.connect()
+        matrix = recommend.load_matrix(connection)
+        self.assertEqual(matrix.nnz, 5)
+        # a tiny bound, to split the work into several chunks
+        for start, end, rows in recommend.suggest(matrix, top_k=10, max_nnz=2):
+            recommend.write_suggestions(connection, start, end, rows)
+        connection.close()
+        suggestions = FollowSuggestion.query.filter_by(user_id=u0.id).all()
+        self.assertEqual(
+            [(s.rank, s.suggested_id, s.score) for s in suggestions],
+            [(1, u3.id, 2.0), (2, u4.id, 1.0)],
+        )
+        self.assertEqual(u0.follow_suggestions(), [u3, u4])
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from app import create_app, db
+from app.models import User, Role, Post
+from app.rendering import (
+    RenderCache,
+    allowed_tags,
+    render_pending,
+    render_rows,
+    rerender,
+    save_checkpoint,
+)
+
+
+class RenderingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        u = User(email="john@example.com", username="john", password="cat")
+        db.session.add(u)
+        db.session.add_all([Post(body="post *%d*" % i, author=u) for i in range(5)])
+        db.session.commit()
+        # stale html, as if rendered with other tags
+        db.session.execute(Post.__table__.update().values(body_html="stale"))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def body_html(self):
+        return [html for (html,) in db.session.query(Post.body_html).order_by(Post.id)]
+
+    def test_rerender(self):
+        progress = list(rerender(Post.__table__, "post", chunk_size=2, workers=1))
+        self.assertEqual([done for done, rate in progress], [2, 4, 5])
+        self.assertEqual(
+            self.body_html(), ["<p>post <em>%d</em></p>" % i for i in range(5)]
+        )
+
+    def test_rerender_process_pool(self):
+        list(rerender(Post.__table__, "post", chunk_size=2, workers=2))
+        self.assertEqual(
+            self.body_html(), ["<p>post <em>%d</em></p>" % i for i in range(5)]
+        )
+
+    def test_rerender_keeps_concurrent_edits(self):
+        first = Post.query.order_by(Post.id).first()
+
+        def edit_while_rendering(rows, profile):
+            rendered = render_rows(rows, profile)
+            # saved by a request between the read and the write of the chunk
+            db.session.execute(
+                Post.__table__.update()
+                .where(Post.id == first.id)
+                .values(body="edited", body_html="<p>edited</p>")
+            )
+            return rendered
+
+        with mock.patch("app.rendering.render_rows", edit_while_rendering):
+            list(rerender(Post.__table__, "post", chunk_size=2, workers=1))
+        self.assertEqual(
+            self.body_html(),
+            ["<p>edited</p>"] + ["<p>post <em>%d</em></p>" % i for i in range(1, 5)],
+        )
+
+    def test_rerender_resumes_from_checkpoint(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            third = Post.query.order_by(Post.id).all()[2]
+            save_checkpoint(path, {"posts": third.id})
+            list(
+                rerender(
+                    Post.__table__,
+                    "post",
+                    chunk_size=2,
+                    workers=1,
+                    checkpoint_path=path,
+                )
+            )
+        finally:
+            os.remove(path)
+        self.assertEqual(
+            self.body_html(),
+            ["stale"] * 3 + ["<p>post <em>%d</em></p>" % i for i in (3, 4)],
+        )
+
+    def test_render_cache(self):
+        cache = RenderCache()
+        html = cache.render("thanks!", "comment")
+        self.assertEqual(html, "thanks!")
+        self.assertEqual(cache.render("thanks!", "comment"), html)
+        # same markdown, other profile: p is not allowed in comments
+        self.assertEqual(cache.render("thanks!", "post"), "<p>thanks!</p>")
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["size"]), (1, 2, 2))
+
+    def test_render_cache_on_disk(self):
+        path = tempfile.mkdtemp()
+        try:
+            self.app.config["FLASKY_RENDER_CACHE_DIR"] = path
+            cache = RenderCache(self.app)
+            html = cache.render("*hi* http://example.com", "comment")
+            # a new process starts with an empty memory, but finds the file
+            cache = RenderCache(self.app)
+            self.assertEqual(cache.render("*hi* http://example.com", "comment"), html)
+            self.assertEqual(cache.stats()["disk_hits"], 1)
+            # nor files rendered with another whitelist
+            with mock.patch.dict(allowed_tags, comment=["b"]):
+                cache = RenderCache(self.app)
+                cache.render("*hi* http://example.com", "comment")
+            self.assertEqual(cache.stats()["disk_hits"], 0)
+            cache.clear()
+            self.assertEqual(os.listdir(path), [])
+        finally:
+            shutil.rmtree(path)
+
+
+class DeferredRenderingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app.config["FLASKY_RENDER_ASYNC"] = True
+        self.app.config["FLASKY_RENDER_ASYNC_MIN_LENGTH"] = 10
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email="john@example.com", username="john", password="cat")
+        db.session.add(self.user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_deferred_rendering(self):
+        short = Post(body="*short*", author=self.user)
+        long = Post(body="*long* <b>post</b>", author=self.user)
+        db.session.add_all([short, long])
+        db.session.commit()
+        self.assertFalse(short.render_pending)
+        self.assertEqual(short.body_html, "<p><em>short</em></p>")
+        self.assertTrue(long.render_pending)
+        self.assertIsNone(long.body_html)
+        self.assertEqual(long.rendered_body(), "*long* &lt;b&gt;post&lt;/b&gt;")
+
+        self.assertEqual(render_pending(), 1)
+        self.assertEqual(render_pending(), 0)
+        db.session.expire_all()
+        self.assertFalse(long.render_pending)
+        self.assertEqual(long.body_html, "<p><em>long</em> <b>post</b></p>")
+
+    def test_edit_while_pending(self):
+        post = Post(body="first long body", author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        post.body = "*second* long body"
+        db.session.add(post)
+        db.session.commit()
+        self.assertTrue(post.render_pending)
+        self.assertEqual(render_pending(), 1)
+        db.session.expire_all()
+        self.assertEqual(post.body_html, "<p><em>second</em> long body</p>")
+        self.assertEqual(post.to_json()["body_html"], post.body_html)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+from app import create_app, db
+from app.models import User, Role, Post, Comment
+from app.search import SearchResults, rebuild
+
+
+class SearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app("testing")
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        Role.insert_roles()
+        self.user = User(email="john@example.com", username="john", password="cat")
+        db.session.add(self.user)
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def search(self, q, per_page=10, cursor=None, candidates=100):
+        return SearchResults(db.session, q, per_page, cursor, candidates)
+
+    def test_index_follows_writes(self):
+        post = Post(body="the quick brown fox", author=self.user)
+        db.session.add(post)
+        db.session.commit()
+        comment = Comment(body="a lazy dog <script>", post=post, author=self.user)
+        db.session.add(comment)
+        db.session.commit()
+        self.assertEqual([hit.id for hit in self.search("quick fox").items], [post.id])
+        hit = self.search("lazy").items[0]
+        self.assertEqual(
+            (hit.kind, hit.id, hit.post_id), ("comment", comment.id, post.id)
+        )
+        self.assertEqual(hit.snippet, "a <mark>lazy</mark> dog &lt;script&gt;")
+
+        # post is expired after the commit, the old body is loaded on set
+        post.body = "the slow brown fox"
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(self.search("quick").items, [])
+        self.assertEqual(len(self.search("slow").items), 1)
+
+        comment.disabled = True
+        db.session.add(comment)
+        db.session.commit()
+        self.assertEqual(self.search("lazy").items, [])
+
+        db.session.delete(post)
+        db.session.commit()
+        self.assertEqual(self.search("fox").items, [])
+
+    def test_ranking_and_cursor(self):
+        db.session.add_all(
+            [Post(body="fox " * n + "end", author=self.user) for n in range(1, 6)]
+        )
+        db.session.commit()
+        first = self.search("fox", per_page=2)
+        # more occurrences of the term, better rank
+        self.assertEqual([hit.id for hit in first.items], [5, 4])
+        second = self.search("fox", per_page=2, cursor=first.next_cursor)
+        third = self.search("fox", per_page=2, cursor=second.next_cursor)
+        self.assertEqual([hit.id for hit in second.items + third.items], [3, 2, 1])
+        self.assertFalse(third.has_next)
+
+    def test_rebuild(self):
+        db.session.add(Post(body="indexed later", author=self.user))
+        db.session.commit()
+        db.session.execute("DELETE FROM posts_fts")
+        db.session.commit()
+        self.assertEqual(self.search("later").items, [])
+        with db.engine.begin() as connection:
+            rebuild(connection)
+        self.assertEqual(len(self.search("later").items), 1)
+
+    def test_search_endpoints(self):
+        db.session.add(Post(body='a "quoted" fox', author=self.user))
+        db.session.commit()
+        response = self.client.get("/search?q=fox")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            "a &#34;quoted&#34; <mark>fox</mark>", response.get_data(as_text=True)
+        )
+        response = self.client.get('/api/v1.0/search/?q="quoted')
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.get_data(as_text=True))
+        self.assertEqual(len(results["results"]), 1)
+        self.assertEqual(results["results"][0]["type"], "post")
+        self.assertIsNone(results["next"])
+        response = self.client.get("/api/v1.0/search/?q=fox&cursor=bad")
+        self.assertEqual(response.status_code, 400)
+
+    def test_candidates(self):
+        db.session.add_all(
+            [Post(body="fox " * n + "end", author=self.user) for n in range(5, 0, -1)]
+        )
+        db.session.commit()
+        # only the 3 newest matches are ranked
+        results = self.search("fox", per_page=2, candidates=3)
+        self.assertEqual([hit.id for hit in results.items], [3, 4])
+        more = self.search("fox", per_page=2, cursor=results.next_cursor)
+        self.assertEqual([hit.id for hit in more.items], [5])
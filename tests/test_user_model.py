@@ -3,8 +3,17 @@
 import unittest
 import time
 from datetime import datetime
-from app import create_app, db
-from app.models import User, Role, Permission, AnonymousUser, Follow
+from app import create_app, db, last_seen_buffer, role_table
+from app.models import (
+    User,
+    Role,
+    Permission,
+    AnonymousUser,
+    Follow,
+    Post,
+    Timeline,
+    Comment,
+)
 
 
 class UserModleTestCase(unittest.TestCase):
@@ -35,6 +44,17 @@ class UserModleTestCase(unittest.TestCase):
         self.assertTrue(u.verify_password("cat"))
         self.assertFalse(u.verify_password("dog"))
 
+    def test_password_rehash(self):
+        self.app.config["FLASKY_PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:1000"
+        u = User(password="cat")
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:1000$"))
+        self.app.config["FLASKY_PASSWORD_HASH_METHOD"] = "pbkdf2:sha256:2000"
+        self.assertFalse(u.verify_password("dog"))
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:1000$"))
+        self.assertTrue(u.verify_password("cat"))
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:2000$"))
+        self.assertTrue(u.verify_password("cat"))
+
     def test_password_salts_are_random(self):
         u1 = User(password="cat")
         u2 = User(password="cat")
@@ -136,6 +156,47 @@ class UserModleTestCase(unittest.TestCase):
         self.assertTrue(u.can(Permission.MODERATE))
         self.assertTrue(u.can(Permission.ADMIN))
 
+    def test_role_table(self):
+        u = User(email="john@example.com", password="cat")
+        db.session.add(u)
+        db.session.commit()
+        u = User.query.get(u.id)
+        statements = []
+        record = lambda conn, cursor, statement, *args: statements.append(statement)
+        db.event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            self.assertTrue(u.can(Permission.WRITE))
+            self.assertFalse(u.is_administrator())
+            self.assertEqual(role_table.get().by_name["User"].id, u.role_id)
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(statements, [])
+        # an edit is seen before it is flushed, as by a query
+        r = Role.query.filter_by(name="User").first()
+        r.remove_permission(Permission.WRITE)
+        self.assertFalse(u.can(Permission.WRITE))
+        db.session.rollback()
+        self.assertTrue(u.can(Permission.WRITE))
+        # reloaded once a role is written
+        r.remove_permission(Permission.WRITE)
+        db.session.commit()
+        self.assertFalse(u.can(Permission.WRITE))
+
+    def test_role_change_revokes_tokens(self):
+        u = User(email="john@example.com", password="cat")
+        db.session.add(u)
+        db.session.commit()
+        generation = u.token_generation
+        # as the admin edit-profile form does, the old role is not loaded
+        u = User.query.get(u.id)
+        u.role = Role.query.filter_by(name="User").first()
+        u.confirmed = u.confirmed
+        db.session.commit()
+        self.assertEqual(u.token_generation, generation)
+        u.role = Role.query.filter_by(name="Moderator").first()
+        db.session.commit()
+        self.assertEqual(u.token_generation, generation + 1)
+
     def test_anonymous_user(self):
         u = AnonymousUser()
         self.assertFalse(u.can(Permission.FOLLOW))
@@ -157,10 +218,56 @@ class UserModleTestCase(unittest.TestCase):
         u = User(password="cat")
         db.session.add(u)
         db.session.commit()
+        self.app.config["FLASKY_LAST_SEEN_RESOLUTION"] = 1
         time.sleep(2)
         last_seen_before = u.last_seen
         u.ping()
         self.assertTrue(u.last_seen > last_seen_before)
+        # written behind, the session has nothing to flush
+        self.assertFalse(db.session.dirty)
+        last_seen_buffer.flush()
+        db.session.expire(u)
+        self.assertTrue(u.last_seen > last_seen_before)
+
+    def test_last_seen_flushed_at_exit(self):
+        u = User(password="cat")
+        db.session.add(u)
+        db.session.commit()
+        last_seen = datetime(2030, 1, 1)
+        user_id = u.id
+        last_seen_buffer.record(user_id, last_seen)
+        # every app buffers for its own database
+        other = create_app("testing")
+        with other.app_context():
+            self.assertIsNone(last_seen_buffer.pending(user_id))
+        last_seen_buffer._flush_at_exit()
+        self.assertEqual(User.query.get(user_id).last_seen, last_seen)
+
+    def test_last_seen_flush_failure(self):
+        u = User(password="cat")
+        db.session.add(u)
+        db.session.commit()
+        last_seen = datetime(2030, 1, 1)
+        user_id = u.id
+        last_seen_buffer.record(user_id, last_seen)
+        db.session.remove()
+        User.__table__.drop(db.engine)
+        self.app.config["FLASKY_LAST_SEEN_FLUSH_SIZE"] = 1
+        # logged at teardown, and kept for the next flush
+        with self.assertLogs(self.app.logger, "ERROR"):
+            with self.app.test_request_context("/"):
+                pass
+        self.assertEqual(last_seen_buffer.pending(user_id), last_seen)
+
+    def test_ping_resolution(self):
+        """last_seen is coarsened to FLASKY_LAST_SEEN_RESOLUTION"""
+        u = User(password="cat")
+        db.session.add(u)
+        db.session.commit()
+        last_seen_before = u.last_seen
+        u.ping()
+        self.assertEqual(u.last_seen, last_seen_before)
+        self.assertIsNone(last_seen_buffer.pending(u.id))
 
     def test_gravatar(self):
         u = User(email="john@example.com", password="cat")
@@ -216,6 +323,85 @@ class UserModleTestCase(unittest.TestCase):
         db.session.commit()
         self.assertTrue(Follow.query.count() == 1)
 
+    def test_timeline(self):
+        u1 = User(email="john@example.com", password="cat")
+        u2 = User(email="susan@example.org", password="dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p1 = Post(body="old post", author=u2)
+        db.session.add(p1)
+        db.session.commit()
+        # backfilled on follow
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.all(), [p1])
+        # fanned out on write
+        p2 = Post(body="new post", author=u2)
+        db.session.add(p2)
+        db.session.commit()
+        self.assertEqual(Timeline.query.filter_by(user_id=u1.id).count(), 2)
+        self.assertEqual(
+            u1.followed_posts.order_by(Post.timestamp.desc()).all(), [p2, p1]
+        )
+        # pruned on unfollow
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts.count(), 0)
+        self.assertEqual(u2.followed_posts.count(), 2)
+
+    def test_timeline_celebrity(self):
+        self.app.config["FLASKY_TIMELINE_FANOUT_LIMIT"] = 1
+        u1 = User(email="john@example.com", password="cat")
+        u2 = User(email="susan@example.org", password="dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        p = Post(body="celebrity post", author=u2)
+        db.session.add(p)
+        db.session.commit()
+        # not fanned out, but still joined in on read
+        self.assertTrue(u2.celebrity)
+        self.assertEqual(Timeline.query.filter_by(post_id=p.id).count(), 0)
+        self.assertEqual(u1.followed_posts.all(), [p])
+        self.assertEqual(u2.followed_posts.all(), [p])
+
+    def test_counters(self):
+        u1 = User(email="john@example.com", password="cat")
+        u2 = User(email="susan@example.org", password="dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertEqual((u1.follower_count, u1.followed_count), (1, 1))
+        u1.follow(u2)
+        p = Post(body="post", author=u2)
+        db.session.add(p)
+        db.session.commit()
+        c = Comment(body="comment", author=u1, post=p)
+        db.session.add(c)
+        db.session.commit()
+        self.assertEqual(u1.followed_count, 2)
+        self.assertEqual(u2.follower_count, 2)
+        self.assertEqual(u2.post_count, 1)
+        self.assertEqual(u1.comment_count, 1)
+        self.assertEqual(p.comment_count, 1)
+        db.session.delete(c)
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_count, 1)
+        self.assertEqual(u2.follower_count, 1)
+        self.assertEqual(u1.comment_count, 0)
+        self.assertEqual(p.comment_count, 0)
+
+        # drift is repaired by the reconciliation
+        u2.post_count = 42
+        p.comment_count = 42
+        db.session.commit()
+        User.reconcile_counters(u1.id, u2.id)
+        Post.reconcile_counters(p.id, p.id)
+        db.session.commit()
+        self.assertEqual(u2.post_count, 1)
+        self.assertEqual(p.comment_count, 0)
+
     def test_to_json(self):
         u = User(email="john@example.com", password="cat")
         db.session.add(u)